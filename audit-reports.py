@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+import traceback
+from datetime import datetime
+
+from dataloader.counter_db import ReportInventoryTable
+from dataloader.pipeline import open_report
+from dataloader.reconcile import format_reconciliation, is_reconciled, reconcile
+
+
+# Checks loaded reports against the metric table. Every report in the
+# report_inventory table whose file is still in the report directory is
+# read again and its totals compared with the database, see
+# dataloader/reconcile.py. loader.py --verify runs the same check after
+# each load.
+
+def write_error(err_msg):
+    logfile = open('errors.log', 'at')
+    logfile.write(datetime.now().isoformat() + '\n')
+    logfile.write(err_msg + '\n')
+    logfile.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage='python audit-reports.py <report directory> [--year YYYY] [--verbose]')
+    parser.add_argument('reportdir')
+    parser.add_argument('--year', help='only audit reports beginning in this year')
+    parser.add_argument('--verbose', action='store_true', help='also list reports that match')
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+    else:
+        args = parser.parse_args()
+        reportdir = os.path.abspath(args.reportdir)
+        audited = 0
+        problems = 0
+        for row in ReportInventoryTable().get_reports(args.year):
+            f = os.path.join(reportdir, row.excel_name)
+            if not os.path.exists(f):
+                continue
+            try:
+                report = open_report(f)
+                result = reconcile(report)
+                report.close()
+            except Exception:
+                print('{0}: ERROR (see errors.log)'.format(row.excel_name))
+                write_error('{0}\n{1}'.format(f, traceback.format_exc()))
+                problems += 1
+                continue
+            audited += 1
+            if not is_reconciled(result):
+                problems += 1
+                print(format_reconciliation(result))
+            elif args.verbose:
+                print(format_reconciliation(result))
+
+        print('Audited {0} reports: {1} with problems'.format(audited, problems))
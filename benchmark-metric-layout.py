@@ -0,0 +1,134 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from dataloader.backends import DuckDbBackend
+from dataloader.counter_db import BulkImport, CounterDb, MetricTable, TitleReportTable
+from dataloader.filters import compile_filter
+from dataloader.pipeline import open_report, staging_sink
+
+
+# Compares the long and wide metric layouts (see MetricTable) on the same
+# reports. Two embedded DuckDB databases are created in a scratch
+# directory, one per layout, and the reports are loaded into each with the
+# loader's own staging and merge steps. The benchmark reports:
+#
+#   - load time: export, bulk import and merge of every report
+#   - disk footprint: the database file size after a checkpoint
+#   - query time: the median of several runs of a few typical filters,
+#     which read the wide layout through the metric view
+#
+# Requires the optional duckdb package. On a MySQL server, compare the
+# data_length and index_length of metric and metric_wide in
+# information_schema.tables after running sql/use-metric-wide.sql.
+
+QUERIES = [
+    ('usage by title', {'group_by': 'title'}),
+    ('usage by month', {'group_by': 'month'}),
+    ('usage by platform', {'group_by': 'platform'}),
+    ('requests, first half year', {'metric_type': 'Total_Item_Requests', 'begin': '01', 'end': '06',
+        'group_by': 'title'}),
+]
+
+
+def create_database(path, layout):
+    import duckdb
+    con = duckdb.connect(path)
+    with open('sql/counter-r5-duckdb.sql') as f:
+        con.execute(f.read())
+    if layout == 'wide':
+        with open('sql/use-metric-wide-duckdb.sql') as f:
+            con.execute(f.read())
+    con.close()
+
+
+def load_reports(files, stagedir):
+    """
+    Loads the reports into the current database and returns the time taken.
+    """
+    start = time.perf_counter()
+    for f in files:
+        report = open_report(f)
+        report.export(staging_sink(stagedir))
+        BulkImport(stagedir).import_all()
+        TitleReportTable().insert_from_temp(None)
+        MetricTable().insert_from_temp(None)
+        report.close()
+    return time.perf_counter() - start
+
+
+def database_size(path):
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"CHECKPOINT")
+    return os.path.getsize(path)
+
+
+def time_query(params, title_type, year, runs):
+    """
+    Returns the median time of runs executions of a filter, and its row
+    count. Month-only begin and end params are completed with year.
+    """
+    params = dict(params)
+    for key in ['begin', 'end']:
+        if key in params:
+            params[key] = '{0}-{1}'.format(year, params[key])
+    sql, values = compile_filter(params, title_type)
+    cursor = CounterDb.conn.cursor()
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        cursor.execute(sql, values)
+        rows = cursor.fetchall()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), len(rows)
+
+
+def run_layout(layout, files, workdir, args):
+    path = os.path.join(workdir, 'counter5-{0}.duckdb'.format(layout))
+    stagedir = os.path.join(workdir, 'staging-{0}'.format(layout))
+    os.makedirs(stagedir, exist_ok=True)
+    create_database(path, layout)
+    CounterDb.use(DuckDbBackend(path), layout)
+    TitleReportTable.clear_cache()
+
+    result = {'load': load_reports(files, stagedir), 'size': database_size(path)}
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT COUNT(*) FROM metric_wide" if layout == 'wide' else u"SELECT COUNT(*) FROM metric")
+    result['rows'] = cursor.fetchone()[0]
+    for name, params in QUERIES:
+        result[name] = time_query(params, args.title_type, args.year, args.runs)
+    CounterDb.conn.close()
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage='python benchmark-metric-layout.py <report file> ... [--year YYYY] [--title-type J|B] [--runs N]')
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--year', default='2022', help='year used by the dated queries')
+    parser.add_argument('--title-type', default='J', choices=['J', 'B'])
+    parser.add_argument('--runs', type=int, default=5, help='runs per query')
+    parser.add_argument('--workdir', help='scratch directory, by default a temporary one')
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+    else:
+        args = parser.parse_args()
+        files = [os.path.abspath(f) for f in args.files]
+        workdir = args.workdir or tempfile.mkdtemp(prefix='counter5-bench-')
+        results = {layout: run_layout(layout, files, workdir, args) for layout in ['long', 'wide']}
+
+        long, wide = results['long'], results['wide']
+        print('{0:<30} {1:>14} {2:>14}'.format('', 'long', 'wide'))
+        print('{0:<30} {1:>14} {2:>14}'.format('stored rows', long['rows'], wide['rows']))
+        print('{0:<30} {1:>14} {2:>14}'.format('database size (bytes)', long['size'], wide['size']))
+        print('{0:<30} {1:>14.3f} {2:>14.3f}'.format('load time (s)', long['load'], wide['load']))
+        for name, params in QUERIES:
+            (long_time, long_rows), (wide_time, wide_rows) = long[name], wide[name]
+            note = '' if long_rows == wide_rows else '  (row counts differ: {0} vs {1})'.format(
+                long_rows, wide_rows)
+            print('{0:<30} {1:>14.4f} {2:>14.4f}{3}'.format(name + ' (s)', long_time, wide_time, note))
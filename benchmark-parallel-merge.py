@@ -0,0 +1,97 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from dataloader.counter_db import BulkImport, CounterDb, TitleReportTable
+from dataloader.merge import ParallelMerge
+from dataloader.pipeline import open_report, staging_sink
+
+
+# Measures how the merge of the temp tables scales with the number of
+# connections (see dataloader/merge.py). The given reports are staged once
+# per run and merged with each connection count in turn, starting from
+# empty tables every time, and the title and metric merge rates are
+# reported separately.
+#
+# The benchmark deletes everything in title_report and metric between
+# runs, so it only runs against an empty scratch database: point
+# dataloader/config.py at one created from sql/counter-r5.sql (or the
+# DuckDB schema) first.
+
+def clear_tables():
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"DELETE FROM metric_wide" if CounterDb.metric_layout == 'wide' else u"DELETE FROM metric")
+    for table in ['title_cluster_key', 'title_cluster', 'title_report']:
+        cursor.execute(u"DELETE FROM {0}".format(table))
+    CounterDb.conn.commit()
+    TitleReportTable.clear_cache()
+
+
+def stage(files, stagedir):
+    """
+    Stages the reports together in the temp tables.
+    """
+    sink = staging_sink(stagedir)
+    for f in files:
+        report = open_report(f)
+        for title, metrics in report.iter_records():
+            sink.write(title, metrics)
+        report.close()
+    sink.close()
+    BulkImport(stagedir).import_all()
+
+
+def time_merge(connections):
+    merge = ParallelMerge(connections)
+    start = time.perf_counter()
+    titles = merge.merge_titles(None)
+    middle = time.perf_counter()
+    metrics = merge.merge_metrics(None)
+    end = time.perf_counter()
+    return titles, middle - start, metrics, end - middle
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage='python benchmark-parallel-merge.py <report file> ... [--connections 1,2,4,8] [--runs N]')
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--connections', default='1,2,4,8',
+        help='comma separated connection counts to try')
+    parser.add_argument('--runs', type=int, default=3, help='runs per connection count')
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+        sys.exit(0)
+
+    args = parser.parse_args()
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT COUNT(*) FROM title_report")
+    if cursor.fetchone()[0]:
+        print('title_report is not empty; run the benchmark against an empty scratch database')
+        sys.exit(1)
+
+    files = [os.path.abspath(f) for f in args.files]
+    stagedir = tempfile.mkdtemp(prefix='counter5-bench-')
+    print('{0:>11} {1:>12} {2:>14} {3:>12} {4:>14}'.format('connections', 'title rows/s',
+        'title speedup', 'metric rows/s', 'metric speedup'))
+    baseline = None
+    for connections in [int(n) for n in args.connections.split(',')]:
+        title_times = []
+        metric_times = []
+        for i in range(args.runs):
+            clear_tables()
+            stage(files, stagedir)
+            titles, title_time, metrics, metric_time = time_merge(connections)
+            title_times.append(title_time)
+            metric_times.append(metric_time)
+        title_rate = titles / statistics.median(title_times)
+        metric_rate = metrics / statistics.median(metric_times)
+        baseline = baseline or (title_rate, metric_rate)
+        print('{0:>11} {1:>12.0f} {2:>13.2f}x {3:>12.0f} {4:>13.2f}x'.format(connections, title_rate,
+            title_rate / baseline[0], metric_rate, metric_rate / baseline[1]))
+    clear_tables()
+    ParallelMerge.close_pool()
@@ -0,0 +1,415 @@
+import argparse
+import csv
+import json
+import random
+import re
+import sys
+import time
+from itertools import groupby
+
+from dataloader.backends import BatchInserter
+from dataloader.counter_db import CounterDb, FilterTable, TitleClusterTable
+from dataloader.filters import FilterEngine, FilterError
+from dataloader.normalize import title_key
+
+
+# Runs a library of typical reporting queries against the configured
+# database and reports how the indexes serve them, so the indexes in
+# sql/create-indexes.sql can be weighed against what they cost the loader.
+# For each query it reports:
+#
+#   - latency: median (p50), p95 and maximum over --runs executions, after
+#     one warm-up run
+#   - the plan: the index used for each table, or a full scan with the
+#     planner's row estimate (--plans prints every step)
+#
+# followed by the indexes of the reporting tables with their size and the
+# queries that used them, and the full scans of large tables with the
+# columns the query filters or joins them on, which are candidates for a
+# missing index. The saved filters in the filter table are run too, so the
+# mix follows what users actually ask for.
+#
+# The database has no cost data, so the cost-per-use queries join a
+# bench_cost table of subscription costs by print ISSN: read from --costs
+# (a CSV file of issn,cost rows), or made up for every ISSN. The table is
+# dropped again at the end. (It is not a TEMPORARY table because DuckDB
+# cursors do not share them.)
+#
+# With --synthetic N, an empty scratch database is first filled with N
+# made-up titles and two years of usage. To weigh an index, save a run
+# with --save, drop the index, and compare with --baseline; time a load
+# with and without it (e.g. benchmark-parallel-merge.py) for its cost.
+#
+# Index advice is for MySQL: DuckDB scans columns by design and only uses
+# its indexes for point lookups.
+
+READ_TABLES = ['title_report', 'metric', 'metric_wide', 'platform_ref', 'title_cluster', 'title_cluster_key']
+
+# Indexes the loader needs whatever the queries do.
+LOADER_INDEXES = {
+    'idx_load_id': 'unload-report.py',
+    'idx_cluster_id': 'title clusters',
+}
+
+QUERIES = [
+    ('title by month',
+        u"SELECT m.period, m.metric_type, SUM(m.period_total) FROM metric m \
+        WHERE m.title_report_id = %s AND m.period BETWEEN %s AND %s \
+        GROUP BY m.period, m.metric_type",
+        lambda s: [s['title_id'], s['begin'], s['end']]),
+    ('title across platforms',
+        u"SELECT t.platform_id, SUM(m.period_total) FROM title_cluster c \
+        JOIN title_cluster k ON k.cluster_id = c.cluster_id \
+        JOIN title_report t ON t.id = k.title_report_id \
+        JOIN metric m ON m.title_report_id = t.id \
+        WHERE c.title_report_id = %s AND m.period BETWEEN %s AND %s \
+        GROUP BY t.platform_id",
+        lambda s: [s['title_id'], s['begin'], s['end']]),
+    ('titles by issn',
+        u"SELECT t.id, t.title, t.platform_id FROM title_report t \
+        WHERE t.print_issn = %s OR t.online_issn = %s",
+        lambda s: [s['issn'], s['issn']]),
+    ('titles by name',
+        u"SELECT t.id, t.title, t.publisher FROM title_report t \
+        WHERE t.title_type = %s AND t.title LIKE %s ORDER BY t.title LIMIT 100",
+        lambda s: [s['title_type'], s['title_prefix'] + '%']),
+    ('publisher by title',
+        u"SELECT t.id, t.title, SUM(m.period_total) FROM title_report t \
+        JOIN metric m ON m.title_report_id = t.id \
+        WHERE t.title_type = %s AND t.publisher = %s AND m.period BETWEEN %s AND %s \
+        GROUP BY t.id, t.title",
+        lambda s: [s['title_type'], s['publisher'], s['begin'], s['end']]),
+    ('platforms in year',
+        u"SELECT t.platform_id, m.metric_type, SUM(m.period_total) FROM metric m \
+        JOIN title_report t ON t.id = m.title_report_id \
+        WHERE m.title_type = %s AND m.period BETWEEN %s AND %s \
+        GROUP BY t.platform_id, m.metric_type",
+        lambda s: [s['title_type'], s['begin'], s['end']]),
+    ('platform by month',
+        u"SELECT m.period, m.metric_type, SUM(m.period_total) FROM metric m \
+        JOIN title_report t ON t.id = m.title_report_id \
+        WHERE t.platform_id = %s AND m.period BETWEEN %s AND %s \
+        GROUP BY m.period, m.metric_type",
+        lambda s: [s['platform_id'], s['begin'], s['end']]),
+    ('year totals by type',
+        u"SELECT m.metric_type, m.access_type, SUM(m.period_total) FROM metric m \
+        WHERE m.title_type = %s AND m.period BETWEEN %s AND %s \
+        GROUP BY m.metric_type, m.access_type",
+        lambda s: [s['title_type'], s['begin'], s['end']]),
+    ('years compared',
+        u"SELECT YEAR(m.period), SUM(m.period_total) FROM metric m \
+        WHERE m.title_type = %s AND m.metric_type = %s \
+        GROUP BY YEAR(m.period)",
+        lambda s: [s['title_type'], s['requests']]),
+    ('top titles in year',
+        u"SELECT m.title_report_id, SUM(m.period_total) AS total FROM metric m \
+        WHERE m.title_type = %s AND m.metric_type = %s AND m.period BETWEEN %s AND %s \
+        GROUP BY m.title_report_id ORDER BY total DESC LIMIT 50",
+        lambda s: [s['title_type'], s['requests'], s['begin'], s['end']]),
+    ('cost per use',
+        u"SELECT c.issn, c.cost, SUM(m.period_total) AS uses, c.cost / SUM(m.period_total) AS cpu \
+        FROM bench_cost c \
+        JOIN title_report t ON t.print_issn = c.issn \
+        JOIN metric m ON m.title_report_id = t.id \
+        WHERE m.metric_type = %s AND m.period BETWEEN %s AND %s \
+        GROUP BY c.issn, c.cost HAVING SUM(m.period_total) > 0 \
+        ORDER BY cpu DESC LIMIT 100",
+        lambda s: [s['requests'], s['begin'], s['end']]),
+    ('cost per use by platform',
+        u"SELECT t.platform_id, SUM(c.cost) / SUM(m.period_total) AS cpu \
+        FROM bench_cost c \
+        JOIN title_report t ON t.print_issn = c.issn \
+        JOIN metric m ON m.title_report_id = t.id \
+        WHERE m.metric_type = %s AND m.period BETWEEN %s AND %s \
+        GROUP BY t.platform_id",
+        lambda s: [s['requests'], s['begin'], s['end']]),
+]
+
+SUBJECTS = ['Applied Chemistry', 'Computer Science', 'Economics', 'Education', 'History',
+    'Linguistics', 'Mathematics', 'Medicine', 'Philosophy', 'Physics', 'Psychology', 'Sociology']
+
+
+def populate(titles, years):
+    """
+    Fills an empty database with made-up titles on the platforms in
+    platform_ref, and monthly usage for the given years. Every fifth
+    journal is also on a second platform, so title clusters span
+    platforms.
+    """
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT COUNT(*) FROM title_report")
+    if cursor.fetchone()[0]:
+        print('title_report is not empty; --synthetic needs an empty scratch database')
+        sys.exit(1)
+    cursor.execute(u"SELECT id FROM platform_ref ORDER BY id")
+    platforms = [row[0] for row in cursor.fetchall()]
+    if not platforms:
+        print('platform_ref is empty; load sql/platform_ref.txt before using --synthetic')
+        sys.exit(1)
+
+    rng = random.Random(1)
+    columns = ['title', 'title_type', 'publisher', 'platform_id', 'isbn', 'print_issn', 'online_issn',
+        'yop', 'title_key']
+    inserter = BatchInserter(CounterDb.backend, CounterDb.conn, 'title_report', columns)
+    for i in range(titles):
+        publisher = 'Publisher {0}'.format(rng.randrange(200))
+        platform_id = platforms[rng.randrange(len(platforms))]
+        if i % 3:
+            title = 'Journal of {0} {1}'.format(rng.choice(SUBJECTS), i)
+            print_issn = '{0:04d}-{1:04d}'.format(1000 + i // 10000, i % 10000)
+            online_issn = '{0:04d}-{1:04d}'.format(2000 + i // 10000, i % 10000)
+            rows = [(title, 'J', publisher, platform_id, None, print_issn, online_issn, None)]
+            if i % 5 == 0:
+                other = platforms[(platforms.index(platform_id) + 1) % len(platforms)]
+                rows.append((title, 'J', publisher, other, None, print_issn, None, None))
+        else:
+            title = 'Handbook of {0} {1}'.format(rng.choice(SUBJECTS), i)
+            rows = [(title, 'B', publisher, platform_id, '978{0:010d}'.format(i), None, None,
+                str(2000 + i % 23))]
+        for row in rows:
+            inserter.add(row + (title_key(row[0], row[2], row[4], row[7]),))
+    inserter.close()
+    CounterDb.conn.commit()
+
+    cursor.execute(u"SELECT id, title_type, print_issn, online_issn, isbn FROM title_report ORDER BY id")
+    title_rows = cursor.fetchall()
+    TitleClusterTable().add([(row[0], row[2], row[3], row[4]) for row in title_rows])
+    CounterDb.conn.commit()
+
+    # Usage is heavily skewed: most titles see little use and a few a lot.
+    wide = CounterDb.metric_layout == 'wide'
+    if wide:
+        table = 'metric_wide'
+        columns = ['title_report_id', 'title_type', 'access_type', 'metric_type', 'year', 'months'] + \
+            ['m{0:02d}'.format(i) for i in range(1, 13)]
+    else:
+        table = 'metric'
+        columns = ['title_report_id', 'title_type', 'access_type', 'metric_type', 'period', 'period_total']
+    inserter = BatchInserter(CounterDb.backend, CounterDb.conn, table, columns)
+    count = 0
+    for title_id, title_type, print_issn, online_issn, isbn in title_rows:
+        scale = rng.paretovariate(1.2)
+        access_types = [1, 2] if title_id % 4 == 0 else [1]
+        for year in years:
+            for access_type in access_types:
+                for metric_type in range(1, 5):
+                    totals = [int(rng.expovariate(1 / scale) * (6 - metric_type)) for month in range(12)]
+                    if wide:
+                        inserter.add((title_id, title_type, access_type, metric_type, year, 4095) + tuple(totals))
+                        count += 1
+                        continue
+                    for month, total in enumerate(totals):
+                        inserter.add((title_id, title_type, access_type, metric_type,
+                            '{0}-{1:02d}-01'.format(year, month + 1), total))
+                        count += 1
+    inserter.close()
+    CounterDb.conn.commit()
+    CounterDb.backend.analyze(cursor, ['title_report', table, 'title_cluster'])
+    print('Added {0} titles and {1} {2} rows'.format(len(title_rows), count, table))
+
+
+def load_costs(path):
+    """
+    Creates the bench_cost table, from a CSV file of issn,cost rows or
+    with made-up costs for every print ISSN.
+    """
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"DROP TABLE IF EXISTS bench_cost")
+    cursor.execute(u"CREATE TABLE bench_cost ( \
+        issn VARCHAR(20) NOT NULL, \
+        cost DECIMAL(10,2) NOT NULL, \
+        PRIMARY KEY (issn))")
+    if path:
+        with open(path, newline='') as f:
+            rows = [(row[0], float(row[1])) for row in csv.reader(f) if len(row) >= 2 and row[1][:1].isdigit()]
+        cursor.executemany(u"INSERT INTO bench_cost (issn, cost) VALUES (%s, %s)", rows)
+    else:
+        cursor.execute(u"INSERT INTO bench_cost (issn, cost) \
+            SELECT print_issn, 500 + MOD(MIN(id) * 7919, 4500) FROM title_report \
+            WHERE print_issn IS NOT NULL AND print_issn <> '' GROUP BY print_issn")
+    CounterDb.conn.commit()
+
+
+def sample_values(year):
+    """
+    Picks the values the queries look up: a journal with an ISSN from the
+    middle of title_report, its platform and publisher, and the year.
+    """
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT COUNT(*) FROM title_report WHERE title_type = 'J' AND print_issn <> ''")
+    count = cursor.fetchone()[0]
+    if not count:
+        print('No journals with an ISSN in title_report; load reports or use --synthetic first')
+        sys.exit(1)
+    cursor.execute(u"SELECT id, title, publisher, platform_id, print_issn FROM title_report \
+        WHERE title_type = 'J' AND print_issn <> '' ORDER BY id LIMIT 1 OFFSET %s", (count // 2,))
+    title_id, title, publisher, platform_id, issn = cursor.fetchone()
+    return {'title_id': title_id, 'title_prefix': title[0:12], 'publisher': publisher,
+        'platform_id': platform_id, 'issn': issn, 'title_type': 'J',
+        'requests': CounterDb.METRIC_TYPE.index('Unique_Item_Requests'),
+        'begin': '{0}-01-01'.format(year), 'end': '{0}-12-01'.format(year)}
+
+
+def saved_filters():
+    """
+    Returns the saved filters as (name, sql, params) queries.
+    """
+    engine = FilterEngine()
+    queries = []
+    for row in FilterTable().get_filters():
+        try:
+            sql, values = engine.compile(row.id)
+        except FilterError as e:
+            print('Skipping filter {0}: {1}'.format(row.id, e))
+            continue
+        queries.append(('filter {0}: {1}'.format(row.id, row.name), sql, values))
+    return queries
+
+
+def aliases(sql):
+    """
+    Returns the tables of a query by the alias (or name) the plan may
+    give them.
+    """
+    tables = {}
+    for table, alias in re.findall(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?!ON\b|WHERE\b|JOIN\b)(\w+))?', sql):
+        tables[table] = table
+        if alias:
+            tables[alias] = table
+    return tables
+
+
+def condition_columns(sql, alias):
+    """
+    Returns the columns of alias that the query filters or joins on.
+    """
+    pattern = r'\b{0}\.(\w+)\s*(?:=|<|>|\bBETWEEN\b|\bLIKE\b|\bIN\b)'.format(re.escape(alias))
+    found = []
+    for column in re.findall(pattern, sql, re.IGNORECASE):
+        if column not in found:
+            found.append(column)
+    return found
+
+
+def percentile(times, p):
+    ordered = sorted(times)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def run_query(sql, params, runs):
+    """
+    Returns the latencies in milliseconds of runs executions, after one
+    warm-up, and the number of rows returned.
+    """
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(sql, params)
+    rows = len(cursor.fetchall())
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        times.append((time.perf_counter() - start) * 1000)
+    return times, rows
+
+
+def plan_summary(steps):
+    """
+    Returns the plan on one line, with repeated steps (like the twelve
+    month scans of the wide layout's metric view) counted once.
+    """
+    parts = []
+    for part, group in groupby('{0}:{1}'.format(step.table, 'SCAN({0})'.format(step.rows)
+            if step.index is None else step.index) for step in steps):
+        n = len(list(group))
+        parts.append(part if n == 1 else '{0}x{1}'.format(part, n))
+    return ' '.join(parts)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage='python benchmark-queries.py [--year YYYY] [--runs N] [--plans] [--costs FILE] \
+[--synthetic TITLES] [--save FILE] [--baseline FILE]')
+    parser.add_argument('--year', default='2022', help='year the dated queries look at')
+    parser.add_argument('--runs', type=int, default=10, help='timed runs per query')
+    parser.add_argument('--plans', action='store_true', help='print every step of each plan')
+    parser.add_argument('--costs', help='CSV file of issn,cost rows for the cost-per-use queries')
+    parser.add_argument('--scan-rows', type=int, default=10000,
+        help='report full scans of tables estimated at this many rows or more')
+    parser.add_argument('--synthetic', type=int, metavar='TITLES',
+        help='first fill an empty database with this many made-up titles')
+    parser.add_argument('--save', help='save the latencies to this JSON file')
+    parser.add_argument('--baseline', help='compare with latencies saved earlier')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        populate(args.synthetic, [int(args.year) - 1, int(args.year)])
+    load_costs(args.costs)
+    values = sample_values(args.year)
+    queries = [(name, sql, params(values)) for name, sql, params in QUERIES] + saved_filters()
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    cursor = CounterDb.conn.cursor()
+    results = {}
+    used = {}
+    scans = {}
+    print('{0:<32} {1:>9} {2:>9} {3:>9} {4:>7} {5:>9}  {6}'.format('query', 'p50 ms', 'p95 ms', 'max ms',
+        'rows', 'vs base', 'plan'))
+    for name, sql, params in queries:
+        times, rows = run_query(sql, params, args.runs)
+        steps = CounterDb.backend.explain(cursor, sql, params)
+        tables = aliases(sql)
+        for step in steps:
+            table = tables.get(step.table, step.table)
+            if step.index is not None:
+                used.setdefault((table, step.index), []).append(name)
+            if step.full_scan and step.index is None and step.rows >= args.scan_rows:
+                scans.setdefault(table, []).append((name, condition_columns(sql, step.table)))
+
+        p50 = percentile(times, 50)
+        results[name] = {'p50': p50, 'p95': percentile(times, 95), 'max': max(times), 'rows': rows}
+        change = '{0:>8.2f}x'.format(p50 / baseline[name]['p50']) if name in baseline else ''
+        print('{0:<32} {1:>9.2f} {2:>9.2f} {3:>9.2f} {4:>7} {5:>9}  {6}'.format(name[:32], p50,
+            results[name]['p95'], results[name]['max'], rows, change, plan_summary(steps)))
+        if args.plans:
+            for step in steps:
+                print('{0:>34} {1:<14} {2:<20} rows={3} {4}'.format('', step.table, step.index or '-',
+                    step.rows, step.detail))
+
+    print('\nIndexes of the reporting tables:')
+    print('{0:<18} {1:<26} {2:>10}  {3}'.format('table', 'index', 'size MB', 'used by'))
+    for index in CounterDb.backend.list_indexes(cursor):
+        if index.table not in READ_TABLES:
+            continue
+        users = used.get((index.table, index.name), [])
+        if users:
+            note = ', '.join(users)
+        elif index.unique:
+            note = 'no query (unique, needed by the loader)'
+        elif index.name in LOADER_INDEXES:
+            note = 'no query (needed by {0})'.format(LOADER_INDEXES[index.name])
+        else:
+            note = 'UNUSED by this mix'
+        size = '{0:.1f}'.format(index.size / 1048576.0) if index.size is not None else '-'
+        print('{0:<18} {1:<26} {2:>10}  {3}'.format(index.table, index.name, size, note))
+
+    if CounterDb.backend.name == 'mysql':
+        print('\nFull scans of large tables (candidates for a missing index):')
+        if not scans:
+            print('  none')
+        for table, found in sorted(scans.items()):
+            for name, columns in found:
+                print('  {0}: {1}, filtered or joined on {2}'.format(table, name, ', '.join(columns) or '-'))
+    else:
+        print('\n{0} scans tables sequentially by design; no missing index report.'.format(CounterDb.backend.name))
+
+    cursor.execute(u"DROP TABLE bench_cost")
+    CounterDb.conn.commit()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
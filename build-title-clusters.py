@@ -0,0 +1,42 @@
+import sys
+
+from dataloader.counter_db import CounterDb, TitleClusterTable
+
+
+# Places the title_report rows that are not in a cluster yet in their
+# cross-platform title clusters. The loader clusters new titles as they are
+# inserted, so this is only needed once after sql/add-title-clusters.sql.
+#
+# Titles are read in id order, one batch at a time, and each batch is
+# committed, so the script can be stopped and re-run.
+
+BATCH_SIZE = 5000
+
+
+def build_clusters(conn):
+    sql = u"SELECT t.id, t.print_issn, t.online_issn, t.isbn FROM title_report t \
+        LEFT JOIN title_cluster c ON c.title_report_id = t.id \
+        WHERE c.title_report_id IS NULL AND t.id > %s ORDER BY t.id LIMIT %s"
+    clusters = TitleClusterTable()
+    cursor = conn.cursor()
+    last_id = 0
+    total = 0
+    while True:
+        cursor.execute(sql, (last_id, BATCH_SIZE))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        clusters.add(rows)
+        conn.commit()
+        last_id = rows[-1][0]
+        total += len(rows)
+        print(' clustered {0} titles'.format(total))
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        print('Usage: python build-title-clusters.py')
+    else:
+        print('Building title clusters')
+        build_clusters(CounterDb.conn)
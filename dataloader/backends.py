@@ -0,0 +1,605 @@
+import csv
+import json
+import os
+import re
+from collections import namedtuple
+
+
+# Storage backends for the COUNTER database.
+#
+# CounterDb talks to the database through a backend, which supplies the
+# connection and the few statements whose syntax differs between engines:
+# upserts, truncation and bulk loading of the temp text files. Everything
+# else is written in SQL that MySQL and DuckDB both accept, with %s
+# placeholders.
+#
+# The backend is chosen in dataloader.config:
+#
+#   backend = 'mysql'             # default, uses dbargs
+#   backend = 'duckdb'
+#   duckdb_path = 'counter5.duckdb'
+#
+# The MySQL backend bulk loads with mysqlimport, which needs the client
+# binary on the loader host and FILE privileges on the server. Where
+# neither is available, set
+#
+#   bulk_mode = 'client'
+#
+# to send the same files as batched multi-row INSERTs instead (BatchInserter).
+#
+# A DuckDB database is created from sql/counter-r5-duckdb.sql. It needs no
+# server, so it suits local analysis of a year of reports, and tests and
+# benchmarks on machines without MySQL.
+
+# One table access in a query plan, see explain(). table is the name or
+# alias the plan gives, index the index used, if any, and rows the
+# planner's estimate of the rows read.
+PlanStep = namedtuple('PlanStep', ['table', 'index', 'full_scan', 'rows', 'detail'])
+
+# A secondary or unique index, see list_indexes(). size is in bytes, or
+# None where the engine does not report it.
+IndexInfo = namedtuple('IndexInfo', ['table', 'name', 'columns', 'unique', 'size'])
+
+
+class MySqlBackend:
+    """
+    The production backend: a MySQL server reached with mysql.connector.
+    Temp tables are bulk loaded with the mysqlimport client.
+    """
+    name = 'mysql'
+    # Appended to a SELECT to lock the rows it returns while other sessions
+    # skip them instead of waiting (MySQL 8.0 or later).
+    skip_locked = ' FOR UPDATE SKIP LOCKED'
+
+    def __init__(self, dbargs, bulk_mode='mysqlimport'):
+        assert bulk_mode in ['mysqlimport', 'client']
+        self._dbargs = dbargs
+        self._bulk_mode = bulk_mode
+
+    def connect(self):
+        import mysql.connector
+        return mysql.connector.connect(**self._dbargs, buffered=True)
+
+    def upsert_sql(self, table, columns, keys, updates=(), select=None):
+        """
+        Returns an INSERT statement that overwrites the updates columns of
+        a row whose unique key (keys) already exists, or leaves the row
+        alone when updates is empty. Values come from %s placeholders, or
+        from the given SELECT statement.
+
+        An update may also be a (column, expression) pair; use excluded()
+        in the expression for the value the INSERT would have written.
+        """
+        sql = u"INSERT INTO {0} ({1}) ".format(table, ', '.join(columns))
+        if select is None:
+            sql += u"VALUES ({0})".format(', '.join(['%s'] * len(columns)))
+        else:
+            sql += select
+        if updates:
+            sql += u" ON DUPLICATE KEY UPDATE {0}".format(', '.join(_assignments(self, updates)))
+        else:
+            sql += u" ON DUPLICATE KEY UPDATE {0} = {1}.{0}".format(keys[0], table)
+        return sql
+
+    def excluded(self, column):
+        """
+        Returns the expression for the value of column that an upsert
+        would have inserted, for use in the updates of upsert_sql.
+        """
+        return u"VALUES({0})".format(column)
+
+    def last_rows(self, keys, order='id'):
+        """
+        Returns the clause that keeps, of the rows a SELECT feeding an
+        upsert returns for the same keys, only the last one by order. It
+        goes after the WHERE clause of the SELECT.
+        """
+        # ON DUPLICATE KEY UPDATE applies the rows one after the other, so
+        # the last row with a key already wins when the rows come in order.
+        return u""
+
+    def upsert_id(self, cursor, table, columns, values, keys):
+        """
+        Inserts a row unless its unique key already exists and returns the
+        id of the new or existing row in a single statement.
+        """
+        sql = u"INSERT INTO {0} ({1}) VALUES ({2}) \
+            ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)".format(
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        cursor.execute(sql, values)
+        return cursor.lastrowid
+
+    def ping(self, conn):
+        """
+        Checks that the connection is alive, reconnecting if the server
+        closed it, e.g. after wait_timeout in a long-running process.
+        """
+        conn.ping(reconnect=True, attempts=3, delay=5)
+
+    def truncate(self, cursor, table):
+        cursor.execute('TRUNCATE TABLE {0}'.format(table))
+
+    def update_join_sql(self, table, source, condition, assignments):
+        """
+        Returns an UPDATE of table joined to source (a table or an aliased
+        subquery) on condition, setting each (column, expression) pair of
+        assignments.
+        """
+        return u"UPDATE {0} JOIN {1} ON {2} SET {3}".format(table, source, condition,
+            ', '.join(u"{0}.{1} = {2}".format(table, *a) for a in assignments))
+
+    def create_id_map(self, cursor):
+        """
+        Creates the id_map table of stage_id_map, or empties it. It is a
+        temporary table, so each connection has its own.
+        """
+        cursor.execute(u"CREATE TEMPORARY TABLE IF NOT EXISTS id_map \
+            (id BIGINT NOT NULL PRIMARY KEY, new_id BIGINT NOT NULL)")
+        cursor.execute(u"DELETE FROM id_map")
+
+    def is_retryable(self, error):
+        """
+        Checks whether a failed transaction can simply be run again: it was
+        rolled back as a deadlock victim or timed out waiting for a lock.
+        """
+        return getattr(error, 'errno', None) in (1213, 1205)
+
+    def acquire_lock(self, cursor, name, timeout):
+        """
+        Takes a server-wide named lock for this connection, waiting up to
+        timeout seconds. Returns True if the lock was obtained.
+        """
+        cursor.execute(u"SELECT GET_LOCK(%s, %s)", (name, timeout))
+        return cursor.fetchone()[0] == 1
+
+    def release_lock(self, cursor, name):
+        cursor.execute(u"SELECT RELEASE_LOCK(%s)", (name,))
+        cursor.fetchone()
+
+    def max_packet(self, cursor):
+        cursor.execute(u"SELECT @@max_allowed_packet")
+        return int(cursor.fetchone()[0])
+
+    def explain(self, cursor, sql, params=()):
+        """
+        Returns the plan of a query as a list of PlanSteps, one per table
+        access. A step reads the whole table (or a whole index) when its
+        access type is ALL (or index).
+        """
+        cursor.execute(u"EXPLAIN " + sql, params)
+        columns = [d[0].lower() for d in cursor.description]
+        steps = []
+        for row in cursor.fetchall():
+            row = dict(zip(columns, row))
+            if row['table'] is None:
+                continue
+            steps.append(PlanStep(row['table'], row['key'], row['type'] in ('ALL', 'index'),
+                int(row['rows'] or 0), ' '.join(str(v) for v in (row['type'], row['extra']) if v)))
+        return steps
+
+    def analyze(self, cursor, tables):
+        """
+        Refreshes the planner statistics of the tables, e.g. after a bulk
+        insert.
+        """
+        cursor.execute(u"ANALYZE TABLE {0}".format(', '.join(tables)))
+        cursor.fetchall()
+
+    def list_indexes(self, cursor):
+        """
+        Returns the indexes of the current database as IndexInfos, less
+        the primary keys. Sizes come from mysql.innodb_index_stats, when
+        the user may read it.
+        """
+        sql = u"SELECT s.table_name, s.index_name, \
+            GROUP_CONCAT(s.column_name ORDER BY s.seq_in_index), MIN(s.non_unique) = 0, {0} \
+            FROM information_schema.statistics s {1} \
+            WHERE s.table_schema = DATABASE() AND s.index_name <> 'PRIMARY' \
+            GROUP BY s.table_name, s.index_name ORDER BY s.table_name, s.index_name"
+        try:
+            cursor.execute(sql.format(u"MAX(i.stat_value) * @@innodb_page_size",
+                u"LEFT JOIN mysql.innodb_index_stats i ON i.database_name = s.table_schema \
+                AND i.table_name = s.table_name AND i.index_name = s.index_name AND i.stat_name = 'size'"))
+        except Exception:
+            cursor.execute(sql.format(u"NULL", u""))
+        return [IndexInfo(table, name, columns.split(','), bool(unique), int(size) if size else None)
+            for table, name, columns, unique, size in cursor.fetchall()]
+
+    def bulk_load(self, conn, reportdir, tables):
+        """
+        Loads each table from the text file of the same name in reportdir
+        with mysqlimport, or with batched INSERTs in client bulk mode.
+        Raises OSError if the import fails.
+        """
+        if self._bulk_mode == 'client':
+            for table in tables:
+                load_text_file(self, conn, reportdir, table)
+            conn.commit()
+            return
+
+        user = self._dbargs['user']
+        passwd = self._dbargs['password']
+        database = self._dbargs['database']
+        paths = ' '.join('{0}/{1}'.format(reportdir, table) for table in tables)
+        cmd = 'mysqlimport --user={0} --password={1} --delete {2} {3} \
+             > mysqlimport_out.txt'.format(user, passwd, database, paths)
+        print(cmd)
+        if os.system(cmd) != 0:
+            raise OSError # Consider using a custom exception class for this purpose.
+        os.remove('mysqlimport_out.txt')
+
+
+class DuckDbBackend:
+    """
+    Embedded columnar backend using DuckDB. Requires the optional duckdb
+    package and a database created from sql/counter-r5-duckdb.sql.
+    """
+    name = 'duckdb'
+    # An embedded database has a single writer process, so there is nothing
+    # to coordinate between nodes.
+    skip_locked = ''
+
+    def __init__(self, path):
+        self._path = path
+
+    def connect(self):
+        try:
+            import duckdb
+        except ImportError:
+            raise ImportError('The duckdb backend requires the duckdb package')
+        return DuckDbConnection(duckdb.connect(self._path))
+
+    def upsert_sql(self, table, columns, keys, updates=(), select=None):
+        sql = u"INSERT INTO {0} ({1}) ".format(table, ', '.join(columns))
+        if select is None:
+            sql += u"VALUES ({0})".format(', '.join(['%s'] * len(columns)))
+        else:
+            sql += select
+        sql += u" ON CONFLICT ({0})".format(', '.join(keys))
+        if updates:
+            sql += u" DO UPDATE SET {0}".format(', '.join(_assignments(self, updates)))
+        else:
+            sql += u" DO NOTHING"
+        return sql
+
+    def excluded(self, column):
+        return u"excluded.{0}".format(column)
+
+    def last_rows(self, keys, order='id'):
+        # ON CONFLICT DO UPDATE cannot update a row twice in one statement,
+        # so rows with the same keys are reduced to the last one first.
+        return u" QUALIFY row_number() OVER (PARTITION BY {0} ORDER BY {1} DESC) = 1".format(
+            ', '.join(keys), order)
+
+    def upsert_id(self, cursor, table, columns, values, keys):
+        # DuckDB has no LAST_INSERT_ID, so look the key up first and only
+        # insert when it is missing.
+        key_values = [values[columns.index(k)] for k in keys]
+        sql = u"SELECT id FROM {0} WHERE {1}".format(table,
+            ' AND '.join('{0} = %s'.format(k) for k in keys))
+        cursor.execute(sql, key_values)
+        row = cursor.fetchone()
+        if row is not None:
+            return row[0]
+        sql = u"INSERT INTO {0} ({1}) VALUES ({2}) RETURNING id".format(
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        cursor.execute(sql, values)
+        return cursor.fetchone()[0]
+
+    def ping(self, conn):
+        pass
+
+    def truncate(self, cursor, table):
+        cursor.execute('DELETE FROM {0}'.format(table))
+
+    def update_join_sql(self, table, source, condition, assignments):
+        return u"UPDATE {0} SET {3} FROM {1} WHERE {2}".format(table, source, condition,
+            ', '.join(u"{0} = {1}".format(*a) for a in assignments))
+
+    def create_id_map(self, cursor):
+        cursor.execute(u"CREATE TEMP TABLE IF NOT EXISTS id_map \
+            (id BIGINT NOT NULL PRIMARY KEY, new_id BIGINT NOT NULL)")
+        cursor.execute(u"DELETE FROM id_map")
+
+    def is_retryable(self, error):
+        # Concurrent writers to the same rows conflict instead of waiting.
+        import duckdb
+        return isinstance(error, duckdb.TransactionException)
+
+    def acquire_lock(self, cursor, name, timeout):
+        return True
+
+    def release_lock(self, cursor, name):
+        pass
+
+    def max_packet(self, cursor):
+        # No protocol limit for an embedded database; this only bounds the
+        # size of a BatchInserter batch.
+        return 16 * 1024 * 1024
+
+    def explain(self, cursor, sql, params=()):
+        # The JSON plan is a tree of operators; table scans name their
+        # table and whether they read it sequentially or through an index.
+        cursor.execute(u"EXPLAIN (FORMAT json) " + sql, params)
+        nodes = json.loads(cursor.fetchone()[1])
+        steps = []
+        while nodes:
+            node = nodes.pop(0)
+            nodes.extend(node.get('children', []))
+            info = node.get('extra_info', {})
+            if 'Table' not in info:
+                continue
+            kind = info.get('Type', node['name'])
+            full_scan = kind == 'Sequential Scan'
+            rows = re.sub(r'\D', '', str(info.get('Estimated Cardinality', '')))
+            steps.append(PlanStep(info['Table'].split('.')[-1], None if full_scan else kind, full_scan,
+                int(rows or 0), kind))
+        return steps
+
+    def analyze(self, cursor, tables):
+        cursor.execute(u"ANALYZE")
+
+    def list_indexes(self, cursor):
+        # Only indexes made with CREATE INDEX are listed; DuckDB does not
+        # expose those behind PRIMARY KEY and UNIQUE constraints.
+        cursor.execute(u"SELECT table_name, index_name, expressions, is_unique FROM duckdb_indexes() \
+            ORDER BY table_name, index_name")
+        return [IndexInfo(table, name, [c.strip() for c in columns.strip('[]').split(',')], unique, None)
+            for table, name, columns, unique in cursor.fetchall()]
+
+    def bulk_load(self, conn, reportdir, tables):
+        """
+        Loads each table from the text file of the same name in reportdir
+        with DuckDB's CSV reader. The files have the same layout as for
+        mysqlimport; a leading id column is left to the table's sequence.
+        """
+        cursor = conn.cursor()
+        for table in tables:
+            cursor.execute(u"SELECT column_name FROM information_schema.columns \
+                WHERE table_name = %s ORDER BY ordinal_position", (table,))
+            columns = [row[0] for row in cursor.fetchall()]
+            names = ['c{0}'.format(i) for i in range(len(columns))]
+            offset = 1 if columns[0] == 'id' else 0
+            path = os.path.join(reportdir, table).replace("'", "''")
+            sql = u"INSERT INTO {0} ({1}) SELECT {2} FROM read_csv('{3}', delim='\t', \
+                header=false, quote='\"', escape='\"', columns={{{4}}})".format(
+                table, ', '.join(columns[offset:]), ', '.join(names[offset:]), path,
+                ', '.join("'{0}': 'VARCHAR'".format(n) for n in names))
+            cursor.execute(sql)
+
+
+def _assignments(backend, updates):
+    return [u"{0} = {1}".format(*c) if isinstance(c, tuple)
+        else u"{0} = {1}".format(c, backend.excluded(c)) for c in updates]
+
+
+def upsert_ids(backend, cursor, table, columns, rows, keys, batch=1000):
+    """
+    Inserts the rows whose unique key (keys) does not exist yet and returns
+    the ids of the new or existing rows, in the order of rows, with one
+    multi-row INSERT and one SELECT per batch instead of an upsert_id per
+    row. The rows must not repeat a key.
+    """
+    ids = []
+    key_index = [columns.index(k) for k in keys]
+    for i in range(0, len(rows), batch):
+        chunk = rows[i:i + batch]
+        # upsert_sql takes any row source in place of a SELECT.
+        values = u"VALUES {0}".format(', '.join(
+            ['({0})'.format(', '.join(['%s'] * len(columns)))] * len(chunk)))
+        cursor.execute(backend.upsert_sql(table, columns, keys, select=values),
+            [v for row in chunk for v in row])
+
+        row_keys = [tuple(row[k] for k in key_index) for row in chunk]
+        sql = u"SELECT id, {0} FROM {1} WHERE ({0}) IN ({2})".format(', '.join(keys), table,
+            ', '.join(['({0})'.format(', '.join(['%s'] * len(keys)))] * len(chunk)))
+        cursor.execute(sql, [v for key in row_keys for v in key])
+        found = {tuple(row[1:]): row[0] for row in cursor.fetchall()}
+        ids.extend(found[key] for key in row_keys)
+    return ids
+
+
+def stage_id_map(backend, cursor, pairs, batch=1000):
+    """
+    Fills the connection's id_map table with (id, new_id) pairs, with one
+    multi-row INSERT per batch, so that a single UPDATE joined to id_map
+    (see update_join_sql) applies them instead of an UPDATE per row.
+    """
+    backend.create_id_map(cursor)
+    for i in range(0, len(pairs), batch):
+        chunk = pairs[i:i + batch]
+        cursor.execute(u"INSERT INTO id_map (id, new_id) VALUES {0}".format(
+            ', '.join(['(%s, %s)'] * len(chunk))), [v for pair in chunk for v in pair])
+
+
+def table_columns(conn, table):
+    """
+    Returns the column names of the table in order.
+    """
+    cursor = conn.cursor()
+    cursor.execute(u"SELECT column_name FROM information_schema.columns \
+        WHERE table_name = %s AND table_schema = DATABASE() ORDER BY ordinal_position", (table,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def load_text_file(backend, conn, reportdir, table):
+    """
+    Loads a table from the tab delimited text file of the same name in
+    reportdir with a BatchInserter, the client-side equivalent of
+    mysqlimport. As with mysqlimport, a leading id column of 'null' is left
+    to AUTO_INCREMENT.
+    """
+    columns = table_columns(conn, table)
+    offset = 1 if columns[0] == 'id' else 0
+    inserter = BatchInserter(backend, conn, table, columns[offset:])
+    try:
+        with open(os.path.join(reportdir, table), newline='', encoding='utf-8') as f:
+            for row in csv.reader(f, dialect='excel-tab'):
+                inserter.add(row[offset:])
+        inserter.close()
+    except (IOError, csv.Error) as e:
+        raise OSError('Could not load {0}: {1}'.format(table, e))
+
+
+class BatchInserter:
+    """
+    Inserts rows into a table with multi-row INSERT statements, prepared
+    once on the server and executed for each batch.
+
+    A batch is sent once it holds MAX_ROWS rows (fewer for wide tables,
+    as a prepared statement may have no more than 65535 placeholders), or
+    early, as a plain statement, when the next row would take the bytes
+    of its values past PACKET_SHARE of max_allowed_packet. Rows much
+    longer than those before them therefore never overflow the packet.
+    Call add() for each row and close() at the end; the caller commits.
+    """
+    MAX_PLACEHOLDERS = 65535
+    MAX_ROWS = 5000
+    # Share of max_allowed_packet a batch may use, leaving room for the
+    # protocol overhead of each value.
+    PACKET_SHARE = 0.5
+    VALUE_OVERHEAD = 8
+
+    def __init__(self, backend, conn, table, columns):
+        self._conn = conn
+        self._table = table
+        self._columns = columns
+        self._max_bytes = backend.max_packet(conn.cursor()) * self.PACKET_SHARE
+        # Prepared statements are only worth it for the full-size batch,
+        # which is executed over and over; batches sent early and the last
+        # partial batch are sent as plain statements.
+        self._cursor = conn.cursor(prepared=True, buffered=False)
+        self._batch_rows = max(1, min(self.MAX_ROWS, self.MAX_PLACEHOLDERS // len(columns)))
+        self._batch_sql = self._sql(self._batch_rows)
+        self._rows = []
+        self._bytes = 0
+
+    def _sql(self, n):
+        row = '({0})'.format(', '.join(['%s'] * len(self._columns)))
+        return u"INSERT INTO {0} ({1}) VALUES {2}".format(self._table,
+            ', '.join(self._columns), ', '.join([row] * n))
+
+    def _row_bytes(self, row):
+        return sum((len(v.encode('utf-8')) if isinstance(v, str) else len(str(v))) + self.VALUE_OVERHEAD
+            for v in row)
+
+    def _execute(self, cursor, sql, rows):
+        cursor.execute(sql, [v for row in rows for v in row])
+
+    def _flush(self):
+        self._execute(self._conn.cursor(), self._sql(len(self._rows)), self._rows)
+        self._rows = []
+        self._bytes = 0
+
+    def add(self, row):
+        size = self._row_bytes(row)
+        if self._rows and self._bytes + size > self._max_bytes:
+            self._flush()
+        self._rows.append(row)
+        self._bytes += size
+        if len(self._rows) >= self._batch_rows:
+            self._execute(self._cursor, self._batch_sql, self._rows)
+            self._rows = []
+            self._bytes = 0
+
+    def close(self):
+        if self._rows:
+            self._flush()
+        self._cursor.close()
+
+
+class DuckDbConnection:
+    """
+    Wraps a DuckDB connection in the subset of the mysql.connector
+    connection API used by the table classes. DuckDB runs in autocommit
+    mode here, so commit and rollback have nothing to do.
+    """
+
+    def __init__(self, con):
+        self._con = con
+
+    def cursor(self, named_tuple=False, **kwargs):
+        return DuckDbCursor(self._con.cursor(), named_tuple)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self._con.close()
+
+
+class DuckDbCursor:
+    """
+    Cursor adapter translating %s placeholders to DuckDB's ? and returning
+    named tuples when asked to, like mysql.connector cursors.
+    """
+    PLACEHOLDER = re.compile(r'%s')
+
+    def __init__(self, cur, named_tuple):
+        self._cur = cur
+        self._named_tuple = named_tuple
+        self._row_type = None
+        self._rowcount = -1
+
+    def _translate(self, sql):
+        return self.PLACEHOLDER.sub('?', sql)
+
+    def execute(self, sql, params=None):
+        self._cur.execute(self._translate(sql), params or [])
+        self._row_type = None
+        self._rowcount = None
+        if self._named_tuple and self._cur.description:
+            self._row_type = namedtuple('Row', [d[0] for d in self._cur.description])
+
+    def executemany(self, sql, seq_params):
+        seq_params = list(seq_params)
+        if seq_params:
+            self._cur.executemany(self._translate(sql), seq_params)
+
+    def _wrap(self, row):
+        if row is None or self._row_type is None:
+            return row
+        return self._row_type._make(row)
+
+    def fetchone(self):
+        return self._wrap(self._cur.fetchone())
+
+    def fetchmany(self, size=1):
+        return [self._wrap(row) for row in self._cur.fetchmany(size)]
+
+    def fetchall(self):
+        return [self._wrap(row) for row in self._cur.fetchall()]
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    @property
+    def rowcount(self):
+        # DuckDB returns the number of rows an INSERT, UPDATE or DELETE
+        # changed as the statement's result, a single Count column.
+        if self._rowcount is None:
+            description = self._cur.description
+            row = None
+            if description and len(description) == 1 and description[0][0] == 'Count':
+                row = self._cur.fetchone()
+            self._rowcount = row[0] if row else -1
+        return self._rowcount
+
+    def close(self):
+        self._cur.close()
+
+
+def get_backend(config):
+    """
+    Returns the backend selected by the given config module.
+    """
+    name = getattr(config, 'backend', 'mysql')
+    if name == 'mysql':
+        return MySqlBackend(config.dbargs, getattr(config, 'bulk_mode', 'mysqlimport'))
+    if name == 'duckdb':
+        return DuckDbBackend(getattr(config, 'duckdb_path', 'counter5.duckdb'))
+    raise ValueError('Unknown database backend: {0}'.format(name))
@@ -0,0 +1,43 @@
+class UnionFind:
+    """
+    Disjoint sets over arbitrary hashable items, with path compression and
+    union by size. Used to group titles that share an identifier.
+    """
+
+    def __init__(self):
+        self._parent = {}
+        self._size = {}
+
+    def add(self, item):
+        if item not in self._parent:
+            self._parent[item] = item
+            self._size[item] = 1
+
+    def find(self, item):
+        self.add(item)
+        root = item
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[item] != root:
+            self._parent[item], item = root, self._parent[item]
+        return root
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return a
+        if self._size[a] < self._size[b]:
+            a, b = b, a
+        self._parent[b] = a
+        self._size[a] += self._size[b]
+        return a
+
+    def groups(self):
+        """
+        Returns a dict mapping each set's root to the list of its items.
+        """
+        groups = {}
+        for item in self._parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return groups
@@ -1,10 +1,17 @@
 from collections import namedtuple
-import mysql.connector
 import dataloader.config
-import html
+import csv
+import json
 import subprocess, os, sys
+import threading
 import datetime
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from dataloader.backends import BatchInserter, get_backend, stage_id_map, upsert_ids
+from dataloader.clusters import UnionFind
+from dataloader.normalize import identifier_keys, normalize_publisher, normalize_title, title_key
+from dataloader.platforms import PlatformResolver
+from dataloader.records import WideMetricRecord, widen
 
 
 class CounterDb:
@@ -12,6 +19,12 @@ class CounterDb:
     The parent class for the COUNTER database. It provides a common
     connection object for table classes. This class is never instantiated
     on its own.
+
+    The connection comes from the storage backend configured in
+    dataloader.config (MySQL by default, see dataloader.backends).
+    metric_layout selects how usage is stored, see MetricTable, and
+    merge_connections how many connections merge the temp tables, see
+    dataloader.merge.
     """
     ACCESS_TYPE = ['', 'Controlled', 'OA_Gold', 'Other_Free_To_Read']
     METRIC_TYPE = ['', 'Total_Item_Investigations', 'Total_Item_Requests',
@@ -22,7 +35,29 @@ class CounterDb:
     PERIODS = ['', 'jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug',
         'sep', 'oct', 'nov', 'dec']
 
-    conn = mysql.connector.connect(**dataloader.config.dbargs, buffered=True)
+    backend = get_backend(dataloader.config)
+    conn = backend.connect()
+    metric_layout = getattr(dataloader.config, 'metric_layout', 'long')
+    merge_connections = getattr(dataloader.config, 'merge_connections', 1)
+
+    @classmethod
+    def use(cls, backend, metric_layout=None):
+        """
+        Switches all table classes to another backend, e.g. an embedded
+        DuckDB database for tests or local analysis, and optionally to
+        another metric layout.
+        """
+        CounterDb.backend = backend
+        CounterDb.conn = backend.connect()
+        if metric_layout is not None:
+            CounterDb.metric_layout = metric_layout
+
+    @classmethod
+    def metric_temp_table(cls):
+        """
+        Returns the temp table metrics are staged in for the metric layout.
+        """
+        return 'metric_wide_temp' if CounterDb.metric_layout == 'wide' else 'metric_temp'
 
 class BulkImport(CounterDb):
     """
@@ -32,48 +67,157 @@ class BulkImport(CounterDb):
         self._reportdir = reportdir
 
     def import_all(self):
+        self.import_tables(['title_report_temp', self.metric_temp_table()])
+
+    def import_tables(self, tables):
+        """
+        Truncates the given temp tables and loads each of them from the text
+        file of the same name in the report directory.
+        """
         # Truncate database temp tables first.
         cursor = CounterDb.conn.cursor()
-        cursor.execute('TRUNCATE TABLE title_report_temp')
-        cursor.execute('TRUNCATE TABLE metric_temp')
+        for table in tables:
+            CounterDb.backend.truncate(cursor, table)
 
-        # Build the mysqlimport command line and then execute.
-        user = dataloader.config.dbargs['user']
-        passwd = dataloader.config.dbargs['password']
-        database = dataloader.config.dbargs['database']
-        cmd = 'mysqlimport --user={0} --password={1} --delete {2} {3}/title_report_temp \
-             {3}/metric_temp > mysqlimport_out.txt'.format(user, passwd, database, self._reportdir)
-        print(cmd)
+        # Bulk load the text files, with mysqlimport for the MySQL backend
+        # unless it is configured for client-side batches.
         try:
-            if os.system(cmd) != 0:
-                raise OSError # Consider using a custom exception class for this purpose.
-            os.remove('mysqlimport_out.txt')
-            
-            # The following code uses the subprocess module to run the same command
-            # but with more options to control execution. The above approach though is
-            # wholly acceptable and is simpler.
-
-            #sp = subprocess.run(args=[
-            #    "mysqlimport",
-            #    "--delete",
-            #    "counter5",
-            #    "reports/title_report_temp",
-            #    "reports/metric_temp"],
-            #    stdout=subprocess.DEVNULL,
-            #    shell=True,
-            #    check=True)
-            #sp.check_returncode()
-
+            CounterDb.backend.bulk_load(CounterDb.conn, self._reportdir, tables)
         except OSError:
             print('There was a problem importing records')
 
+    def is_staged(self, excel_name):
+        """
+        Checks whether the temp tables currently hold the rows of the given
+        report, e.g. when resuming a load that stopped after the import.
+        """
+        sql = u"SELECT COUNT(*) FROM title_report_temp WHERE excel_name = %s"
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(sql, (excel_name,))
+        row = cursor.fetchone()
+
+        return row[0] > 0
+
+    def discard(self, excel_names):
+        """
+        Deletes the staged rows of the given reports from the temp tables,
+        e.g. the partial rows of a report that failed while being exported
+        with others.
+        """
+        if not excel_names:
+            return
+        in_names = ', '.join(['%s'] * len(excel_names))
+        cursor = CounterDb.conn.cursor()
+        for table in ['title_report_temp', self.metric_temp_table()]:
+            cursor.execute(u"DELETE FROM {0} WHERE excel_name IN ({1})".format(table, in_names),
+                list(excel_names))
+        CounterDb.conn.commit()
+
+class StagingLock(CounterDb):
+    """
+    Serializes use of the shared temp tables between loader processes.
+
+    The temp tables are truncated, bulk loaded and merged for one report at
+    a time, so nodes loading in parallel must take turns from staging to
+    merge. Parsing, the slow part, happens outside the lock. Use as:
+
+        with StagingLock():
+            ...
+    """
+    NAME = 'counter5.staging'
+
+    def __init__(self, timeout=3600):
+        self._timeout = timeout
+
+    def __enter__(self):
+        cursor = CounterDb.conn.cursor()
+        if not CounterDb.backend.acquire_lock(cursor, self.NAME, self._timeout):
+            raise TimeoutError('Timed out waiting for the staging lock')
+        return self
+
+    def __exit__(self, *exc):
+        cursor = CounterDb.conn.cursor()
+        CounterDb.backend.release_lock(cursor, self.NAME)
+        return False
+
+class TempTableSink(CounterDb):
+    """
+    Record sink that writes report records straight into the title_report_temp
+    and metric temp tables, without intermediate text files or mysqlimport.
+
+    Use it with report.export(TempTableSink()) in place of export() followed
+    by BulkImport.import_all(). Rows are sent in prepared multi-row INSERT
+    batches sized to the server's max_allowed_packet (see BatchInserter).
+    """
+    TITLE_COLUMNS = ['title', 'title_type', 'publisher', 'publisher_id', 'platform',
+        'doi', 'proprietary_id', 'isbn', 'print_issn', 'online_issn', 'uri', 'yop',
+        'excel_name', 'row_num', 'title_key']
+    METRIC_COLUMNS = ['title_type', 'access_type', 'metric_type', 'period',
+        'period_total', 'excel_name', 'row_num']
+
+    def __init__(self):
+        self._wide = CounterDb.metric_layout == 'wide'
+        metric_table = self.metric_temp_table()
+        cursor = CounterDb.conn.cursor()
+        CounterDb.backend.truncate(cursor, 'title_report_temp')
+        CounterDb.backend.truncate(cursor, metric_table)
+        self._titles = BatchInserter(CounterDb.backend, CounterDb.conn,
+            'title_report_temp', self.TITLE_COLUMNS)
+        self._metrics = BatchInserter(CounterDb.backend, CounterDb.conn, metric_table,
+            list(WideMetricRecord._fields) if self._wide else self.METRIC_COLUMNS)
+
+    def write(self, title, metrics):
+        self._titles.add(tuple(title))
+        if self._wide:
+            metrics = widen(metrics)
+        for metric in metrics:
+            self._metrics.add(tuple(metric))
+
+    def close(self):
+        self._titles.close()
+        self._metrics.close()
+        CounterDb.conn.commit()
+
 class TitleReportTable(CounterDb):
     """
     Represents the title_report table.
+
+    The ids of titles seen by insert_from_temp are cached by (platform_id,
+    title_key) and shared by all instances, so a long-running process does
+    not look up the same titles for every report. Title rows are never
+    changed once inserted, so cached ids stay valid until rows are deleted.
+    unload() bumps the titles counter of data_version when it deletes
+    titles, and every process empties its cache before its next upsert
+    once it sees the counter change (see check_cache).
+
+    load_id holds the report_inventory id of the last report that listed
+    the title, see unload().
     """
+    CACHE_SIZE = 500000
+    UNLOAD_BATCH = 1000
+    _title_ids = {}
+    _cache_version = None
+
     def __init__(self):
         pass
 
+    @classmethod
+    def clear_cache(cls):
+        TitleReportTable._title_ids = {}
+
+    @classmethod
+    def check_cache(cls):
+        """
+        Empties the cache if titles were deleted since it was filled, in
+        this process or another. Called on the main connection before
+        titles are upserted, never from merge workers, which only read the
+        cache.
+        """
+        version = DataVersion().get(DataVersion.TITLES)
+        if version != TitleReportTable._cache_version:
+            TitleReportTable._title_ids = {}
+            TitleReportTable._cache_version = version
+
     def _is_duplicate(self, row):
         """
         This is a check to determine if the title (journal or book) is
@@ -86,6 +230,10 @@ class TitleReportTable(CounterDb):
           - isbn
           - yop
 
+        Title, publisher, isbn and yop are combined into a normalized hash
+        (title_key), so the check is a single equality lookup on the unique
+        idx_title_key index (platform_id, title_key).
+
         Note that there may be instances where a book or journal title
         may appear to be unique but in fact is not. For example, the
         publisher ACM may also appear as Association for Computing Machinery.
@@ -98,14 +246,11 @@ class TitleReportTable(CounterDb):
         containing the id of the duplicate row.
         """
         platform = PlatformTable()
-        params = (row.title, row.publisher, platform.get_platform_id(row.platform),
-            row.isbn, row.yop)
+        params = (platform.get_platform_id(row.platform),
+            title_key(row.title, row.publisher, row.isbn, row.yop))
         sql = u"SELECT id FROM title_report WHERE \
-            title = %s AND \
-            publisher = %s AND \
             platform_id = %s AND \
-            isbn = %s AND \
-            yop = %s"
+            title_key = %s"
         cursor = CounterDb.conn.cursor(named_tuple=True)
         cursor.execute(sql, params)
         row = cursor.fetchone()
@@ -117,16 +262,13 @@ class TitleReportTable(CounterDb):
         Sets the publisher name to Not Defined in select cases. HTML
         entities are also unescaped in the publisher name.
         """
-        if publisher is None or '???' in publisher or publisher == '':
-            return 'Not Defined'
-        else:
-            return html.unescape(html.unescape(publisher))
+        return normalize_publisher(publisher)
     
     def _set_title(self, title):
         """
         Unescapes HTML entities in the title name.
         """
-        return html.unescape(html.unescape(title))
+        return normalize_title(title)
 
     def insert(self, row):
         """
@@ -176,60 +318,345 @@ class TitleReportTable(CounterDb):
 
         return rowid
 
-    def insert_from_temp(self):
+    def insert_from_temp(self, load_id):
         """
-        Inserts rows from title temp table into the title_report table.
+        Inserts rows from title temp table into the title_report table,
+        tagging them with the load id of the report.
         """
-        # For every row in the title_report_temp table, either do an insert
-        # or, if a duplicate row, update the title_report_id reference
-        # in the temp table. Regardless of insert or update, the title_report_id
-        # will need to be updated.
+        self.check_cache()
         cursor = CounterDb.conn.cursor(named_tuple=True)
         cursor.execute('SELECT * FROM title_report_temp')
         rows = cursor.fetchall()
+        cursor = CounterDb.conn.cursor()
+        new_ids, new_titles = self.upsert_rows(cursor, rows, self.platform_ids(rows))
+        self.tag(cursor, load_id)
+
+        # Titles not seen before join their cross-platform cluster in the
+        # same transaction.
+        TitleClusterTable().add(new_titles)
+        CounterDb.conn.commit()
+
+        # Only cache ids once they are committed.
+        self.cache_ids(new_ids)
+
+    def insert_batch_from_temp(self, load_ids):
+        """
+        Inserts the titles of several reports staged together in
+        title_report_temp. load_ids holds a (load_id, excel_name) pair for
+        each report, in load order.
+
+        Each distinct title is upserted once for the whole batch, however
+        many reports list it. Its other staged rows then get the same
+        title_report_id, and every title the load id of the last report
+        listing it, with one joined UPDATE each.
+        """
+        # The database groups the staged rows, sorting or hashing on disk
+        # when they do not fit in memory. The first row staged for a title
+        # stands for it, as the first report would in separate loads.
+        sql = u"SELECT t.* FROM title_report_temp t \
+            JOIN (SELECT MIN(id) AS id FROM title_report_temp GROUP BY platform, title_key) f \
+            ON f.id = t.id ORDER BY t.id"
+        self.check_cache()
+        cursor = CounterDb.conn.cursor(named_tuple=True)
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+        platform_ids = self.platform_ids(rows)
+        cursor = CounterDb.conn.cursor()
+        new_ids, new_titles = self.upsert_rows(cursor, rows, platform_ids)
+
+        # The other staged rows of each title take the id of the row that
+        # stood for it, which upsert_rows left in id_map.
+        first = u"(SELECT t.platform, t.title_key, m.new_id FROM title_report_temp t \
+            JOIN id_map m ON m.id = t.id) f"
+        sql = CounterDb.backend.update_join_sql('title_report_temp', first,
+            u"f.platform = title_report_temp.platform AND f.title_key = title_report_temp.title_key",
+            [('title_report_id', 'f.new_id')])
+        cursor.execute(sql)
+
+        # Each title takes the load id of the last report listing it, all
+        # in one statement.
+        order = u" ".join([u"WHEN %s THEN {0}".format(n) for n in range(len(load_ids))])
+        last = u"(SELECT title_report_id, MAX(CASE excel_name {0} END) AS n \
+            FROM title_report_temp GROUP BY title_report_id) last".format(order)
+        case = u"CASE last.n {0} END".format(u" ".join([u"WHEN {0} THEN %s".format(n)
+            for n in range(len(load_ids))]))
+        sql = CounterDb.backend.update_join_sql('title_report', last, u"last.title_report_id = title_report.id",
+            [('load_id', case)])
+        cursor.execute(sql, [excel_name for load_id, excel_name in load_ids]
+            + [load_id for load_id, excel_name in load_ids])
+
+        TitleClusterTable().add(new_titles)
+        CounterDb.conn.commit()
+        self.cache_ids(new_ids)
+
+    def platform_ids(self, rows):
+        """
+        Returns the platform ids of the platform names in the temp rows.
+        """
+        platform = PlatformTable()
+        return {name: platform.get_platform_id(name) for name in set(row.platform for row in rows)}
+
+    def upsert_rows(self, cursor, rows, platform_ids):
+        """
+        Upserts title_report_temp rows into title_report and sets their
+        title_report_id, using the given cursor. The caller commits. The
+        temp row ids and their title ids are left in the connection's
+        id_map (see dataloader.backends.stage_id_map).
+
+        Returns the ids of the titles that were not cached, keyed by
+        (platform_id, title_key), for cache_ids() once committed, and
+        their (id, print_issn, online_issn, isbn) for TitleClusterTable.
+        The cache is only read, so partitions may be upserted on several
+        threads; the caller runs check_cache() first.
+        """
+        # For every row in the title_report_temp table, either do an insert
+        # or, if a duplicate row, pick up the id of the existing row. The
+        # titles not in the cache are upserted against the unique title key
+        # in batches (see dataloader.backends.upsert_ids). Regardless of
+        # insert or update, the title_report_id will need to be updated in
+        # the temp table.
+        #
+        # Rows are staged already normalized (see normalize_titles), so
+        # they are stored as they are.
+        columns = ['title', 'title_type', 'publisher', 'publisher_id', 'platform_id', 'doi',
+            'proprietary_id', 'isbn', 'print_issn', 'online_issn', 'uri', 'yop', 'title_key']
+        cache = TitleReportTable._title_ids
+        new_rows = {}
         for row in rows:
-            # Check for duplicate.
-            dupe = self._is_duplicate(row)
-            if dupe:
-                rowid = dupe.id
-            else:
-                sql = u"INSERT INTO title_report SET \
-                    id = NULL, \
-                    title = %s, \
-                    title_type = %s, \
-                    publisher = %s, \
-                    publisher_id = %s, \
-                    platform_id = %s, \
-                    doi = %s, \
-                    proprietary_id = %s, \
-                    isbn = %s, \
-                    print_issn = %s, \
-                    online_issn = %s, \
-                    uri = %s, \
-                    yop = %s"
-                platform = PlatformTable()
-                platform_id = platform.get_platform_id(row.platform)
-                publisher = self._set_publisher(row.publisher)
-                title = self._set_title(row.title)
-                params = (title, row.title_type, publisher, row.publisher_id,
-                    platform_id, row.doi, row.proprietary_id, row.isbn, row.print_issn,
-                    row.online_issn, row.uri, row.yop)
-                cursor = CounterDb.conn.cursor()
-                cursor.execute(sql, params)
-                rowid = cursor.lastrowid
-                CounterDb.conn.commit()
-            
-            # Update title_report_id in temp table
-            sql = u"UPDATE title_report_temp SET title_report_id = %s WHERE id = %s"
-            params = (rowid, row.id)
-            cursor = CounterDb.conn.cursor()
-            cursor.execute(sql, params)
+            key = (platform_ids[row.platform], row.title_key)
+            if key not in cache and key not in new_rows:
+                new_rows[key] = row
+
+        params = [(row.title, row.title_type, row.publisher, row.publisher_id,
+            key[0], row.doi, row.proprietary_id, row.isbn, row.print_issn,
+            row.online_issn, row.uri, row.yop, key[1]) for key, row in new_rows.items()]
+        ids = upsert_ids(CounterDb.backend, cursor, 'title_report', columns, params,
+            ['platform_id', 'title_key'])
+        new_ids = dict(zip(new_rows, ids))
+        new_titles = [(rowid, row.print_issn, row.online_issn, row.isbn)
+            for rowid, row in zip(ids, new_rows.values())]
+
+        temp_ids = []
+        for row in rows:
+            key = (platform_ids[row.platform], row.title_key)
+            temp_ids.append((row.id, cache.get(key) or new_ids[key]))
+
+        # Update title_report_id in temp table, joined to the staged ids.
+        stage_id_map(CounterDb.backend, cursor, temp_ids)
+        sql = CounterDb.backend.update_join_sql('title_report_temp', 'id_map',
+            u"id_map.id = title_report_temp.id", [('title_report_id', 'id_map.new_id')])
+        cursor.execute(sql)
+        return new_ids, new_titles
+
+    def tag(self, cursor, load_id):
+        """
+        Sets the load id of every title staged in title_report_temp, once
+        their title_report_id is known. The caller commits.
+        """
+        # Cached titles are never written by upsert_rows, so the tag is
+        # set for all staged titles in one statement.
+        sql = u"UPDATE title_report SET load_id = %s \
+            WHERE id IN (SELECT title_report_id FROM title_report_temp)"
+        cursor.execute(sql, (load_id,))
+
+    @classmethod
+    def cache_ids(cls, new_ids):
+        """
+        Adds committed title ids to the shared cache.
+        """
+        if len(TitleReportTable._title_ids) + len(new_ids) > cls.CACHE_SIZE:
+            TitleReportTable._title_ids = {}
+        TitleReportTable._title_ids.update(new_ids)
+
+    def unload(self, load_id):
+        """
+        Removes the titles tagged with load_id that no longer have usage,
+        after MetricTable.unload(), together with their cluster entry. The
+        titles that keep usage from other reports are tagged with the
+        latest of those. Works through the titles UNLOAD_BATCH at a time
+        and returns the number deleted.
+        """
+        metric_table = 'metric_wide' if CounterDb.metric_layout == 'wide' else 'metric'
+        cursor = CounterDb.conn.cursor()
+        deleted = 0
+        last_id = 0
+        while True:
+            sql = u"SELECT id FROM title_report WHERE load_id = %s AND id > %s ORDER BY id LIMIT %s"
+            cursor.execute(sql, (load_id, last_id, self.UNLOAD_BATCH))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+            last_id = ids[-1]
+            in_ids = ', '.join(['%s'] * len(ids))
+
+            sql = u"SELECT id FROM title_report t WHERE id IN ({0}) \
+                AND NOT EXISTS (SELECT 1 FROM {1} m WHERE m.title_report_id = t.id)".format(in_ids, metric_table)
+            cursor.execute(sql, ids)
+            unused = [row[0] for row in cursor.fetchall()]
+            if unused:
+                in_unused = ', '.join(['%s'] * len(unused))
+                TitleClusterTable().remove(cursor, unused)
+                cursor.execute(u"DELETE FROM title_report WHERE id IN ({0})".format(in_unused), unused)
+                DataVersion().bump(cursor, DataVersion.TITLES)
+                deleted += len(unused)
+
+            sql = u"UPDATE title_report SET load_id = \
+                (SELECT MAX(m.load_id) FROM {0} m WHERE m.title_report_id = title_report.id) \
+                WHERE id IN ({1})".format(metric_table, in_ids)
+            cursor.execute(sql, ids)
             CounterDb.conn.commit()
 
+        # Deleted ids must not be served from the cache.
+        self.check_cache()
+        return deleted
+
+class TitleClusterTable(CounterDb):
+    """
+    Represents the title_cluster and title_cluster_key tables, which group
+    the title_report rows of the same journal or book across platforms and
+    publisher spellings.
+
+    Titles sharing a normalized ISSN or ISBN (see identifier_keys) are in
+    the same cluster, transitively: a print ISSN on one platform and the
+    matching online ISSN plus print ISSN on another link all three rows.
+    Each title row has exactly one cluster, so usage for a title across
+    platforms is a lookup on title_cluster.cluster_id. A cluster's id is
+    the smallest title_report id ever placed in it.
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self):
+        pass
+
+    def _lookup(self, cursor, sql, values):
+        found = {}
+        values = list(values)
+        for i in range(0, len(values), self.BATCH_SIZE):
+            batch = values[i:i + self.BATCH_SIZE]
+            cursor.execute(sql.format(', '.join(['%s'] * len(batch))), batch)
+            found.update(cursor.fetchall())
+        return found
+
+    def add(self, titles):
+        """
+        Places titles, given as (title_report_id, print_issn, online_issn,
+        isbn) tuples, in clusters. Existing clusters that a title links
+        together are merged. The caller commits.
+        """
+        if not titles:
+            return
+        cursor = CounterDb.conn.cursor()
+        title_keys = {t[0]: identifier_keys(*t[1:]) for t in titles}
+        all_keys = {key for keys in title_keys.values() for key in keys}
+        key_clusters = self._lookup(cursor, u"SELECT norm_key, cluster_id FROM title_cluster_key \
+            WHERE norm_key IN ({0})", all_keys)
+        title_clusters = self._lookup(cursor, u"SELECT title_report_id, cluster_id FROM title_cluster \
+            WHERE title_report_id IN ({0})", title_keys)
+
+        # Union the titles, their keys and the clusters they already
+        # belong to; each resulting set becomes one cluster.
+        sets = UnionFind()
+        for title_id, keys in title_keys.items():
+            sets.add(('t', title_id))
+            if title_id in title_clusters:
+                sets.union(('t', title_id), ('c', title_clusters[title_id]))
+            for key in keys:
+                sets.union(('t', title_id), ('k', key))
+                if key in key_clusters:
+                    sets.union(('k', key), ('c', key_clusters[key]))
+
+        cluster_rows = []
+        key_rows = []
+        merged = []
+        for members in sets.groups().values():
+            clusters = [m[1] for m in members if m[0] == 'c']
+            cluster_id = min(clusters + [m[1] for m in members if m[0] == 't'])
+            merged.extend((c, cluster_id) for c in clusters if c != cluster_id)
+            cluster_rows.extend((m[1], cluster_id) for m in members if m[0] == 't')
+            key_rows.extend((m[1], cluster_id) for m in members if m[0] == 'k')
+
+        # Merging relabels every title and key of the absorbed clusters,
+        # with one UPDATE per table joined to the staged old and new ids.
+        if merged:
+            stage_id_map(CounterDb.backend, cursor, merged)
+            for table in ['title_cluster', 'title_cluster_key']:
+                cursor.execute(CounterDb.backend.update_join_sql(table, 'id_map',
+                    u"id_map.id = {0}.cluster_id".format(table), [('cluster_id', 'id_map.new_id')]))
+        sql = CounterDb.backend.upsert_sql('title_cluster', ['title_report_id', 'cluster_id'],
+            ['title_report_id'], ['cluster_id'])
+        cursor.executemany(sql, cluster_rows)
+        if key_rows:
+            sql = CounterDb.backend.upsert_sql('title_cluster_key', ['norm_key', 'cluster_id'],
+                ['norm_key'], ['cluster_id'])
+            cursor.executemany(sql, key_rows)
+
+    def remove(self, cursor, title_ids):
+        """
+        Takes titles that are about to be deleted out of their clusters,
+        together with the keys that no other title of the cluster has. The
+        caller deletes the titles and commits.
+        """
+        in_ids = ', '.join(['%s'] * len(title_ids))
+        cursor.execute(u"SELECT c.cluster_id, t.print_issn, t.online_issn, t.isbn \
+            FROM title_cluster c JOIN title_report t ON t.id = c.title_report_id \
+            WHERE c.title_report_id IN ({0})".format(in_ids), title_ids)
+        removed = {}
+        for cluster_id, print_issn, online_issn, isbn in cursor.fetchall():
+            removed.setdefault(cluster_id, set()).update(identifier_keys(print_issn, online_issn, isbn))
+        cursor.execute(u"DELETE FROM title_cluster WHERE title_report_id IN ({0})".format(in_ids), title_ids)
+        if not removed:
+            return
+
+        # A key stays while another title of its cluster still has it.
+        kept = self._lookup(cursor, u"SELECT c.title_report_id, c.cluster_id FROM title_cluster c \
+            WHERE c.cluster_id IN ({0})", removed)
+        remaining = {}
+        if kept:
+            cursor.execute(u"SELECT id, print_issn, online_issn, isbn FROM title_report WHERE id IN ({0})".format(
+                ', '.join(['%s'] * len(kept))), list(kept))
+            for title_id, print_issn, online_issn, isbn in cursor.fetchall():
+                remaining.setdefault(kept[title_id], set()).update(identifier_keys(print_issn, online_issn, isbn))
+        keys = [key for cluster_id, cluster_keys in removed.items()
+            for key in cluster_keys - remaining.get(cluster_id, set())]
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            batch = keys[i:i + self.BATCH_SIZE]
+            cursor.execute(u"DELETE FROM title_cluster_key WHERE norm_key IN ({0})".format(
+                ', '.join(['%s'] * len(batch))), batch)
+
+    def get_cluster_titles(self, title_report_id):
+        """
+        Returns the ids of all title_report rows in the same cluster as the
+        given title, including itself.
+        """
+        sql = u"SELECT c.title_report_id FROM title_cluster c \
+            JOIN title_cluster t ON t.cluster_id = c.cluster_id \
+            WHERE t.title_report_id = %s"
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(sql, (title_report_id,))
+        return [row[0] for row in cursor.fetchall()]
+
 class MetricTable(CounterDb):
     """
     Represents the metric table.
+
+    With metric_layout = 'wide' in dataloader.config, usage is stored in
+    metric_wide instead: one row per title, access type, metric type and
+    year with a column for each month, and a bit mask (months) of the
+    months that have been loaded. metric is then a view giving the same
+    rows as the long table, so queries do not change. Reports are staged
+    in metric_wide_temp in the same shape. See sql/use-metric-wide.sql.
+
+    Every row is tagged with the load id (report_inventory id) of the
+    report that last wrote it. The values and load id it overwrote are
+    kept in the prev_ columns, so unload() can take a report back out.
+    The history is one load deep: unloading a report whose values were
+    since overwritten by another leaves the newer values alone, but those
+    rows still hold the unloaded values as their previous ones. Unload
+    overlapping reports newest first.
     """
+    MONTH_COLUMNS = ['m{0:02d}'.format(i) for i in range(1, 13)]
+    UNLOAD_BATCH = 1000
+
     def __init__(self):
         pass
 
@@ -299,87 +726,463 @@ class MetricTable(CounterDb):
             cursor.execute(sql, params)
             CounterDb.conn.commit()
 
-    def insert_from_temp(self):
+    def insert_from_temp(self, load_id):
         """
-        Inserts data from the metric temp table in the main metric table.
+        Inserts data from the metric temp table in the main metric table,
+        tagging the rows with the load id of the report.
+        """
+        cursor = CounterDb.conn.cursor()
+        self.set_title_ids(cursor)
+        CounterDb.conn.commit()
+
+        # Next, insert into the main metric table in one statement.
+        cursor.execute(self.merge_sql(), (load_id,))
+        CounterDb.conn.commit()
+
+    def set_title_ids(self, cursor):
+        """
+        Sets title_report_id in the metric temp table from the title temp
+        table, once titles have been merged.
         """
-        # First step is to update the title_report_id in the temp table.
         # Basic algorithm:
         # - for every row in the temp table, update the title_report_id
         # - where the report filename and row number are the same
-        sql = u"UPDATE metric_temp m SET m.title_report_id = \
+        sql = u"UPDATE {0} SET title_report_id = \
             (SELECT t.title_report_id FROM title_report_temp t WHERE \
-            t.excel_name = m.excel_name AND t.row_num = m.row_num)"
+            t.excel_name = {0}.excel_name AND t.row_num = {0}.row_num)".format(self.metric_temp_table())
+        cursor.execute(sql)
+
+    def merge_sql(self, partitioned=False, reports=None):
+        """
+        Returns the upsert merging the metric temp table into the metric
+        table, or into metric_wide for the wide layout. The statement takes
+        the load id to tag the rows with as its first parameter.
+
+        With partitioned set, the statement takes two more parameters, the
+        lowest and highest title_report_id to merge, and merges the rows in
+        key order (see dataloader.merge).
+
+        With reports set, the statement merges the staged rows of that many
+        reports at once (see dataloader.pipeline.load_batch). In place of
+        the load id it takes a (excel_name, load_id) pair per report, then
+        the excel_name of each report again. The reports must not stage
+        rows with the same key.
+        """
+        load_id, where = self._batch_sql(reports)
+        if CounterDb.metric_layout == 'wide':
+            return self._wide_merge_sql(partitioned, load_id, where)
+
+        # Rows already present for the same title, access type, metric type
+        # and period (the idx_dupe_check unique index) get the new total. A
+        # key staged twice, by a title repeated within a report, gets the
+        # total of the last row staged.
+        keys = ['title_report_id', 'access_type', 'metric_type', 'period']
+        columns = ['title_report_id', 'title_type', 'access_type', 'metric_type', 'period', 'period_total']
+        select = u"SELECT {0}, {1} FROM metric_temp{2}".format(', '.join(columns), load_id, where)
+        if partitioned:
+            select += u" {0} title_report_id BETWEEN %s AND %s".format('AND' if where else 'WHERE')
+        select += CounterDb.backend.last_rows(keys)
+        select += u" ORDER BY {0}".format(', '.join(keys + ['id']) if partitioned else 'id')
+        updates = self._keep_previous('metric', ['period_total']) + ['period_total', 'load_id']
+        return CounterDb.backend.upsert_sql('metric', columns + ['load_id'], keys, updates, select)
+
+    def _batch_sql(self, reports):
+        """
+        Returns the load id expression and WHERE clause of a merge.
+        """
+        if reports is None:
+            return u"%s", u""
+        load_id = u"CASE excel_name {0} END".format(' '.join([u"WHEN %s THEN %s"] * reports))
+        where = u" WHERE excel_name IN ({0})".format(', '.join(['%s'] * reports))
+        return load_id, where
+
+    def _keep_previous(self, table, columns):
+        """
+        Returns the upsert assignments saving the values and load id a row
+        had in its prev_ columns, unless the same report wrote them: a
+        report merged again, e.g. when quarantined rows are replayed, keeps
+        what was there before its first merge.
+        """
+        # MySQL applies the assignments in order, so these must come
+        # before those of the columns they save.
+        new = CounterDb.backend.excluded
+        return [('prev_' + c, u"CASE WHEN {0}.load_id = {1} THEN {0}.prev_{2} ELSE {0}.{2} END".format(
+            table, new('load_id'), c)) for c in columns + ['load_id']]
+
+    def _wide_merge_sql(self, partitioned, load_id, where):
+        """
+        Returns the upsert merging metric_wide_temp into metric_wide. A
+        month is only overwritten when the report covers it, so loading the
+        second half of a year keeps the first.
+        """
+        # A title repeated within a report gives several staged rows for
+        # the same key, covering the same months; as in the long layout,
+        # the last row staged wins.
+        keys = ['title_report_id', 'access_type', 'metric_type', 'year']
+        columns = keys + ['title_type', 'months'] + self.MONTH_COLUMNS + ['load_id']
+        select = u"SELECT {0}, {1} FROM metric_wide_temp{2}".format(
+            ', '.join(columns[:-1]), load_id, where)
+        if partitioned:
+            select += u" {0} title_report_id BETWEEN %s AND %s".format('AND' if where else 'WHERE')
+        select += CounterDb.backend.last_rows(keys)
+        select += u" ORDER BY {0}".format(', '.join(keys + ['id']) if partitioned else 'id')
+        new = CounterDb.backend.excluded
+        updates = self._keep_previous('metric_wide', ['months'] + self.MONTH_COLUMNS)
+        updates.extend((m, u"CASE WHEN {0} & {1} <> 0 THEN {2} ELSE metric_wide.{3} END".format(
+            new('months'), 1 << i, new(m), m)) for i, m in enumerate(self.MONTH_COLUMNS))
+        # MySQL applies the assignments in order, so months and load_id
+        # must come last.
+        updates.append(('months', u"metric_wide.months | {0}".format(new('months'))))
+        updates.append('load_id')
+        return CounterDb.backend.upsert_sql('metric_wide', columns, keys, updates, select)
+
+    def partitions(self, load_ids=None):
+        """
+        Returns the set of (year, platform_id) pairs the usage rows written
+        by the reports with the given load ids fall in, or those of all
+        usage rows when load_ids is None. A report may list titles of
+        several platforms, so the platforms come from the titles.
+        """
+        if CounterDb.metric_layout == 'wide':
+            sql = u"SELECT DISTINCT m.year, t.platform_id FROM metric_wide m \
+                JOIN title_report t ON t.id = m.title_report_id"
+        else:
+            sql = u"SELECT DISTINCT YEAR(m.period), t.platform_id FROM metric m \
+                JOIN title_report t ON t.id = m.title_report_id"
+        cursor = CounterDb.conn.cursor()
+        if load_ids is None:
+            cursor.execute(sql)
+            return {(int(year), platform_id) for year, platform_id in cursor.fetchall()}
+
+        load_ids = list(load_ids)
+        partitions = set()
+        for i in range(0, len(load_ids), self.UNLOAD_BATCH):
+            batch = load_ids[i:i + self.UNLOAD_BATCH]
+            cursor.execute(sql + u" WHERE m.load_id IN ({0})".format(', '.join(['%s'] * len(batch))), batch)
+            partitions.update((int(year), platform_id) for year, platform_id in cursor.fetchall())
+        return partitions
+
+    def unload(self, load_id):
+        """
+        Takes the usage written by the report with the given load id back
+        out: rows it inserted are deleted and rows it overwrote get their
+        previous values back. Works through the rows of UNLOAD_BATCH titles
+        at a time, each batch in its own transaction, using the
+        idx_load_id index. Returns the numbers of rows deleted and
+        restored.
+        """
+        if CounterDb.metric_layout == 'wide':
+            table, values = 'metric_wide', ['months'] + self.MONTH_COLUMNS
+        else:
+            table, values = 'metric', ['period_total']
+        restore = ', '.join('{0} = prev_{0}'.format(c) for c in values + ['load_id'])
+        clear = ', '.join('prev_{0} = NULL'.format(c) for c in values + ['load_id'])
+        cursor = CounterDb.conn.cursor()
+        deleted = restored = 0
+        while True:
+            sql = u"SELECT DISTINCT title_report_id FROM {0} WHERE load_id = %s \
+                ORDER BY title_report_id LIMIT %s".format(table)
+            cursor.execute(sql, (load_id, self.UNLOAD_BATCH))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+            in_ids = ', '.join(['%s'] * len(ids))
+
+            # A row the report inserted has nothing saved.
+            sql = u"DELETE FROM {0} WHERE load_id = %s AND title_report_id IN ({1}) \
+                AND prev_{2} IS NULL".format(table, in_ids, values[0])
+            cursor.execute(sql, [load_id] + ids)
+            deleted += cursor.rowcount
+            # Restoring sets load_id to another report's, or NULL, so the
+            # rows drop out of the next batch.
+            sql = u"UPDATE {0} SET {1}, {2} WHERE load_id = %s AND title_report_id IN ({3})".format(
+                table, restore, clear, in_ids)
+            cursor.execute(sql, [load_id] + ids)
+            restored += cursor.rowcount
+            CounterDb.conn.commit()
+
+        return deleted, restored
+
+class ItemReportTable(CounterDb):
+    """
+    Represents the item_report and item_metric tables.
+
+    Item Master Reports can run to millions of rows, so they are loaded in
+    chunks of CHUNK_ROWS report rows. Each chunk is written to text files,
+    bulk imported into item_report_temp and item_metric_temp, and merged
+    into the main tables with two set-based upserts. Memory use is bounded
+    by the chunk size and the number of statements per chunk is constant.
+    """
+    CHUNK_ROWS = 25000
+    ITEM_COLUMNS = ['item', 'data_type', 'publisher', 'publisher_id', 'platform_id',
+        'authors', 'publication_date', 'article_version', 'doi', 'proprietary_id',
+        'isbn', 'print_issn', 'online_issn', 'uri', 'parent_title', 'parent_data_type',
+        'parent_doi', 'parent_proprietary_id', 'parent_isbn', 'parent_print_issn',
+        'parent_online_issn', 'parent_uri', 'yop', 'item_key']
+
+    def __init__(self, reportdir):
+        self._reportdir = reportdir
+        self._platform = PlatformTable()
+
+    def _platform_id(self, name):
+        platform_id = self._platform.get_platform_id(name)
+        if platform_id is None:
+            raise ValueError('Platform not present in the platform_ref table: "{0}"'.format(name))
+        return platform_id
+
+    def _stage(self, items, metrics):
+        """
+        Writes a chunk to the temp text files and bulk imports them.
+        """
+        item_temp = '{0}/item_report_temp'.format(self._reportdir)
+        with open(item_temp, 'w', newline='', encoding='utf-8') as csvfile:
+            csvwriter = csv.writer(csvfile, dialect='excel-tab', lineterminator='\n')
+            csvwriter.writerows(items.values())
+        metric_temp = '{0}/item_metric_temp'.format(self._reportdir)
+        with open(metric_temp, 'w', newline='', encoding='utf-8') as csvfile:
+            csvwriter = csv.writer(csvfile, dialect='excel-tab', lineterminator='\n')
+            csvwriter.writerows(metrics)
+        BulkImport(self._reportdir).import_tables(['item_report_temp', 'item_metric_temp'])
+
+        # BulkImport only reports a failed import, so the staged rows are
+        # counted before the chunk is merged and the load marked done.
+        cursor = CounterDb.conn.cursor()
+        for table, expected in [('item_report_temp', len(items)), ('item_metric_temp', len(metrics))]:
+            cursor.execute(u"SELECT COUNT(*) FROM {0}".format(table))
+            staged = cursor.fetchone()[0]
+            if staged != expected:
+                raise OSError('{0} rows of {1} were imported into {2}'.format(staged, expected, table))
+
+    def _merge(self):
+        """
+        Upserts the staged chunk into item_report and item_metric.
+        """
+        select = u"SELECT {0} FROM item_report_temp".format(', '.join(self.ITEM_COLUMNS))
+        sql = CounterDb.backend.upsert_sql('item_report', self.ITEM_COLUMNS,
+            ['platform_id', 'item_key'], [], select)
         cursor = CounterDb.conn.cursor()
         cursor.execute(sql)
+
+        columns = ['item_report_id', 'access_type', 'access_method', 'metric_type', 'period', 'period_total']
+        select = u"SELECT r.id, m.access_type, m.access_method, m.metric_type, m.period, m.period_total \
+            FROM item_metric_temp m \
+            JOIN item_report r ON r.platform_id = m.platform_id AND r.item_key = m.item_key"
+        sql = CounterDb.backend.upsert_sql('item_metric', columns,
+            ['item_report_id', 'access_type', 'access_method', 'metric_type', 'period'],
+            ['period_total'], select)
+        cursor.execute(sql)
         CounterDb.conn.commit()
 
-        # Next, do the inserts into the main metric table but check for
-        # duplicates first.
-        cursor = CounterDb.conn.cursor(named_tuple=True)
-        cursor.execute('SELECT * FROM metric_temp')
-        rows = cursor.fetchall()
-        for row in rows:
-            dupe = self._is_duplicate(row.title_report_id, row.access_type, row.metric_type, row.period)
-            if dupe:
-                sql = u"UPDATE metric SET \
-                    period_total = %s \
-                    WHERE id = %s"
-                params = (row.period_total, dupe.id)
-            else:
-                sql = u"INSERT INTO metric SET \
-                    id = NULL, \
-                    title_report_id = %s, \
-                    title_type = %s, \
-                    access_type = %s, \
-                    metric_type = %s, \
-                    period = %s, \
-                    period_total = %s"
-                params = (row.title_report_id, row.title_type, row.access_type, row.metric_type,
-                    row.period, row.period_total)
+    def load(self, report):
+        """
+        Loads an ItemMasterReport chunk by chunk. Returns the number of
+        report rows loaded.
+        """
+        items = {}
+        metrics = {}
+        platform_ids = {}
+        rows = 0
+        for item, item_metrics in report.iter_records():
+            # A report names few platforms, so each is resolved once.
+            platform_id = platform_ids.get(item.platform)
+            if platform_id is None:
+                platform_id = platform_ids[item.platform] = self._platform_id(item.platform)
+
+            # An item appears once for each metric type (and access type),
+            # so items are de-duplicated within the chunk before staging.
+            if (platform_id, item.item_key) not in items:
+                values = item._replace(platform=platform_id,
+                    item=normalize_title(item.item),
+                    publisher=normalize_publisher(item.publisher),
+                    parent_title=normalize_title(item.parent_title))
+                items[(platform_id, item.item_key)] = tuple(values)
+            # A repeated item row stages the same metric keys again; the
+            # last row's totals are kept, as for title reports.
+            for metric in item_metrics:
+                values = (platform_id,) + tuple(metric[1:])
+                metrics[values[:-1]] = values
+
+            rows += 1
+            if rows % self.CHUNK_ROWS == 0:
+                self._stage(items, metrics.values())
+                self._merge()
+                items = {}
+                metrics = {}
+                print(' loaded {0} rows'.format(rows))
+
+        if items:
+            self._stage(items, metrics.values())
+            self._merge()
+
+        return rows
 
-            # Do the insert and return.
-            cursor = CounterDb.conn.cursor()
-            cursor.execute(sql, params)
-            CounterDb.conn.commit()
 
 class PlatformTable(CounterDb):
     """
     Represents the platform_ref table.
+
+    Lookups go through a PlatformResolver built from platform_ref and
+    platform_alias on first use and shared by all instances. A name that
+    does not resolve triggers a reload, at most every REFRESH_SECONDS, so
+    a long-running process picks up platforms registered after it started.
     """
+    REFRESH_SECONDS = 60
+    _resolver = None
+    _loaded_at = None
+
     def __init__(self):
         pass
 
+    def get_resolver(self):
+        """
+        Returns the shared platform resolver, loading it if needed.
+        """
+        if PlatformTable._resolver is None:
+            self.refresh()
+        return PlatformTable._resolver
+
+    def refresh(self):
+        """
+        Reloads the resolver, e.g. after platforms or aliases were added.
+        """
+        cursor = CounterDb.conn.cursor()
+        cursor.execute('SELECT id, name, preferred_name FROM platform_ref')
+        platforms = cursor.fetchall()
+        cursor.execute('SELECT alias, platform_id FROM platform_alias')
+        aliases = cursor.fetchall()
+        PlatformTable._resolver = PlatformResolver(platforms, aliases)
+        PlatformTable._loaded_at = datetime.now()
+
     def get_platform_id(self, name):
         """
         Returns the corresponding ID for a given platform name. If the
         platform name is found, the ID will be returned; otherwise,
         the return value will be None.
-        """
-        params = (name,)
-        sql = u"SELECT id FROM platform_ref WHERE name = %s"
-        cursor = CounterDb.conn.cursor()
-        cursor.execute(sql, params)
-        row = cursor.fetchone()
 
-        return row[0]
+        Names are matched exactly first and then on their normalized
+        form, so encoding and spelling variants resolve to the same ID.
+        """
+        platform_id = self.get_resolver().resolve(name)
+        if platform_id is None and \
+            datetime.now() - PlatformTable._loaded_at > timedelta(seconds=self.REFRESH_SECONDS):
+            self.refresh()
+            platform_id = PlatformTable._resolver.resolve(name)
+        return platform_id
 
     def get_platform_names(self):
         """
         Returns the names defined in the platform_ref table.
         Used to determine if a report contains an undefined platform name.
         """
-        sql = "SELECT name from platform_ref"
+        return self.get_resolver().names()
+
+
+class DataVersion(CounterDb):
+    """
+    Represents the data_version table of counters. The DATA counter
+    changes whenever loaded usage changes, and caches of query results
+    (see dataloader.filters) are keyed by it. The TITLES counter changes
+    whenever title_report rows are deleted, and the title id caches of the
+    loaders are checked against it (see TitleReportTable).
+    """
+    DATA = 1
+    TITLES = 2
+
+    def __init__(self):
+        pass
+
+    def get(self, counter=DATA):
         cursor = CounterDb.conn.cursor()
-        cursor.execute(sql)
+        cursor.execute(u"SELECT version FROM data_version WHERE id = %s", (counter,))
+        row = cursor.fetchone()
+
+        return row[0] if row is not None else 0
+
+    def bump(self, cursor, counter=DATA):
+        """
+        Increments a counter as part of the caller's transaction.
+        """
+        cursor.execute(u"UPDATE data_version SET version = version + 1 WHERE id = %s", (counter,))
+
+
+class FilterTable(CounterDb):
+    """
+    Represents the filter table of saved queries, see dataloader.filters.
+    """
+    def __init__(self):
+        pass
+
+    def get(self, filter_id):
+        sql = u"SELECT id, name, description, params, title_type, owner FROM filter WHERE id = %s"
+        cursor = CounterDb.conn.cursor(named_tuple=True)
+        cursor.execute(sql, (filter_id,))
+        row = cursor.fetchone()
+
+        return row
+
+    def get_filters(self, owner=None):
+        sql = u"SELECT id, name, description, params, title_type, owner FROM filter"
+        params = []
+        if owner is not None:
+            sql += u" WHERE owner = %s"
+            params.append(owner)
+        sql += u" ORDER BY name"
+        cursor = CounterDb.conn.cursor(named_tuple=True)
+        cursor.execute(sql, params)
         rows = cursor.fetchall()
-        names = [tuple[0] for tuple in rows]
-        return names
+
+        return rows
+
+
+class FilterCacheTable(CounterDb):
+    """
+    Represents the filter_cache table of filter results, see
+    dataloader.filters. A result is stored as text under the hash of the
+    compiled filter and the data version it was computed at, so it
+    outlives the process that ran the filter.
+    """
+    def __init__(self):
+        pass
+
+    def get(self, filter_hash, version):
+        sql = u"SELECT result FROM filter_cache WHERE filter_hash = %s AND data_version = %s"
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(sql, (filter_hash, version))
+        row = cursor.fetchone()
+
+        return None if row is None else row[0]
+
+    def put(self, filter_hash, version, result):
+        """
+        Stores a result, dropping those of older data versions, which can
+        no longer be returned.
+        """
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(u"DELETE FROM filter_cache WHERE data_version < %s", (version,))
+        sql = CounterDb.backend.upsert_sql('filter_cache', ['filter_hash', 'data_version', 'result', 'cached_at'],
+            ['filter_hash', 'data_version'], ['result', 'cached_at'])
+        cursor.execute(sql, (filter_hash, version, result, datetime.now().isoformat()))
+        CounterDb.conn.commit()
+
+    def clear(self):
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(u"DELETE FROM filter_cache")
+        CounterDb.conn.commit()
 
 
 class ReportInventoryTable(CounterDb):
     """
     Represents the spreadsheet inventory table.
+
+    A title report gets its row when its load starts (start) and the row
+    is completed when the load is done (finish). The row id is the load
+    id the report's title_report and metric rows are tagged with; a row
+    with no load_end is a load that has not finished.
+
+    Every completed load also sets change_seq to the data version it
+    bumped, so rows can be read in the order their loads were committed,
+    including reports loaded again under their old id (see
+    dataloader.export).
     """
     def __init__(self):
         pass
@@ -388,38 +1191,460 @@ class ReportInventoryTable(CounterDb):
         """
         Checks to see if the report has already been loaded.
         """
-        sql = u"SELECT platform, run_date, begin_date, end_date \
+        sql = u"SELECT row_cnt \
             FROM report_inventory \
             WHERE platform = %s \
             AND run_date = %s \
             AND begin_date = %s \
             AND end_date = %s \
-            AND row_cnt = %s"
+            AND load_end IS NOT NULL"
         params = (report.platform, report.run_date, report.begin_date,
-            report.end_date, report.row_count)
+            report.end_date)
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+        # Counting the rows of a title report takes a pass over them, so it
+        # is left to the export unless the header matches a loaded report.
+        return any(row[0] == report.row_count for row in rows)
+
+    def get_reports(self, year=None):
+        """
+        Returns the inventory rows, optionally only those for reports that
+        begin in the given year, in load order.
+        """
+        sql = u"SELECT id, excel_name, platform, begin_date, end_date, row_cnt \
+            FROM report_inventory WHERE load_end IS NOT NULL"
+        params = []
+        if year is not None:
+            sql += u" AND begin_date BETWEEN %s AND %s"
+            params = ['{0}-01-01'.format(year), '{0}-12-31'.format(year)]
+        sql += u" ORDER BY id"
+        cursor = CounterDb.conn.cursor(named_tuple=True)
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+        return rows
+
+    def find(self, report):
+        """
+        Returns the inventory rows for a report file name, or for an
+        inventory id given as a number.
+        """
+        sql = u"SELECT id, excel_name, platform, begin_date, end_date, row_cnt, load_end \
+            FROM report_inventory"
+        if str(report).isdigit():
+            sql += u" WHERE id = %s"
+            params = (int(report),)
+        else:
+            sql += u" WHERE excel_name = %s ORDER BY id"
+            params = (os.path.basename(report),)
+        cursor = CounterDb.conn.cursor(named_tuple=True)
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+        return rows
+
+    def get_load_id(self, report):
+        """
+        Returns the inventory id of a report whose load has started, or
+        None.
+        """
+        sql = u"SELECT id FROM report_inventory \
+            WHERE platform = %s AND begin_date = %s AND end_date = %s AND row_cnt = %s"
+        params = (report.platform, report.begin_date, report.end_date, report.row_count)
         cursor = CounterDb.conn.cursor()
         cursor.execute(sql, params)
         row = cursor.fetchone()
 
-        return (row is not None)
+        return row[0] if row is not None else None
 
-    def insert(self, report, load_start, load_end):
+    def start(self, report, load_start):
         """
-        Inserts the report details into the inventory table.
+        Records that the load of a title report has started and returns
+        its inventory id, the load id to tag its rows with. A report loaded
+        again, e.g. after an interrupted load or with a later run date,
+        keeps its id.
         """
-        sql = u"INSERT INTO report_inventory SET \
-            id = NULL, \
+        columns = ['excel_name', 'platform', 'run_date', 'begin_date', 'end_date', 'row_cnt',
+            'load_start', 'load_date']
+        params = (report.filename, report.platform, report.run_date, report.begin_date,
+            report.end_date, report.row_count, load_start, datetime.now().strftime('%Y-%m-%d'))
+        cursor = CounterDb.conn.cursor()
+        load_id = CounterDb.backend.upsert_id(cursor, 'report_inventory', columns, params,
+            ['platform', 'begin_date', 'end_date', 'row_cnt'])
+        CounterDb.conn.commit()
+
+        return load_id
+
+    def finish(self, load_id, report, load_start, load_end):
+        """
+        Completes the inventory row of a loaded report.
+        """
+        sql = u"UPDATE report_inventory SET \
             excel_name = %s, \
-            platform = %s, \
             run_date = %s, \
-            begin_date = %s, \
-            end_date = %s, \
-            row_cnt = %s, \
             load_start = %s, \
             load_end = %s, \
-            load_date = CURRENT_DATE"
+            load_date = CURRENT_DATE, \
+            change_seq = (SELECT version FROM data_version WHERE id = 1) \
+            WHERE id = %s"
+        params = (report.filename, report.run_date, load_start, load_end, load_id)
+        cursor = CounterDb.conn.cursor()
+        DataVersion().bump(cursor)
+        cursor.execute(sql, params)
+        CounterDb.conn.commit()
+
+    def touch(self, load_id):
+        """
+        Records that the usage of a loaded report changed after its load,
+        e.g. when its quarantined rows were replayed: the data version is
+        bumped, so cached filter results are dropped, and the report gets a
+        new change_seq, so the next incremental export rewrites its
+        partitions.
+        """
+        sql = u"UPDATE report_inventory SET \
+            change_seq = (SELECT version FROM data_version WHERE id = 1) \
+            WHERE id = %s"
+        cursor = CounterDb.conn.cursor()
+        DataVersion().bump(cursor)
+        cursor.execute(sql, (load_id,))
+        CounterDb.conn.commit()
+
+    def insert(self, report, row_count, load_start, load_end):
+        """
+        Records a loaded item report, whose rows are not tagged with a load
+        id, in the inventory table. row_count is the number of report rows
+        the load read, so the report is not read again to count them. A
+        report loaded again, e.g. after a failure, updates its row.
+        """
+        columns = ['excel_name', 'platform', 'run_date', 'begin_date', 'end_date', 'row_cnt',
+            'load_start', 'load_end', 'load_date', 'change_seq']
+        select = u"SELECT %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_DATE, version \
+            FROM data_version WHERE id = 1"
+        sql = CounterDb.backend.upsert_sql('report_inventory', columns,
+            ['platform', 'begin_date', 'end_date', 'row_cnt'],
+            ['excel_name', 'run_date', 'load_start', 'load_end', 'load_date', 'change_seq'], select)
         params = (report.filename, report.platform, report.run_date, report.begin_date,
-            report.end_date, len(report.data_rows()), load_start, load_end)
+            report.end_date, row_count, load_start, load_end)
+        cursor = CounterDb.conn.cursor()
+        DataVersion().bump(cursor)
+        cursor.execute(sql, params)
+        CounterDb.conn.commit()
+
+    def delete(self, load_id):
+        """
+        Removes an inventory row, once its report has been unloaded.
+        """
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(u"DELETE FROM report_inventory WHERE id = %s", (load_id,))
+        DataVersion().bump(cursor)
+        CounterDb.conn.commit()
+
+
+class QuarantineTable(CounterDb):
+    """
+    Represents the quarantine table: report rows that could not be loaded,
+    with the reason and the raw cell values as JSON.
+
+    A row is fixed either by correcting row_data in place or by changing
+    the code or reference data that rejected it, and is then loaded with
+    replay-quarantine.py, which sets replayed_at.
+    """
+    def __init__(self):
+        pass
+
+    def insert(self, reportdir, rows):
+        """
+        Saves the quarantined rows of a report. A row quarantined again,
+        e.g. when a report is reloaded, replaces the earlier entry.
+        """
+        if not rows:
+            return
+        columns = ['report_dir', 'excel_name', 'row_num', 'reason', 'row_data',
+            'quarantined_at', 'replayed_at']
+        sql = CounterDb.backend.upsert_sql('quarantine', columns,
+            ['report_dir', 'excel_name', 'row_num'], columns[3:])
+        now = datetime.now().isoformat()
+        params = [(reportdir, row.excel_name, row.row_num, row.reason[:255],
+            json.dumps(row.values, default=str), now, None) for row in rows]
         cursor = CounterDb.conn.cursor()
+        cursor.executemany(sql, params)
+        CounterDb.conn.commit()
+
+    def pending(self, excel_name=None):
+        """
+        Returns the rows not yet replayed, optionally for one report only,
+        ordered by report and row number.
+        """
+        sql = u"SELECT id, report_dir, excel_name, row_num, reason, row_data \
+            FROM quarantine WHERE replayed_at IS NULL"
+        params = []
+        if excel_name is not None:
+            sql += u" AND excel_name = %s"
+            params.append(excel_name)
+        sql += u" ORDER BY report_dir, excel_name, row_num"
+        cursor = CounterDb.conn.cursor(named_tuple=True)
         cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+        return rows
+
+    def set_replayed(self, ids):
+        sql = u"UPDATE quarantine SET replayed_at = %s WHERE id = %s"
+        now = datetime.now().isoformat()
+        cursor = CounterDb.conn.cursor()
+        cursor.executemany(sql, [(now, i) for i in ids])
+        CounterDb.conn.commit()
+
+
+class LoadJobTable(CounterDb):
+    """
+    Represents the load_job table, the persistent work queue for batch runs.
+
+    Every report file found by the loader gets a row recording how far its
+    load has progressed. The states follow the steps of a load in order:
+
+      - queued: found in the report directory, not yet processed
+      - parsed: exported to the title and metric text files
+      - staged: bulk imported into the temp tables
+      - merged: inserted into title_report and metric
+      - done: recorded in report_inventory
+      - failed: an exception was raised, see the error column
+
+    A restarted run skips files that are done and resumes the others from
+    their last completed step.
+
+    Several loader processes, on one machine or many, can share a queue.
+    Each claims one job at a time (claimed_by) and keeps the claim alive
+    with heartbeats; a job whose heartbeat is older than the stale timeout
+    is assumed abandoned and may be claimed by another node, which resumes
+    it from its last completed step.
+    """
+    STATES = ['queued', 'parsed', 'staged', 'merged', 'done', 'failed']
+
+    def __init__(self):
+        pass
+
+    def enqueue(self, reportdir, files):
+        """
+        Adds the given files to the queue. Files already known for the
+        report directory keep their current state.
+        """
+        sql = CounterDb.backend.upsert_sql('load_job', ['report_dir', 'excel_name', 'state', 'queued_at'],
+            ['report_dir', 'excel_name'])
+        now = datetime.now().isoformat()
+        params = [(reportdir, os.path.basename(f), 'queued', now) for f in files]
+        cursor = CounterDb.conn.cursor()
+        cursor.executemany(sql, params)
+        CounterDb.conn.commit()
+
+    def pending(self, reportdir, retry_failed=False):
+        """
+        Returns the jobs still to be processed for the report directory in
+        file name order. Failed jobs are only included when retry_failed is
+        set, in which case their state is reset to queued.
+        """
+        cursor = CounterDb.conn.cursor()
+        if retry_failed:
+            sql = u"UPDATE load_job SET state = 'queued', error = NULL, claimed_by = NULL, heartbeat_at = NULL \
+                WHERE report_dir = %s AND state = 'failed'"
+            cursor.execute(sql, (reportdir,))
+            CounterDb.conn.commit()
+
+        sql = u"SELECT * FROM load_job \
+            WHERE report_dir = %s \
+            AND state NOT IN ('done', 'failed') \
+            ORDER BY excel_name"
+        cursor = CounterDb.conn.cursor(named_tuple=True)
+        cursor.execute(sql, (reportdir,))
+        rows = cursor.fetchall()
+
+        return rows
+
+    def requeue_if_changed(self, reportdir, name, modified):
+        """
+        Puts a failed job back in the queue if its file was modified after
+        the failure, e.g. when a corrected report was copied over it.
+        """
+        sql = u"UPDATE load_job SET state = 'queued', error = NULL, claimed_by = NULL, heartbeat_at = NULL \
+            WHERE report_dir = %s AND excel_name = %s \
+            AND state = 'failed' AND finished_at < %s"
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(sql, (reportdir, name, modified.isoformat()))
         CounterDb.conn.commit()
+
+    def claim(self, reportdir, node, names, stale_after=600):
+        """
+        Claims the next unfinished job for the given files on behalf of
+        node, and returns it, or None when there is nothing left to claim.
+        Jobs claimed by other nodes are skipped unless their last heartbeat
+        is more than stale_after seconds old.
+
+        The candidate row is read with SELECT ... FOR UPDATE SKIP LOCKED,
+        so concurrent claims never wait on each other or pick the same job.
+        """
+        if not names:
+            return None
+        now = datetime.now()
+        stale = (now - timedelta(seconds=stale_after)).isoformat()
+        sql = u"SELECT * FROM load_job \
+            WHERE report_dir = %s \
+            AND excel_name IN ({0}) \
+            AND state NOT IN ('done', 'failed') \
+            AND (claimed_by IS NULL OR claimed_by = %s OR heartbeat_at < %s) \
+            ORDER BY excel_name \
+            LIMIT 1{1}".format(', '.join(['%s'] * len(names)), CounterDb.backend.skip_locked)
+        params = [reportdir] + list(names) + [node, stale]
+        cursor = CounterDb.conn.cursor(named_tuple=True)
+        try:
+            cursor.execute(sql, params)
+            job = cursor.fetchone()
+            if job is not None:
+                sql = u"UPDATE load_job SET claimed_by = %s, heartbeat_at = %s WHERE id = %s"
+                cursor.execute(sql, (node, now.isoformat(), job.id))
+            CounterDb.conn.commit()
+        except Exception:
+            CounterDb.conn.rollback()
+            raise
+
+        return job
+
+    def get(self, job_id):
+        """
+        Returns a job as it is now, e.g. after its state has changed since
+        it was claimed.
+        """
+        cursor = CounterDb.conn.cursor(named_tuple=True)
+        cursor.execute(u"SELECT * FROM load_job WHERE id = %s", (job_id,))
+        row = cursor.fetchone()
+
+        return row
+
+    def claimed_elsewhere(self, reportdir, node, names):
+        """
+        Returns the number of unfinished jobs for the given files that are
+        claimed by other nodes. They cannot be claimed yet, but will be if
+        their node stops sending heartbeats, so a run should not end while
+        there are any.
+        """
+        if not names:
+            return 0
+        sql = u"SELECT COUNT(*) FROM load_job \
+            WHERE report_dir = %s \
+            AND excel_name IN ({0}) \
+            AND state NOT IN ('done', 'failed') \
+            AND claimed_by IS NOT NULL AND claimed_by <> %s".format(', '.join(['%s'] * len(names)))
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(sql, [reportdir] + list(names) + [node])
+        (n,) = cursor.fetchone()
+        CounterDb.conn.commit()
+
+        return n
+
+    def set_state(self, job_id, state, error=None):
+        """
+        Records the progress of a job. The start time is set when a job
+        first leaves the queued state and the finish time when it is done
+        or has failed, which also releases its claim.
+        """
+        assert state in self.STATES
+        now = datetime.now().isoformat()
+        finished = state in ('done', 'failed')
+        finished_at = now if finished else None
+        # MySQL applies SET assignments left to right, so the columns that
+        # depend on the previous state must come before state itself.
+        sql = u"UPDATE load_job SET \
+            attempts = attempts + CASE WHEN state = 'queued' THEN 1 ELSE 0 END, \
+            started_at = CASE WHEN state = 'queued' THEN %s ELSE started_at END, \
+            finished_at = %s, \
+            state = %s, \
+            error = %s"
+        if finished:
+            sql += u", claimed_by = NULL, heartbeat_at = NULL"
+        sql += u" WHERE id = %s"
+        params = (now, finished_at, state, error, job_id)
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(sql, params)
+        CounterDb.conn.commit()
+
+    def counts(self, reportdir):
+        """
+        Returns a dict of job counts by state for the report directory.
+        """
+        sql = u"SELECT state, COUNT(*) FROM load_job \
+            WHERE report_dir = %s GROUP BY state"
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(sql, (reportdir,))
+        counts = dict.fromkeys(self.STATES, 0)
+        for (state, n) in cursor.fetchall():
+            counts[state] = n
+
+        return counts
+
+    def requeue(self, reportdir, name):
+        """
+        Puts a finished job, done or failed, back in the queue, for a file
+        delivered again with different content.
+        """
+        sql = u"UPDATE load_job SET state = 'queued', error = NULL, claimed_by = NULL, heartbeat_at = NULL \
+            WHERE report_dir = %s AND excel_name = %s AND state IN ('done', 'failed')"
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(sql, (reportdir, name))
+        CounterDb.conn.commit()
+
+    def mark_unloaded(self, excel_name):
+        """
+        Marks the done jobs of an unloaded report as failed, so the file
+        is not skipped as done but only loaded again when it is replaced
+        or failed jobs are retried.
+        """
+        sql = u"UPDATE load_job SET state = 'failed', error = %s, finished_at = %s, \
+            claimed_by = NULL, heartbeat_at = NULL \
+            WHERE excel_name = %s AND state = 'done'"
+        now = datetime.now().isoformat()
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(sql, ('unloaded at {0}'.format(now), now, excel_name))
+        CounterDb.conn.commit()
+
+
+class Heartbeat(threading.Thread):
+    """
+    Refreshes a claimed job's heartbeat_at every interval seconds until
+    stopped, so other nodes do not reclaim a job that takes a long time.
+
+    The thread uses its own connection, since the loader's connection is
+    busy with the load itself. If the claim is found to belong to another
+    node, lost is set and the heartbeats stop.
+    """
+
+    def __init__(self, job_id, node, interval=60):
+        super().__init__(daemon=True)
+        self._job_id = job_id
+        self._node = node
+        self._interval = interval
+        self._stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        conn = CounterDb.backend.connect()
+        try:
+            sql = u"UPDATE load_job SET heartbeat_at = %s WHERE id = %s AND claimed_by = %s"
+            while not self._stopped.wait(self._interval):
+                cursor = conn.cursor()
+                cursor.execute(sql, (datetime.now().isoformat(), self._job_id, self._node))
+                conn.commit()
+                if cursor.rowcount == 0:
+                    # A finished job has no claim left; it was only lost
+                    # if another node holds it.
+                    cursor.execute(u"SELECT claimed_by FROM load_job WHERE id = %s", (self._job_id,))
+                    row = cursor.fetchone()
+                    conn.commit()
+                    self.lost = row is not None and row[0] is not None
+                    break
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
@@ -0,0 +1,178 @@
+import os
+from datetime import date
+
+from dataloader.counter_db import CounterDb, MetricTable
+
+
+# Exports the usage warehouse (metric joined to title_report and
+# platform_ref) to Parquet for the BI tools, partitioned by year and
+# platform in the hive layout most readers understand:
+#
+#   <outdir>/year=2022/platform_id=12/usage.parquet
+#
+# The change_seq of the last report_inventory row exported is kept in
+# <outdir>/_last_change_seq. An incremental export only rewrites the
+# partitions holding usage written by reports whose load completed since
+# then, which includes reports loaded again under their old inventory id.
+# The partitions are found from the metric rows tagged with the reports'
+# load ids, since a report may list titles of several platforms. Loads
+# that have not finished, or failed, have no change_seq and are left out
+# until they complete. A full export rewrites the partitions of all usage
+# in the database, and removes partition files that no longer have any.
+
+class ParquetExporter(CounterDb):
+    """
+    Writes the joined usage data to partitioned Parquet files.
+
+    Each partition is read over an unbuffered (server-side) cursor in
+    chunks of CHUNK_ROWS and written to a temporary file that replaces the
+    old partition only once it is complete, so readers never see a
+    partial file. Requires the optional pyarrow package.
+    """
+    CHUNK_ROWS = 50000
+    STATE_FILE = '_last_change_seq'
+    COLUMNS = ['title_report_id', 'title', 'title_type', 'publisher', 'publisher_id',
+        'platform', 'doi', 'proprietary_id', 'isbn', 'print_issn', 'online_issn', 'uri',
+        'yop', 'access_type', 'metric_type', 'period', 'period_total']
+
+    def __init__(self, outdir):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('ParquetExporter requires the pyarrow package')
+        self._pa = pa
+        self._pq = pq
+        self._outdir = outdir
+        self._schema = pa.schema([(name, pa.int64()) if name in ['title_report_id', 'period_total']
+            else (name, pa.date32()) if name == 'period'
+            else (name, pa.string()) for name in self.COLUMNS])
+
+    def _last_change_seq(self):
+        path = os.path.join(self._outdir, self.STATE_FILE)
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+
+    def _save_change_seq(self, change_seq):
+        path = os.path.join(self._outdir, self.STATE_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(change_seq))
+        os.replace(path + '.tmp', path)
+
+    def touched_partitions(self, since_seq=0):
+        """
+        Returns the highest change_seq and the set of (year, platform_id)
+        partitions holding usage written by report_inventory rows completed
+        after since_seq.
+        """
+        sql = u"SELECT id, change_seq FROM report_inventory WHERE change_seq > %s"
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(sql, (since_seq,))
+        rows = cursor.fetchall()
+        if not rows:
+            return since_seq, set()
+        last_seq = max(change_seq for load_id, change_seq in rows)
+        return last_seq, MetricTable().partitions(load_id for load_id, change_seq in rows)
+
+    def all_partitions(self):
+        """
+        Returns the highest change_seq and the set of (year, platform_id)
+        partitions of all usage, with those already exported, so that
+        partitions whose usage is gone are removed.
+        """
+        cursor = CounterDb.conn.cursor()
+        cursor.execute(u"SELECT MAX(change_seq) FROM report_inventory")
+        last_seq = cursor.fetchone()[0] or 0
+        return last_seq, MetricTable().partitions() | self.exported_partitions()
+
+    def exported_partitions(self):
+        """
+        Returns the set of (year, platform_id) partitions in the output
+        directory.
+        """
+        partitions = set()
+        if not os.path.isdir(self._outdir):
+            return partitions
+        for year_dir in os.listdir(self._outdir):
+            if not year_dir.startswith('year='):
+                continue
+            for platform_dir in os.listdir(os.path.join(self._outdir, year_dir)):
+                if not platform_dir.startswith('platform_id='):
+                    continue
+                partition = (int(year_dir[5:]), int(platform_dir[12:]))
+                if os.path.exists(self._partition_path(*partition)):
+                    partitions.add(partition)
+        return partitions
+
+    def _partition_path(self, year, platform_id):
+        return os.path.join(self._outdir, 'year={0}'.format(year),
+            'platform_id={0}'.format(platform_id), 'usage.parquet')
+
+    def _code_name(self, names, value):
+        # MySQL stores the ENUM name; the DuckDB schema stores the code.
+        return names[value] if isinstance(value, int) else value
+
+    def write_partition(self, year, platform_id):
+        """
+        Rewrites one partition and returns the number of rows written. A
+        partition with no usage left is removed.
+        """
+        sql = u"SELECT t.id, t.title, m.title_type, t.publisher, t.publisher_id, \
+            p.preferred_name, t.doi, t.proprietary_id, t.isbn, t.print_issn, t.online_issn, \
+            t.uri, t.yop, m.access_type, m.metric_type, m.period, m.period_total \
+            FROM metric m \
+            JOIN title_report t ON t.id = m.title_report_id \
+            JOIN platform_ref p ON p.id = t.platform_id \
+            WHERE t.platform_id = %s AND m.period >= %s AND m.period < %s"
+        params = (platform_id, date(year, 1, 1), date(year + 1, 1, 1))
+
+        path = self._partition_path(year, platform_id)
+        tmp_path = path + '.tmp'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        cursor = CounterDb.conn.cursor(buffered=False)
+        cursor.execute(sql, params)
+        writer = None
+        count = 0
+        try:
+            while True:
+                rows = cursor.fetchmany(self.CHUNK_ROWS)
+                if not rows:
+                    break
+                columns = [list(column) for column in zip(*rows)]
+                columns[13] = [self._code_name(self.ACCESS_TYPE, v) for v in columns[13]]
+                columns[14] = [self._code_name(self.METRIC_TYPE, v) for v in columns[14]]
+                if writer is None:
+                    writer = self._pq.ParquetWriter(tmp_path, self._schema)
+                writer.write_table(self._pa.Table.from_arrays(columns, schema=self._schema))
+                count += len(rows)
+        finally:
+            cursor.close()
+            if writer is not None:
+                writer.close()
+
+        if count:
+            os.replace(tmp_path, path)
+        elif os.path.exists(path):
+            os.remove(path)
+        return count
+
+    def export(self, full=False):
+        """
+        Rewrites the partitions touched since the last export, or every
+        partition when full is set or nothing was exported yet. Returns the
+        number of partitions written.
+        """
+        since_seq = self._last_change_seq()
+        if full or not since_seq:
+            last_seq, partitions = self.all_partitions()
+        else:
+            last_seq, partitions = self.touched_partitions(since_seq)
+        for year, platform_id in sorted(partitions):
+            count = self.write_partition(year, platform_id)
+            print('year={0} platform_id={1}: {2} rows'.format(year, platform_id, count))
+        os.makedirs(self._outdir, exist_ok=True)
+        self._save_change_seq(last_seq)
+        return len(partitions)
@@ -0,0 +1,235 @@
+import datetime
+import decimal
+import hashlib
+import json
+from collections import namedtuple
+
+from dataloader.counter_db import CounterDb, DataVersion, FilterCacheTable, FilterTable, PlatformTable
+
+
+# Runs the saved filters in the filter table.
+#
+# A filter's params column holds a JSON object. Every key is optional:
+#
+#   {"platform": ["ACM Digital Library", "JSTOR"],   # names, aliases or ids
+#    "publisher": "Elsevier",                        # substring match
+#    "title": "journal of",                          # substring match
+#    "issn": "1234-5678",                            # print or online ISSN
+#    "isbn": "9780123456789",
+#    "yop": "2020",
+#    "access_type": "Controlled",                    # name or list of names
+#    "metric_type": ["Total_Item_Requests"],
+#    "begin": "2022-01", "end": "2022-12",           # months, inclusive
+#    "group_by": "title"}                            # title, platform, publisher or month
+#
+# The filter's title_type column restricts it to journals (J) or books
+# (B). A filter compiles to a single parameterized SELECT that sums
+# period_total by the group_by column, largest totals first. Platform
+# names resolve like the names in reports (see PlatformTable), so a
+# registered name, preferred name or alias all select the platform.
+#
+# Results are cached in the filter_cache table, keyed by a hash of the
+# compiled filter and the data version. The data version is bumped
+# whenever loaded usage changes, so a cached result is reused, by any
+# process, until new usage has been loaded.
+
+FilterPage = namedtuple('FilterPage', ['rows', 'total_rows', 'page', 'page_size', 'data_version'])
+
+
+class FilterError(ValueError):
+    """
+    Raised for filter params that cannot be compiled.
+    """
+
+
+GROUP_COLUMNS = {
+    'title': ['t.id', 't.title', 't.publisher', 'p.preferred_name', 't.print_issn', 't.online_issn', 't.isbn'],
+    'platform': ['p.id', 'p.preferred_name'],
+    'publisher': ['t.publisher'],
+    'month': ['m.period'],
+}
+GROUP_NAMES = {
+    'title': ['title_report_id', 'title', 'publisher', 'platform', 'print_issn', 'online_issn', 'isbn'],
+    'platform': ['platform_id', 'platform'],
+    'publisher': ['publisher'],
+    'month': ['period'],
+}
+PARAM_KEYS = ['platform', 'publisher', 'title', 'issn', 'isbn', 'yop', 'access_type',
+    'metric_type', 'begin', 'end', 'group_by']
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _in_list(column, values, names=None):
+    """
+    Returns an IN condition for the values, checking them against names
+    when given, and the parameters for it.
+    """
+    values = _as_list(values)
+    if names is not None:
+        unknown = [v for v in values if v not in names]
+        if unknown:
+            raise FilterError('Unknown value for {0}: {1}'.format(column, ', '.join(map(str, unknown))))
+    return '{0} IN ({1})'.format(column, ', '.join(['%s'] * len(values))), values
+
+
+def compile_filter(params, title_type):
+    """
+    Compiles filter params (a dict, see above) to SQL and a parameter list.
+    Returns the SELECT statement and its parameters; the statement has no
+    ORDER BY or LIMIT, so callers can page or count it.
+    """
+    unknown = [key for key in params if key not in PARAM_KEYS]
+    if unknown:
+        raise FilterError('Unknown filter params: {0}'.format(', '.join(unknown)))
+    group_by = params.get('group_by', 'title')
+    if group_by not in GROUP_COLUMNS:
+        raise FilterError('Unknown group_by: {0}'.format(group_by))
+
+    conditions = ['m.title_type = %s']
+    values = [title_type]
+    if 'platform' in params:
+        platforms = _as_list(params['platform'])
+        ids = [p for p in platforms if isinstance(p, int)]
+        names = [p for p in platforms if not isinstance(p, int)]
+        parts = []
+        if ids:
+            sql, args = _in_list('p.id', ids)
+            parts.append(sql)
+            values.extend(args)
+        if names:
+            platform = PlatformTable()
+            unknown = [name for name in names if platform.get_platform_id(name) is None]
+            if unknown:
+                raise FilterError('Unknown platform: {0}'.format(', '.join(unknown)))
+            sql, args = _in_list('p.id', [platform.get_platform_id(name) for name in names])
+            parts.append(sql)
+            values.extend(args)
+        conditions.append('({0})'.format(' OR '.join(parts)))
+    for key, column in [('publisher', 't.publisher'), ('title', 't.title')]:
+        if key in params:
+            conditions.append('{0} LIKE %s'.format(column))
+            values.append('%{0}%'.format(params[key]))
+    if 'issn' in params:
+        conditions.append('(t.print_issn = %s OR t.online_issn = %s)')
+        values.extend([params['issn'], params['issn']])
+    for key, column in [('isbn', 't.isbn'), ('yop', 't.yop')]:
+        if key in params:
+            sql, args = _in_list(column, params[key])
+            conditions.append(sql)
+            values.extend(args)
+    for key, names in [('access_type', CounterDb.ACCESS_TYPE), ('metric_type', CounterDb.METRIC_TYPE)]:
+        if key in params:
+            # Compare on the numeric code, which works for both the MySQL
+            # ENUMs and the codes stored by the DuckDB schema.
+            codes = [names.index(v) if v in names[1:] else v for v in _as_list(params[key])]
+            sql, args = _in_list('m.{0} + 0'.format(key), codes, range(1, len(names)))
+            conditions.append(sql)
+            values.extend(args)
+    if 'begin' in params:
+        conditions.append('m.period >= %s')
+        values.append('{0}-01'.format(params['begin'][0:7]))
+    if 'end' in params:
+        conditions.append('m.period <= %s')
+        values.append('{0}-01'.format(params['end'][0:7]))
+
+    columns = GROUP_COLUMNS[group_by]
+    select = ', '.join('{0} AS {1}'.format(c, n) for c, n in zip(columns, GROUP_NAMES[group_by]))
+    sql = u"SELECT {0}, SUM(m.period_total) AS total \
+        FROM metric m \
+        JOIN title_report t ON t.id = m.title_report_id \
+        JOIN platform_ref p ON p.id = t.platform_id \
+        WHERE {1} \
+        GROUP BY {2}".format(select, ' AND '.join(conditions), ', '.join(columns))
+    return sql, values
+
+
+def _json_value(value):
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError('Cannot store {0!r} in the filter cache'.format(value))
+
+
+class FilterEngine(CounterDb):
+    """
+    Runs saved filters with a result cache in the database.
+
+    Results of up to MAX_CACHED_ROWS rows are stored in filter_cache and
+    pages are served from the stored result. Larger results are paged in
+    SQL with LIMIT and OFFSET. Rows come back the same either way, with
+    sums as numbers and periods as ISO date strings.
+    """
+    MAX_CACHED_ROWS = 50000
+
+    def __init__(self):
+        self._filters = FilterTable()
+        self._cache = FilterCacheTable()
+
+    def _get(self, filter_id):
+        row = self._filters.get(filter_id)
+        if row is None:
+            raise FilterError('No filter with id {0}'.format(filter_id))
+        return row
+
+    def _compile(self, row):
+        try:
+            params = json.loads(row.params)
+        except ValueError as e:
+            raise FilterError('Filter {0} params are not valid JSON: {1}'.format(row.id, e))
+        return compile_filter(params, row.title_type)
+
+    def compile(self, filter_id):
+        """
+        Returns the SQL and parameters for a saved filter.
+        """
+        return self._compile(self._get(filter_id))
+
+    def _fetch(self, sql, values):
+        cursor = CounterDb.conn.cursor(named_tuple=True)
+        cursor.execute(sql, values)
+        return cursor.fetchall()
+
+    def _page(self, result, page, page_size, version):
+        Row = namedtuple('Row', result['columns'])
+        offset = (page - 1) * page_size
+        rows = [Row(*values) for values in result['rows'][offset:offset + page_size]]
+        return FilterPage(rows, len(result['rows']), page, page_size, version)
+
+    def run(self, filter_id, page=1, page_size=100):
+        """
+        Returns a FilterPage with the given page of the filter's results.
+        Pages are numbered from 1.
+        """
+        # The key is the compiled filter, so editing a filter, or adding a
+        # platform alias its names resolve through, does not return results
+        # cached for its old definition.
+        version = DataVersion().get()
+        sql, values = self.compile(filter_id)
+        filter_hash = hashlib.sha1(json.dumps([' '.join(sql.split()), values]).encode('utf-8')).hexdigest()
+        cached = self._cache.get(filter_hash, version)
+        if cached is not None:
+            return self._page(json.loads(cached), page, page_size, version)
+
+        # Fetch one row more than can be cached to find out in a single
+        # query whether the whole result fits.
+        rows = self._fetch(u"{0} ORDER BY total DESC LIMIT %s".format(sql),
+            values + [self.MAX_CACHED_ROWS + 1])
+        if len(rows) > self.MAX_CACHED_ROWS:
+            count = self._fetch(u"SELECT COUNT(*) AS n FROM ({0}) f".format(sql), values)[0][0]
+            paged = self._fetch(u"{0} ORDER BY total DESC LIMIT %s OFFSET %s".format(sql),
+                values + [page_size, (page - 1) * page_size])
+            return FilterPage(paged, count, page, page_size, version)
+
+        # Stored results are what later runs return, so this run returns
+        # them too.
+        columns = list(rows[0]._fields) if rows else []
+        result = json.dumps({'columns': columns, 'rows': [list(row) for row in rows]}, default=_json_value)
+        self._cache.put(filter_hash, version, result)
+        return self._page(json.loads(result), page, page_size, version)
+
+    def clear_cache(self):
+        self._cache.clear()
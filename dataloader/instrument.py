@@ -0,0 +1,380 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from dataloader.counter_db import CounterDb, Heartbeat
+from dataloader.merge import ParallelMerge
+
+
+# Counts the database round trips of a load, to find the statements that
+# run once per row (N+1 patterns) instead of once per report. Turn it on
+# with --instrument in loader.py, or from code:
+#
+#   instrumentation = Instrumentation(budget=50)
+#   instrumentation.install()
+#   ... load reports ...
+#   instrumentation.check_budget()
+#
+# install() wraps CounterDb.conn and CounterDb.backend, so every
+# statement, commit and rollback of the table classes goes through the
+# wrappers, including the merge connections of dataloader.merge, whether
+# they were opened before or after. The heartbeat threads are left out.
+# Each statement is counted under its shape (the SQL with literals and
+# placeholder lists collapsed, see statement_shape), with a histogram of
+# its latencies, and attributed to the current report and stage. An
+# executemany of an INSERT is one multi-row statement, as the drivers
+# send it; any other executemany runs its statement once per parameter
+# set, and counts that many times.
+# dataloader.pipeline names those with report() and stage(), which do
+# nothing while instrumentation is off.
+#
+# The budget is a maximum number of statements per 1,000 data rows of a
+# report. A set-based load runs a fixed number of statements per report
+# (a few hundred rows per statement at worst); one that looks rows up or
+# commits one by one runs several per row and is far over any budget.
+
+# Upper bounds, in milliseconds, of the latency histogram buckets.
+BUCKETS = [0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000, float('inf')]
+
+SHAPE_PATTERNS = [
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(?+)'),
+    (re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+'), '(?+)+'),
+]
+
+NO_REPORT = '(outside reports)'
+
+
+class StatementBudgetError(Exception):
+    """
+    Raised by check_budget for reports that ran more statements per
+    1,000 rows than the budget allows.
+    """
+
+
+def statement_shape(sql):
+    """
+    Returns sql with its literals, placeholders and value lists collapsed,
+    so the statements of a loop that differ only in their values share a
+    shape.
+    """
+    for pattern, replacement in SHAPE_PATTERNS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+class StatementStats:
+    """
+    The calls and latency histogram of one statement shape.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.histogram = [0] * len(BUCKETS)
+
+    def add(self, seconds, calls=1):
+        """
+        Adds calls runs of the statement that took seconds in all, each
+        taking an equal share in the histogram.
+        """
+        self.calls += calls
+        self.seconds += seconds
+        ms = seconds * 1000 / calls
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                self.histogram[i] += calls
+                break
+
+    def percentile(self, p):
+        """
+        Returns the upper bound in milliseconds of the bucket holding the
+        p-th percentile latency.
+        """
+        rank = p / 100.0 * self.calls
+        seen = 0
+        for bound, n in zip(BUCKETS, self.histogram):
+            seen += n
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+
+class ReportStats:
+    """
+    The statements and commits of one report, by stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.statements = OrderedDict()
+        self.commits = OrderedDict()
+        self.rollbacks = 0
+
+    def statement_count(self):
+        return sum(s.calls for shapes in self.statements.values() for s in shapes.values())
+
+    def commit_count(self):
+        return sum(self.commits.values())
+
+    def seconds(self):
+        return sum(s.seconds for shapes in self.statements.values() for s in shapes.values())
+
+    def per_1k_rows(self):
+        """
+        Returns the statements per 1,000 data rows, or None when the
+        report loaded no rows.
+        """
+        if not self.rows:
+            return None
+        return self.statement_count() * 1000.0 / self.rows
+
+
+class Instrumentation:
+    """
+    Collects statement counts, latencies and commits per report and
+    stage. Only one instance is active at a time, see install().
+    """
+    TOP_STATEMENTS = 5
+
+    def __init__(self, budget=None, echo=False):
+        self.budget = budget
+        self.echo = echo
+        self.reports = OrderedDict()
+        self._report = []
+        self._stage = []
+        self._lock = threading.Lock()
+
+    def install(self):
+        """
+        Wraps the CounterDb connection and backend and makes this the
+        active instrumentation.
+        """
+        global _active
+        if not isinstance(CounterDb.backend, InstrumentedBackend):
+            CounterDb.backend = InstrumentedBackend(CounterDb.backend)
+            CounterDb.conn = InstrumentedConnection(CounterDb.conn)
+        # Merge connections opened before are kept by the pool.
+        ParallelMerge._pool = [conn if isinstance(conn, InstrumentedConnection)
+            else InstrumentedConnection(conn) for conn in ParallelMerge._pool]
+        _active = self
+
+    def uninstall(self):
+        global _active
+        if isinstance(CounterDb.backend, InstrumentedBackend):
+            CounterDb.backend = CounterDb.backend.backend
+            CounterDb.conn = CounterDb.conn.conn
+        ParallelMerge._pool = [conn.conn if isinstance(conn, InstrumentedConnection)
+            else conn for conn in ParallelMerge._pool]
+        _active = None
+
+    def _current(self):
+        name = self._report[-1] if self._report else NO_REPORT
+        if name not in self.reports:
+            self.reports[name] = ReportStats(name)
+        return self.reports[name], self._stage[-1] if self._stage else 'other'
+
+    def record(self, sql, seconds, calls=1):
+        with self._lock:
+            stats, stage = self._current()
+            shapes = stats.statements.setdefault(stage, {})
+            shape = statement_shape(sql)
+            if shape not in shapes:
+                shapes[shape] = StatementStats()
+            shapes[shape].add(seconds, calls)
+
+    def record_commit(self):
+        with self._lock:
+            stats, stage = self._current()
+            stats.commits[stage] = stats.commits.get(stage, 0) + 1
+
+    def record_rollback(self):
+        with self._lock:
+            stats, stage = self._current()
+            stats.rollbacks += 1
+
+    def add_rows(self, rows):
+        with self._lock:
+            self._current()[0].rows += rows
+
+    def over_budget(self):
+        """
+        Returns the ReportStats of the reports over the budget.
+        """
+        if self.budget is None:
+            return []
+        return [stats for stats in self.reports.values()
+            if stats.per_1k_rows() is not None and stats.per_1k_rows() > self.budget]
+
+    def check_budget(self):
+        """
+        Raises StatementBudgetError if any report ran more statements per
+        1,000 rows than the budget.
+        """
+        over = self.over_budget()
+        if over:
+            raise StatementBudgetError('Over the budget of {0} statements per 1,000 rows:\n{1}'.format(
+                self.budget, '\n'.join(self.summary(stats.name) for stats in over)))
+
+    def summary(self, name):
+        """
+        Returns a report's counts by stage and its most frequent statement
+        shapes as text.
+        """
+        stats = self.reports[name]
+        per_1k = stats.per_1k_rows()
+        lines = ['  {0}: {1} rows, {2} statements{3}, {4} commits, {5:.2f} s in the database'.format(
+            name, stats.rows, stats.statement_count(),
+            ' ({0:.0f} per 1k rows{1})'.format(per_1k, ', OVER BUDGET' if stats in self.over_budget() else '')
+            if per_1k is not None else '', stats.commit_count(), stats.seconds())]
+        lines.append('    {0:<10} {1:>10} {2:>8} {3:>10}'.format('stage', 'statements', 'commits', 'ms'))
+        for stage in OrderedDict.fromkeys(list(stats.statements) + list(stats.commits)):
+            shapes = stats.statements.get(stage, {}).values()
+            lines.append('    {0:<10} {1:>10} {2:>8} {3:>10.1f}'.format(stage, sum(s.calls for s in shapes),
+                stats.commits.get(stage, 0), sum(s.seconds for s in shapes) * 1000))
+        top = sorted(((s.calls, s.seconds, stage, shape, s) for stage, shapes in stats.statements.items()
+            for shape, s in shapes.items()), key=lambda t: (-t[0], -t[1]))[:self.TOP_STATEMENTS]
+        lines.append('    {0:>7} {1:>10} {2:>8} {3:>8}  {4}'.format('calls', 'total ms', 'p50 ms', 'p95 ms',
+            'stage: statement'))
+        for calls, seconds, stage, shape, s in top:
+            lines.append('    {0:>7} {1:>10.1f} {2:>8} {3:>8}  {4}: {5}'.format(calls, seconds * 1000,
+                _bucket_label(s.percentile(50)), _bucket_label(s.percentile(95)), stage, shape[0:100]))
+        return '\n'.join(lines)
+
+
+def _bucket_label(bound):
+    return '<{0:g}'.format(bound) if bound != BUCKETS[-1] else '>{0:g}'.format(BUCKETS[-2])
+
+
+_active = None
+
+
+@contextmanager
+def report(name):
+    """
+    Attributes the statements run inside the block to the named report,
+    and prints its summary at the end of the block if the instrumentation
+    echoes.
+    """
+    if _active is None:
+        yield
+        return
+    instrumentation = _active
+    instrumentation._report.append(name)
+    try:
+        yield
+    finally:
+        instrumentation._report.pop()
+        if instrumentation.echo and name in instrumentation.reports:
+            print(instrumentation.summary(name))
+
+
+@contextmanager
+def stage(name):
+    """
+    Attributes the statements run inside the block to the named stage of
+    the current report.
+    """
+    if _active is None:
+        yield
+        return
+    instrumentation = _active
+    instrumentation._stage.append(name)
+    try:
+        yield
+    finally:
+        instrumentation._stage.pop()
+
+
+def add_rows(rows):
+    """
+    Adds to the data rows of the current report, the base of its budget.
+    """
+    if _active is not None:
+        _active.add_rows(rows)
+
+
+def _counted(thread):
+    return _active is not None and not isinstance(thread, Heartbeat)
+
+
+class InstrumentedBackend:
+    """
+    Wraps a storage backend so that the connections it opens are
+    instrumented too.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def connect(self):
+        return InstrumentedConnection(self.backend.connect())
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+class InstrumentedConnection:
+    """
+    Wraps a connection, counting commits and rollbacks and handing out
+    instrumented cursors.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self.conn.cursor(*args, **kwargs))
+
+    def commit(self):
+        if _counted(threading.current_thread()):
+            _active.record_commit()
+        self.conn.commit()
+
+    def rollback(self):
+        if _counted(threading.current_thread()):
+            _active.record_rollback()
+        self.conn.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class InstrumentedCursor:
+    """
+    Wraps a cursor, timing each execute. An executemany counts as one
+    statement for an INSERT and as one per parameter set otherwise.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def _timed(self, method, sql, *args, calls=1):
+        start = time.perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            if _counted(threading.current_thread()) and calls:
+                _active.record(sql, time.perf_counter() - start, calls)
+
+    def execute(self, sql, *args, **kwargs):
+        return self._timed(lambda s, *a: self.cursor.execute(s, *a, **kwargs), sql, *args)
+
+    def executemany(self, sql, seq_params):
+        seq_params = list(seq_params)
+        calls = len(seq_params)
+        if sql.lstrip().upper().startswith('INSERT'):
+            calls = min(calls, 1)
+        return self._timed(self.cursor.executemany, sql, seq_params, calls=calls)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
@@ -0,0 +1,241 @@
+import openpyxl
+
+import os
+from datetime import datetime
+
+from dataloader.normalize import item_key
+from dataloader.records import ItemMetricRecord, ItemRecord, cell_text
+
+class ItemMasterReport:
+    """
+    Represents an Item Master Report.
+
+    This class loads the Item Master Report (IR) and its standard views for
+    journal articles (IR_A1) and multimedia (IR_M1). The header block is the
+    same as for the Title Master Report, but item reports are far larger, so
+    nothing here holds more than one row in memory: the worksheet is opened
+    read-only and every method works from a single streaming pass.
+    """
+
+    ACCESS_TYPE = {'Controlled': 1, 'OA_Gold': 2, 'Other_Free_To_Read': 3}
+    ACCESS_METHOD = {'Regular': 1, 'TDM': 2}
+    METRIC_TYPE = {'Total_Item_Investigations': 1, 'Total_Item_Requests': 2, 'Unique_Item_Investigations': 3,
+        'Unique_Item_Requests': 4, 'Unique_Title_Investigations': 5, 'Unique_Title_Requests': 6,
+        'Limit_Exceeded': 7, 'No_License': 8}
+    # Data_Type is only a column in the full IR; the standard views each
+    # cover a single data type.
+    DATA_TYPE = {'IR_A1': 'Article', 'IR_M1': 'Multimedia'}
+    MAX_ROWS = 1048576
+    HEADER_ROW = 14
+    DATA_ROW_START = 15
+
+    def __init__(self, workbook, book=None):
+        """
+        Opens the report at path workbook, or uses book, the same workbook
+        already opened read-only.
+        """
+        self._workbook = book or openpyxl.load_workbook(filename=workbook, data_only=True, read_only=True)
+        self._worksheet = self._workbook.active
+        self._report_id = self._worksheet.cell(row=2, column=2).value
+        self._reporting_period = self._worksheet.cell(row=10, column=2).value
+        self._run_date = self._worksheet.cell(row=11, column=2).value
+        self._platform = self._worksheet.cell(row=15, column=4).value
+        self._filename = os.path.basename(workbook)
+        self._dirname = os.path.dirname(workbook)
+        assert self._report_id in ['IR', 'IR_A1', 'IR_M1']
+
+        # Row count and validation results are gathered in one pass over
+        # the sheet, the first time any of them is needed.
+        self._num_rows = None
+        self._platform_names = None
+        self._invalid_rows = None
+
+    def _scan(self):
+        """
+        Counts the data rows and records the platforms used and the rows
+        missing one of Item, Platform or Metric_Type.
+        """
+        if self._num_rows is not None:
+            return
+        columns = self._column_index()
+        required = [columns[name] for name in ['Item', 'Platform', 'Metric_Type']]
+        platform_col = columns['Platform']
+        platform_names = set()
+        invalid_rows = []
+        n = 0
+        for row_num, values in self._iter_data_rows():
+            if any(values[i] is None for i in required):
+                invalid_rows.append(row_num)
+            if values[platform_col] is not None:
+                platform_names.add(values[platform_col])
+            n += 1
+        self._num_rows = n
+        self._platform_names = sorted(platform_names)
+        self._invalid_rows = invalid_rows
+
+    def has_valid_platforms(self, platform_names):
+        return len(self.get_invalid_platforms(platform_names)) == 0
+
+    def get_invalid_platforms(self, platform_names):
+        self._scan()
+        return [name for name in self._platform_names if name not in platform_names]
+
+    def has_all_valid_rows(self):
+        return len(self.get_invalid_rows()) == 0
+
+    def get_invalid_rows(self):
+        self._scan()
+        return self._invalid_rows
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @filename.setter
+    def filename(self, filename):
+        self._filename = filename
+
+    @property
+    def report_id(self):
+        return self._report_id
+
+    @property
+    def begin_date(self):
+        kv_pair = self._reporting_period.split(';')[0]
+        return kv_pair.split('=')[1]
+
+    @property
+    def end_date(self):
+        kv_pair = self._reporting_period.split(';')[1]
+        return kv_pair.split('=')[1]
+
+    @property
+    def run_date(self):
+        if self._run_date is None:
+            return '0000-00-00'
+        else:
+            return str(self._run_date)[0:10]
+
+    @property
+    def platform(self):
+        return self._platform
+
+    @property
+    def row_count(self):
+        return self.num_rows()
+
+    def num_rows(self):
+        self._scan()
+        return self._num_rows
+
+    def data_rows(self):
+        """
+        Returns the range of data rows, starting at row 15.
+        """
+        return range(self.DATA_ROW_START, self.DATA_ROW_START + self.num_rows())
+
+    def close(self):
+        self._workbook.close()
+
+    def print_stats(self):
+        """
+        Report worthwhile statistics for the report
+        """
+        dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+        print(" found {0:>6} rows ({1}).".format(self.num_rows(), dt_string), end='')
+
+    def _column_index(self):
+        """
+        Returns a dict mapping the column names in the header row to their
+        position in a data row.
+        """
+        header = next(self._worksheet.iter_rows(min_row=self.HEADER_ROW, max_row=self.HEADER_ROW,
+            values_only=True))
+        index = {}
+        for i, name in enumerate(header):
+            if name is None:
+                break
+            index[str(name).strip()] = i
+        return index
+
+    def _iter_data_rows(self):
+        """
+        Yields (row number, cell values) for each data row. The data ends at
+        the first row with a blank first cell.
+        """
+        row_num = self.DATA_ROW_START
+        for values in self._worksheet.iter_rows(min_row=self.DATA_ROW_START, min_col=1,
+            max_row=self.MAX_ROWS, values_only=True):
+            if values[0] is None:
+                break
+            yield row_num, values
+            row_num += 1
+
+    def iter_records(self):
+        """
+        Yields an (ItemRecord, [ItemMetricRecord, ...]) pair for each data
+        row, with one metric record per month in the reporting period.
+
+        Columns that a standard view leaves out take their fixed values:
+        Access_Type is Controlled, Access_Method is Regular and Data_Type
+        follows from the Report_ID.
+        """
+        columns = self._column_index()
+        report_begin = datetime.fromisoformat(self.begin_date)
+        report_end = datetime.fromisoformat(self.end_date)
+        periods = [datetime(report_begin.year, i, 1).strftime('%Y-%m-%d')
+            for i in range(report_begin.month, report_end.month + 1)]
+        first_month = columns['Reporting_Period_Total'] + 1
+        default_data_type = self.DATA_TYPE.get(self._report_id, '')
+
+        def get(values, name, default=''):
+            if name not in columns:
+                return default
+            return cell_text(values[columns[name]])
+
+        for row_num, values in self._iter_data_rows():
+            item = ItemRecord(
+                item=get(values, 'Item'),
+                data_type=get(values, 'Data_Type', default_data_type),
+                publisher=get(values, 'Publisher'),
+                publisher_id=get(values, 'Publisher_ID'),
+                platform=get(values, 'Platform'),
+                authors=get(values, 'Authors'),
+                publication_date=get(values, 'Publication_Date'),
+                article_version=get(values, 'Article_Version'),
+                doi=get(values, 'DOI'),
+                proprietary_id=get(values, 'Proprietary_ID'),
+                isbn=get(values, 'ISBN'),
+                print_issn=get(values, 'Print_ISSN'),
+                online_issn=get(values, 'Online_ISSN'),
+                uri=get(values, 'URI'),
+                parent_title=get(values, 'Parent_Title'),
+                parent_data_type=get(values, 'Parent_Data_Type'),
+                parent_doi=get(values, 'Parent_DOI'),
+                parent_proprietary_id=get(values, 'Parent_Proprietary_ID'),
+                parent_isbn=get(values, 'Parent_ISBN'),
+                parent_print_issn=get(values, 'Parent_Print_ISSN'),
+                parent_online_issn=get(values, 'Parent_Online_ISSN'),
+                parent_uri=get(values, 'Parent_URI'),
+                yop=get(values, 'YOP'),
+                item_key=None)
+            key = item_key(item.item, item.publisher, item.doi, item.proprietary_id, item.isbn,
+                item.print_issn, item.online_issn, item.parent_title, item.data_type, item.yop)
+            item = item._replace(item_key=key)
+
+            access_type = self.ACCESS_TYPE[get(values, 'Access_Type', 'Controlled')]
+            access_method = self.ACCESS_METHOD[get(values, 'Access_Method', 'Regular')]
+            metric_type = self.METRIC_TYPE[get(values, 'Metric_Type')]
+
+            metrics = []
+            for n, period in enumerate(periods):
+                # If monthly total is missing, treat it as "zero"
+                value = values[first_month + n]
+                if not value:
+                    month_total = 0
+                else:
+                    month_total = int(float(value)) # float conversion deals with cases of '0.0'
+                metrics.append(ItemMetricRecord(item.platform, key, access_type, access_method,
+                    metric_type, period, month_total))
+
+            yield item, metrics
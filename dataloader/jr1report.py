@@ -1,9 +1,11 @@
 import openpyxl
 import collections
-import os, csv
+import os
 from datetime import datetime
 
-class JR1Report:
+from dataloader.records import MetricRecord, RecordStream, TitleRecord, cell_text
+
+class JR1Report(RecordStream):
     """
     Represents the JR1 report spreadsheet.
 
@@ -161,88 +163,61 @@ class JR1Report:
 
         return row_spec._make(datarow)
     
-    def export(self):
-        """
-        Prepares text files of the raw spreadsheet data for bulk import into the DB. Two separate
-        files are generated (titles and metrics):
-
-        - title_report_temp
-        - metric_temp
-        
-        Both files are Excel tab delimited format, which are subsequently loaded with mysqlimport.
-        """
-        
-        # Start with titles data.
-        title_report_temp = '{0}/title_report_temp'.format(self._dirname)
-        with open(title_report_temp, 'w', newline='', encoding='utf-8') as csvfile:
-            csvwriter = csv.writer(csvfile, dialect='excel-tab', lineterminator='\n')
-        
-            # Iterate through the spreadsheet rows starting at the first data row (row 10). Only the
-            # first 7 columns are included in the export for titles data.
-            datarows = self.data_rows() # Range of rows in the spreadsheet.
-            row_num = min(datarows) # Spreadsheet row number.
-            for row in self._worksheet.iter_rows(min_row=min(datarows), min_col=1, max_row=max(datarows), max_col=7):
-                # Start building a list of field values. The actual fields and their sequence
-                # must correspond to the title_report_temp table. See schema for details.
-                datarow = list()
-                datarow.append('null') # id
-                i = 0
-                while i <= len(row):
-                    if i == 1:
-                        datarow.append(self.title_type) # title_type
-                    if i == 2:
-                        datarow.append('') # publisher_id
-                    if i == 5:
-                        datarow.append('') # isbn
-                    if i == 7:
-                        datarow.append('') # uri
-                        datarow.append('') # yop
-                        break
-                    if row[i].value is None:
-                        datarow.append('') # cell is blank
-                    else:
-                        datarow.append(str(row[i].value).strip())
-                    i += 1
-                datarow.append(self._filename) # excel_name
-                datarow.append(row_num) # row_num
-                datarow.append(0) # title_report_id
-                csvwriter.writerow(datarow)
-                row_num += 1
-
-        # Export metrics.
-        metric_temp = '{0}/metric_temp'.format(self._dirname)
-        with open(metric_temp, 'w', newline='', encoding='utf-8') as csvfile:
-            csvwriter = csv.writer(csvfile, dialect='excel-tab', lineterminator='\n')
-
-            # Grab the report begin and end dates, which are needed to generate the report periods.
+    def _periods(self):
+        if getattr(self, '_period_list', None) is None:
             report_begin = datetime.fromisoformat(self.begin_date)
             report_end = datetime.fromisoformat(self.end_date)
+            self._period_list = [datetime(report_begin.year, i, 1).strftime('%Y-%m-%d')
+                for i in range(report_begin.month, report_end.month + 1)]
+        return self._period_list
 
-            # Iterate through the spreadsheet rows starting at the first data row (row 10). For metrics,
-            # the first applicable report column is 11 and extends to the number of months in the report.
-            datarows = self.data_rows()
-            row_num = min(datarows)
-            for row in self._worksheet.iter_rows(min_row=min(datarows), min_col=11, max_row=max(datarows), max_col=report_end.month+10):
-                # A row will be inserted for each month column in the source
-                # spreadsheet. The actual number of months is determined from
-                # the start and end dates contained in the report header.
-                n = 0
-                for i in range(report_begin.month, report_end.month + 1):
-                    period = datetime(report_begin.year, i, 1).strftime('%Y-%m-%d')
-                    period_total = int(float(row[n].value)) # float conversion deals with cases of '0.0'
-
-                    # Start building a list of field values. The actual fields and their sequence
-                    # must correspond to the title_report_temp table. See schema for details.
-                    datarow = list()
-                    datarow.append('null') # id
-                    datarow.append(0) # title_report_id
-                    datarow.append(self.title_type) # title_type
-                    datarow.append(1) # access_type --> defaults to Controlled
-                    datarow.append(2) # metric_type --> defaults to Total_Item_Requests
-                    datarow.append(period)
-                    datarow.append(period_total)
-                    datarow.append(self._filename)
-                    datarow.append(row_num)
-                    csvwriter.writerow(datarow)
-                    n += 1
-                row_num += 1
+    def iter_data_rows(self):
+        """
+        Yields (row number, cell values) for each row of publication data.
+        """
+        max_col = datetime.fromisoformat(self.end_date).month + 10
+        row_num = self.DATA_ROW_START
+        for values in self._worksheet.iter_rows(min_row=self.DATA_ROW_START, min_col=1,
+            max_row=self.MAX_ROWS, max_col=max_col, values_only=True):
+            if values[0] is None: # Done when the first cell in the row is blank
+                break
+            yield row_num, values
+            row_num += 1
+
+    def convert_row(self, row_num, values):
+        """
+        Returns the (TitleRecord, [MetricRecord, ...]) pair for a row of
+        publication data.
+
+        The JR1 layout is fixed: the first 7 columns hold the title data and
+        the month columns start at column 11. To force compatibility with the
+        R5 specification, the columns missing from JR1 (publisher_id, isbn,
+        uri and yop) are left blank. All usage is recorded as Controlled
+        access and Total_Item_Requests. A blank month counts as zero; a
+        count that is not a number raises ValueError.
+        """
+        title = TitleRecord(
+            title=cell_text(values[0]),
+            title_type=self.title_type,
+            publisher=cell_text(values[1]),
+            publisher_id='',
+            platform=cell_text(values[2]),
+            doi=cell_text(values[3]),
+            proprietary_id=cell_text(values[4]),
+            isbn='',
+            print_issn=cell_text(values[5]),
+            online_issn=cell_text(values[6]),
+            uri='',
+            yop='',
+            excel_name=self._filename,
+            row_num=row_num,
+            title_key=None)
+
+        metrics = []
+        for n, period in enumerate(self._periods()):
+            value = values[10 + n]
+            period_total = int(float(value)) if value not in (None, '') else 0 # float conversion deals with cases of '0.0'
+            metrics.append(MetricRecord(self.title_type, 1, 2, period, period_total,
+                self._filename, row_num)) # access_type Controlled, metric_type Total_Item_Requests
+
+        return title, metrics
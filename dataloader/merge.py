@@ -0,0 +1,162 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dataloader.counter_db import CounterDb, MetricTable, TitleClusterTable, TitleReportTable
+
+
+# Merges the temp tables into title_report and metric over several database
+# connections at once, so the merge of a large report is not limited to
+# one server thread. Set
+#
+#   merge_connections = 4
+#
+# in dataloader/config.py (or pass --merge-connections to loader.py). With
+# the default of 1, the merge runs on CounterDb.conn as before.
+#
+# The staged rows are split into as many partitions as there are
+# connections, and each partition is merged in its own transaction:
+#
+#   - titles by title_key range. title_key is a hex SHA-1, so a range of
+#     keys is a contiguous slice of the unique (platform_id, title_key)
+#     index within each platform.
+#   - metrics by title_report_id range, once title ids are known.
+#
+# Partitions never share a row, and each worker takes its locks in index
+# order, so workers can only meet at the edges of their ranges. A worker
+# picked as a deadlock victim (or timing out on a lock) rolls back and
+# retries its partition after a randomized backoff, up to MAX_ATTEMPTS.
+# Every step is an upsert, so rerunning a partition is harmless, and so is
+# rerunning the whole merge after a failure.
+
+class ParallelMerge(CounterDb):
+    """
+    Merges the title and metric temp tables with a pool of connections.
+
+    The connections are opened on first use and shared by all instances,
+    so a long-running loader opens them once. Title clusters and the title
+    id cache are updated from the main connection once every title
+    partition has committed.
+    """
+    MAX_ATTEMPTS = 5
+    RETRY_DELAY = 0.2
+    _pool = []
+
+    def __init__(self, connections):
+        self._n = connections
+        while len(ParallelMerge._pool) < connections:
+            ParallelMerge._pool.append(CounterDb.backend.connect())
+        for conn in ParallelMerge._pool[:connections]:
+            CounterDb.backend.ping(conn)
+
+    @classmethod
+    def close_pool(cls):
+        for conn in ParallelMerge._pool:
+            conn.close()
+        ParallelMerge._pool = []
+
+    def _run(self, conn, work, *args):
+        """
+        Runs work(cursor, *args) in a transaction on conn, retrying it when
+        the backend reports a deadlock or lock timeout.
+        """
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            try:
+                result = work(conn.cursor(), *args)
+                conn.commit()
+                return result
+            except Exception as e:
+                conn.rollback()
+                if attempt == self.MAX_ATTEMPTS or not CounterDb.backend.is_retryable(e):
+                    raise
+                print('  retrying merge partition after: {0}'.format(e))
+                time.sleep(self.RETRY_DELAY * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+    def _map(self, work, partitions):
+        """
+        Runs work on each non-empty partition, one connection per partition,
+        and returns the results in partition order.
+        """
+        tasks = [args for args in partitions if args[0]]
+        if len(tasks) <= 1:
+            return [self._run(ParallelMerge._pool[0], work, *args) for args in tasks]
+        with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+            futures = [executor.submit(self._run, conn, work, *args)
+                for conn, args in zip(ParallelMerge._pool, tasks)]
+            return [future.result() for future in futures]
+
+    def merge_titles(self, load_id):
+        """
+        Upserts title_report_temp into title_report, partitioned by
+        title_key range, and tags the titles with load_id. Returns the
+        number of staged title rows.
+        """
+        # The workers share the title id cache, so it is checked here on
+        # the main connection before they start.
+        trt = TitleReportTable()
+        trt.check_cache()
+        cursor = CounterDb.conn.cursor(named_tuple=True)
+        cursor.execute('SELECT * FROM title_report_temp')
+        rows = cursor.fetchall()
+        platform_ids = trt.platform_ids(rows)
+
+        partitions = [[] for i in range(self._n)]
+        for row in rows:
+            sort_key = (platform_ids[row.platform] or 0, row.title_key)
+            partitions[int(row.title_key[0:8], 16) * self._n >> 32].append((sort_key, row))
+        partitions = [([row for sort_key, row in sorted(p, key=lambda r: r[0])], platform_ids)
+            for p in partitions]
+
+        new_ids = {}
+        new_titles = []
+        for ids, titles in self._map(trt.upsert_rows, partitions):
+            new_ids.update(ids)
+            new_titles.extend(titles)
+
+        # Clusters may span partitions, so they are added in one go.
+        trt.tag(CounterDb.conn.cursor(), load_id)
+        TitleClusterTable().add(new_titles)
+        CounterDb.conn.commit()
+        trt.cache_ids(new_ids)
+        return len(rows)
+
+    def merge_metrics(self, load_id):
+        """
+        Upserts the metric temp table into metric (or metric_wide),
+        partitioned by title_report_id range, and tags the rows with
+        load_id. Returns the number of staged metric rows.
+        """
+        mt = MetricTable()
+        cursor = CounterDb.conn.cursor()
+        mt.set_title_ids(cursor)
+        CounterDb.conn.commit()
+
+        # Split the staged title ids into ranges with about the same number
+        # of rows each.
+        cursor.execute(u"SELECT title_report_id, COUNT(*) FROM {0} \
+            WHERE title_report_id IS NOT NULL \
+            GROUP BY title_report_id ORDER BY title_report_id".format(self.metric_temp_table()))
+        counts = cursor.fetchall()
+        total = sum(n for title_id, n in counts)
+        ranges = []
+        low = None
+        rows = 0
+        for title_id, n in counts:
+            low = title_id if low is None else low
+            rows += n
+            if rows >= total * (len(ranges) + 1) / self._n:
+                ranges.append((low, title_id))
+                low = None
+        if low is not None:
+            ranges.append((low, counts[-1][0]))
+
+        sql = mt.merge_sql(partitioned=True)
+        self._map(lambda cursor, bounds: cursor.execute(sql, (load_id,) + bounds), [(r,) for r in ranges])
+        return total
+
+    def run(self, load_id):
+        """
+        Merges both temp tables, tagging the rows with load_id. Returns the
+        number of title and metric rows merged.
+        """
+        return self.merge_titles(load_id), self.merge_metrics(load_id)
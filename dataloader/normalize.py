@@ -0,0 +1,175 @@
+import hashlib
+import html
+import sys
+import unicodedata
+
+
+# Separator placed between the fields of a title key. It cannot appear in
+# spreadsheet text, so adjacent fields can never run together.
+KEY_SEPARATOR = '\x1f'
+
+# Most reports name a few dozen publishers thousands of times, so their
+# normalized forms are kept across batches, up to PUBLISHER_CACHE_SIZE.
+PUBLISHER_CACHE_SIZE = 50000
+_publishers = {}
+
+
+def normalize_title(title):
+    """
+    Returns the title as it is stored in the title_report table. HTML
+    entities are unescaped twice, because some vendors double escape them.
+    """
+    if title is None:
+        return ''
+    return html.unescape(html.unescape(title))
+
+
+def normalize_publisher(publisher):
+    """
+    Returns the publisher as it is stored in the title_report table. The
+    publisher is set to Not Defined when it is blank or contains '???'.
+    """
+    if publisher is None or '???' in publisher or publisher == '':
+        return 'Not Defined'
+    return html.unescape(html.unescape(publisher))
+
+
+def _key_part(value):
+    """
+    Reduces a single field to the form used in a title key: Unicode NFKC,
+    case folded and with runs of whitespace collapsed.
+    """
+    if value is None:
+        return ''
+    value = unicodedata.normalize('NFKC', str(value))
+    return ' '.join(value.casefold().split())
+
+
+def record_key(*parts):
+    """
+    Returns a 40 character hex digest of the given fields after reducing
+    each of them with _key_part.
+    """
+    parts = [_key_part(part) for part in parts]
+    return hashlib.sha1(KEY_SEPARATOR.join(parts).encode('utf-8')).hexdigest()
+
+
+def title_key(title, publisher, isbn, yop):
+    """
+    Returns the dedup key for a title as a 40 character hex string.
+
+    The key covers the same data elements as the original duplicate check
+    (title, publisher, isbn and yop). Platform is deliberately left out,
+    because it is stored as platform_id and forms the other half of the
+    unique index on title_report. Title and publisher are normalized the
+    same way as the stored values, so an escaped title in a new report
+    matches the unescaped title already in the table.
+    """
+    return normalized_title_key(normalize_title(title), normalize_publisher(publisher), isbn, yop)
+
+
+def normalized_title_key(title, publisher, isbn, yop):
+    """
+    Returns title_key for a title and publisher already normalized with
+    normalize_title and normalize_publisher.
+    """
+    isbn = '' if isbn is None else str(isbn).replace('-', '')
+    return record_key(title, publisher, isbn, yop)
+
+
+def _normalize_column(values, normalize, cache):
+    """
+    Returns the normalized form of a column of values. Each distinct value
+    is normalized once; results are interned, so repeated strings share a
+    single object, and kept in cache for later calls.
+    """
+    column = {}
+    for value in set(values):
+        normalized = cache.get(value)
+        if normalized is None:
+            normalized = sys.intern(normalize(value))
+            if len(cache) >= PUBLISHER_CACHE_SIZE:
+                cache.clear()
+            cache[value] = normalized
+        column[value] = normalized
+    return [column[value] for value in values]
+
+
+def normalize_titles(titles):
+    """
+    Returns a batch of TitleRecords in the canonical form that is staged
+    and stored: title and publisher normalized and title_key set. Works
+    column by column over the distinct values of the batch, so a title
+    repeated for each metric type is only normalized and keyed once.
+    """
+    names = _normalize_column([t.title for t in titles], normalize_title, {})
+    publishers = _normalize_column([t.publisher for t in titles], normalize_publisher, _publishers)
+    keys = {}
+    records = []
+    for t, name, publisher in zip(titles, names, publishers):
+        parts = (name, publisher, t.isbn, t.yop)
+        key = keys.get(parts)
+        if key is None:
+            key = keys[parts] = normalized_title_key(*parts)
+        records.append(t._replace(title=name, publisher=publisher, title_key=key))
+    return records
+
+
+def item_key(item, publisher, doi, proprietary_id, isbn, print_issn, online_issn,
+    parent_title, data_type, yop):
+    """
+    Returns the dedup key for an item (article, chapter, multimedia item)
+    in an Item Master Report. As with title_key, the platform is kept out
+    of the key and stored alongside it as platform_id.
+    """
+    isbn = '' if isbn is None else str(isbn).replace('-', '')
+    return record_key(normalize_title(item), normalize_publisher(publisher), doi,
+        proprietary_id, isbn, print_issn, online_issn, normalize_title(parent_title),
+        data_type, yop)
+
+
+def issn_key(issn):
+    """
+    Returns the normalized form of an ISSN (eight characters, no hyphen,
+    upper case check digit), or None if the value is not an ISSN.
+    """
+    if issn is None:
+        return None
+    value = str(issn).strip().upper().replace('-', '').replace(' ', '')
+    if len(value) != 8 or not value[:7].isdigit() or not (value[7].isdigit() or value[7] == 'X'):
+        return None
+    return value
+
+
+def isbn_key(isbn):
+    """
+    Returns the ISBN-13 form of an ISBN-10 or ISBN-13, without hyphens, or
+    None if the value is not an ISBN. ISBN-10s are converted so the two
+    forms of the same book match.
+    """
+    if isbn is None:
+        return None
+    value = str(isbn).strip().upper().replace('-', '').replace(' ', '')
+    if len(value) == 10 and value[:9].isdigit() and (value[9].isdigit() or value[9] == 'X'):
+        value = '978' + value[:9]
+        total = sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(value))
+        return value + str((10 - total % 10) % 10)
+    if len(value) == 13 and value.isdigit():
+        return value
+    return None
+
+
+def identifier_keys(print_issn, online_issn, isbn):
+    """
+    Returns the normalized identifier keys of a title, used to cluster the
+    same journal or book across platforms, e.g. ['issn:12345678'].
+    """
+    keys = []
+    for issn in (print_issn, online_issn):
+        key = issn_key(issn)
+        if key is not None and 'issn:' + key not in keys:
+            keys.append('issn:' + key)
+    key = isbn_key(isbn)
+    if key is not None:
+        keys.append('isbn:' + key)
+    return keys
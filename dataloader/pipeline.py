@@ -0,0 +1,583 @@
+import json
+import os
+import traceback
+from datetime import datetime
+
+from dataloader.counter_db import CounterDb, BulkImport, TitleReportTable, MetricTable, ReportInventoryTable, \
+    ItemReportTable, PlatformTable, QuarantineTable, StagingLock, TempTableSink, Heartbeat
+from dataloader import instrument
+from dataloader.irreport import ItemMasterReport
+from dataloader.jr1report import JR1Report
+from dataloader.merge import ParallelMerge
+from dataloader.preprocess import check_report, sniff_report, target_name
+from dataloader.reconcile import can_reconcile, format_reconciliation, is_reconciled, reconcile
+from dataloader.records import ReplayStream, TsvSink
+from dataloader.sushi import SushiReport
+from dataloader.tmreport import TitleMasterReport
+from dataloader.textreport import TextTitleMasterReport
+
+
+# The steps for loading a single report, shared by loader.py and the
+# SUSHI harvester. Each step advances the report's load_job row, see
+# LoadJobTable for the states.
+#
+# Several processes may load at once. Each writes its text files to its
+# own staging directory, and the steps that use the shared temp tables,
+# from bulk import to merge, run under the StagingLock.
+#
+# Rows that cannot be converted are saved to the quarantine table while
+# the rest of the report loads; replay_quarantine() loads them later.
+#
+# For large backfills, run_batch() loads many title reports with a single
+# staging cycle instead, see load_batch(). watch_reports() loads files as
+# they arrive, see watch-reports.py. ingest_file() checks, renames and
+# loads a vendor file as delivered, see ingest-reports.py.
+#
+# The statements of each load are attributed to the report and to its
+# stage (open, export, import, merge, inventory, verify) for
+# dataloader.instrument.
+
+def open_report(f):
+    """
+    Instantiates the report instance according to the report version,
+    i.e. COUNTER R4 or R5.
+    """
+    if os.path.basename(f).startswith('jr'):
+        return JR1Report(f)
+    if os.path.basename(f).startswith('tr') and f.endswith(('.tsv', '.csv')):
+        return TextTitleMasterReport(f)
+    if os.path.basename(f).startswith('tr'):
+        return TitleMasterReport(f)
+    if os.path.basename(f).startswith('ir'):
+        return ItemMasterReport(f)
+    if os.path.basename(f).startswith('sushi'):
+        return SushiReport(f)
+    raise ValueError('Unrecognized report file name: {0}'.format(f))
+
+
+def staging_sink(stagedir):
+    """
+    Returns the sink writing the temp table text files for the configured
+    metric layout.
+    """
+    return TsvSink(stagedir, wide=CounterDb.metric_layout == 'wide')
+
+
+def merge_staged(load_id):
+    """
+    Merges the temp tables into title_report and metric, over several
+    connections when merge_connections is configured. The rows are tagged
+    with load_id, the report's inventory id.
+    """
+    if CounterDb.merge_connections > 1:
+        ParallelMerge(CounterDb.merge_connections).run(load_id)
+    else:
+        TitleReportTable().insert_from_temp(load_id)
+        MetricTable().insert_from_temp(load_id)
+
+
+def export_report(report, reportdir, sink):
+    """
+    Writes the report records to the sink and saves any quarantined rows.
+    """
+    report.export(sink)
+    save_quarantined(report, reportdir)
+
+
+def save_quarantined(report, reportdir):
+    quarantined = report.quarantined_rows()
+    if quarantined:
+        print('  {0} rows quarantined'.format(len(quarantined)))
+        QuarantineTable().insert(reportdir, quarantined)
+
+
+def load_report(report, reportdir, job, jobs, direct=False, stagedir=None, exported=False):
+    """
+    Loads a single report, advancing its job through the load states.
+    Steps the job already completed in an earlier run are skipped.
+
+    With direct set, records are written straight into the temp tables
+    instead of going through text files and mysqlimport. Otherwise the
+    text files are written to stagedir, by default the report directory.
+    With exported set, they were just written there (see ingest_file) and
+    the export step is skipped.
+    """
+    stagedir = stagedir or reportdir
+    if isinstance(report, ItemMasterReport):
+        load_item_report(report, stagedir, job, jobs)
+        return
+
+    inv = ReportInventoryTable()
+    bi = BulkImport(stagedir)
+
+    # The started_at time of an interrupted job is kept, so the inventory
+    # reflects when the load of this report actually began.
+    load_start = (job.started_at or datetime.now()).isoformat()
+
+    state = 'parsed' if exported else job.state
+    if state in ('queued', 'parsed') and not direct and not exported:
+        # Process the data in the spreadsheet. The method currently
+        # used relies on the use of temporary tables that are bulk
+        # loaded from CSV versions of the spreadsheet data. Inserts
+        # and updates are then handled from the temps.
+        # First step is to export title and metric data from the report
+        # into equivalent CSV files.
+        with instrument.stage('export'):
+            export_report(report, reportdir, staging_sink(stagedir))
+            jobs.set_state(job.id, 'parsed')
+        state = 'parsed'
+
+    # The inventory row records the row count, which the export pass has
+    # just taken, if there was one.
+    with instrument.stage('inventory'):
+        load_id = inv.start(report, load_start)
+
+    with StagingLock():
+        # The temp tables are shared by all reports, so a job can only
+        # resume after the import if its rows are still the ones staged.
+        if state in ('staged', 'merged') and not bi.is_staged(report.filename):
+            state = 'queued' if direct else 'parsed'
+            if not direct:
+                with instrument.stage('export'):
+                    export_report(report, reportdir, staging_sink(stagedir))
+
+        if state in ('queued', 'parsed'):
+            with instrument.stage('import'):
+                if direct:
+                    export_report(report, reportdir, TempTableSink())
+                    jobs.set_state(job.id, 'parsed')
+                else:
+                    # Next step is bulk importing of CSV files into temp tables.
+                    bi.import_all()
+                # A report whose rows were all quarantined has nothing to stage.
+                expected = len(report.data_rows()) > len(report.quarantined_rows())
+                if expected and not bi.is_staged(report.filename):
+                    raise OSError('{0} was not imported into the temp tables'.format(report.filename))
+                jobs.set_state(job.id, 'staged')
+            state = 'staged'
+
+        if state == 'staged':
+            # Perform inserts into main tables from the temps.
+            with instrument.stage('merge'):
+                merge_staged(load_id)
+                jobs.set_state(job.id, 'merged')
+
+    # Finally, update the report inventory.
+    with instrument.stage('inventory'):
+        load_end = datetime.now().isoformat()
+        inv.finish(load_id, report, load_start, load_end)
+        jobs.set_state(job.id, 'done')
+    instrument.add_rows(len(report.data_rows()))
+
+
+def merge_rounds(reports):
+    """
+    Splits reports into rounds whose metric rows can be merged in one
+    statement each: no two reports in a round are for the same platform
+    and overlapping months. Platforms are compared by id, so reports that
+    name a platform by different aliases still overlap. A report goes in
+    the round after the last one holding a report it overlaps, so
+    overlapping reports are merged in load order, and the last one wins as
+    in separate loads.
+    """
+    resolver = PlatformTable().get_resolver()
+    def platform(report):
+        platform_id = resolver.resolve(report.platform)
+        return report.platform if platform_id is None else platform_id
+
+    rounds = []
+    for report in reports:
+        after = -1
+        for i, merged in enumerate(rounds):
+            if any(platform(other) == platform(report) and other.begin_date <= report.end_date
+                    and report.begin_date <= other.end_date for other in merged):
+                after = i
+        if after + 1 == len(rounds):
+            rounds.append([])
+        rounds[after + 1].append(report)
+    return rounds
+
+
+def load_batch(reports, reportdir, jobs, stagedir, verify=False):
+    """
+    Loads several title reports, given as (job, report) pairs, with one
+    staging cycle: the reports are exported to the same text files and
+    bulk imported together, every distinct title is upserted once for the
+    whole batch (see TitleReportTable.insert_batch_from_temp), and metrics
+    are merged in a few set-based statements (see merge_rounds).
+
+    Each report still gets its own inventory row, load id and job state.
+    A report that fails to export is left out of the batch. If the batch
+    merge fails, its reports are loaded one at a time, so a bad file only
+    fails itself, and what was merged for it is taken back out (see
+    discard_load). With verify set, each report is reconciled right after
+    its merge, before a later report in the batch can overwrite its usage.
+
+    Returns the file names of the reports loaded, a list of (job,
+    traceback) pairs for those that failed, and the reconciliation
+    summaries of those verify found differences in.
+    """
+    inv = ReportInventoryTable()
+    bi = BulkImport(stagedir)
+    failed = {}
+    exported = []
+    messages = []
+    sink = staging_sink(stagedir)
+    with instrument.stage('export'):
+        for job, report in reports:
+            try:
+                # export() would close the shared sink after the first report.
+                for title, metrics in report.iter_records():
+                    sink.write(title, metrics)
+                save_quarantined(report, reportdir)
+                jobs.set_state(job.id, 'parsed')
+                exported.append((job, report))
+            except Exception:
+                failed[report.filename] = (job, traceback.format_exc())
+        sink.close()
+
+    staged = []
+    with StagingLock():
+        with instrument.stage('import'):
+            bi.import_all()
+            bi.discard(list(failed))
+            for job, report in exported:
+                # A report whose rows were all quarantined has nothing to stage.
+                expected = len(report.data_rows()) > len(report.quarantined_rows())
+                if expected and not bi.is_staged(report.filename):
+                    failed[report.filename] = (job, '{0} was not imported into the temp tables'.format(
+                        report.filename))
+                    continue
+                jobs.set_state(job.id, 'staged')
+                staged.append((job, report))
+
+        load_start = datetime.now().isoformat()
+        with instrument.stage('inventory'):
+            load_ids = {report.filename: inv.start(report, load_start) for job, report in staged}
+        verified = []
+        try:
+            with instrument.stage('merge'):
+                TitleReportTable().insert_batch_from_temp(
+                    [(load_ids[report.filename], report.filename) for job, report in staged])
+                mt = MetricTable()
+                cursor = CounterDb.conn.cursor()
+                mt.set_title_ids(cursor)
+                CounterDb.conn.commit()
+            for merged in merge_rounds([report for job, report in staged]):
+                with instrument.stage('merge'):
+                    params = [v for report in merged for v in (report.filename, load_ids[report.filename])]
+                    params.extend(report.filename for report in merged)
+                    cursor.execute(mt.merge_sql(reports=len(merged)), params)
+                    CounterDb.conn.commit()
+                if verify:
+                    verified.extend(verify_report(report) for report in merged)
+            merged = staged
+            messages.extend(message for message in verified if message)
+        except Exception:
+            CounterDb.conn.rollback()
+            print('  batch merge failed, loading its reports one at a time:')
+            print(traceback.format_exc())
+            merged = []
+
+    load_end = datetime.now().isoformat()
+    loaded = []
+    for job, report in merged:
+        with instrument.stage('inventory'):
+            jobs.set_state(job.id, 'merged')
+            inv.finish(load_ids[report.filename], report, load_start, load_end)
+            jobs.set_state(job.id, 'done')
+        instrument.add_rows(len(report.data_rows()))
+        loaded.append(report.filename)
+
+    # The separate loads start again from the export, since the temp
+    # tables hold the rows of the whole batch.
+    for job, report in reports:
+        if report.filename in loaded or report.filename in failed:
+            continue
+        try:
+            jobs.set_state(job.id, 'queued')
+            load_report(report, reportdir, jobs.get(job.id), jobs, stagedir=stagedir)
+            loaded.append(report.filename)
+        except Exception:
+            failed[report.filename] = (job, traceback.format_exc())
+            continue
+        if verify:
+            message = verify_report(report)
+            if message:
+                messages.append(message)
+
+    for job, error in failed.values():
+        jobs.set_state(job.id, 'failed', error)
+    for job, report in reports:
+        if report.filename in failed and report.filename in load_ids:
+            discard_load(load_ids[report.filename])
+    return loaded, list(failed.values()), messages
+
+
+def discard_load(load_id):
+    """
+    Takes the rows of a load that failed before it finished back out and
+    removes its inventory row, so nothing is left of it. The inventory
+    row of a report that was loaded before is finished, and is kept with
+    the rows of that load.
+    """
+    inv = ReportInventoryTable()
+    rows = inv.find(load_id)
+    if not rows or rows[0].load_end is not None:
+        return
+    MetricTable().unload(load_id)
+    TitleReportTable().unload(load_id)
+    inv.delete(load_id)
+
+
+def load_item_report(report, stagedir, job, jobs):
+    """
+    Loads an Item Master Report. Item reports are staged and merged chunk
+    by chunk, and the merges are upserts, so an interrupted load simply
+    starts again from the first chunk.
+    """
+    load_start = (job.started_at or datetime.now()).isoformat()
+    with StagingLock():
+        rows = ItemReportTable(stagedir).load(report)
+    jobs.set_state(job.id, 'merged')
+
+    load_end = datetime.now().isoformat()
+    ReportInventoryTable().insert(report, rows, load_start, load_end)
+    jobs.set_state(job.id, 'done')
+
+
+def verify_report(report):
+    """
+    Reconciles a loaded report with the database and returns the text to
+    log, or None if they match or the report's type cannot be reconciled.
+    The load is already done, so an error while reconciling is returned
+    as the text to log rather than raised.
+    """
+    if not can_reconcile(report):
+        return None
+    try:
+        with instrument.stage('verify'):
+            result = reconcile(report)
+    except Exception:
+        return '{0}: verify failed\n{1}'.format(report.filename, traceback.format_exc())
+    if not is_reconciled(result):
+        print(format_reconciliation(result, limit=3))
+        return format_reconciliation(result)
+    return None
+
+
+def run_job(job, reportdir, jobs, node, stagedir=None, heartbeat_interval=60, verify=False,
+    report=None, direct=False):
+    """
+    Loads the file of a job claimed by node, sending heartbeats while it
+    runs. Returns None if all went well, or the text to log otherwise:
+    the traceback when the load failed, in which case the job is marked
+    failed, or the reconciliation summary when verify found differences.
+
+    report is the job's report when the caller has already opened it, as
+    harvest-sushi.py has, and direct is passed on to load_report.
+    """
+    f = os.path.join(reportdir, job.excel_name)
+    heartbeat = Heartbeat(job.id, node, interval=heartbeat_interval)
+    heartbeat.start()
+    try:
+        with instrument.report(job.excel_name):
+            with instrument.stage('open'):
+                if report is None:
+                    report = open_report(f)
+
+                # Check if spreadsheet has already been loaded. A record of
+                # which reports have been loaded and when is maintained in
+                # the inventory table.
+                done = ReportInventoryTable().is_loaded(report)
+            message = None
+            if done:
+                jobs.set_state(job.id, 'done')
+            else:
+                load_report(report, reportdir, job, jobs, direct=direct, stagedir=stagedir)
+                if verify:
+                    message = verify_report(report)
+
+            # Clean up.
+            report.close()
+            return message
+
+    except Exception:
+        jobs.set_state(job.id, 'failed', traceback.format_exc())
+        return '{0}\n{1}'.format(f, traceback.format_exc())
+
+    finally:
+        heartbeat.stop()
+        if heartbeat.lost:
+            print('  claim on {0} was taken over by another node'.format(job.excel_name))
+
+
+def run_batch(batch, reportdir, jobs, node, stagedir=None, heartbeat_interval=60, verify=False):
+    """
+    Loads the files of several jobs claimed by node with load_batch,
+    sending heartbeats for all of them while it runs. Reports already
+    loaded are marked done and item reports are loaded on their own.
+    Returns the texts to log, like run_job, one per job with something to
+    report.
+    """
+    stagedir = stagedir or reportdir
+    heartbeats = [Heartbeat(job.id, node, interval=heartbeat_interval) for job in batch]
+    for heartbeat in heartbeats:
+        heartbeat.start()
+    messages = []
+    reports = []
+    try:
+        with instrument.report('{0} (batch of {1})'.format(batch[0].excel_name, len(batch))):
+            for job in batch:
+                f = os.path.join(reportdir, job.excel_name)
+                try:
+                    with instrument.stage('open'):
+                        report = open_report(f)
+                        done = ReportInventoryTable().is_loaded(report)
+                    if done:
+                        jobs.set_state(job.id, 'done')
+                        report.close()
+                    elif isinstance(report, ItemMasterReport):
+                        load_report(report, reportdir, job, jobs, stagedir=stagedir)
+                        report.close()
+                    else:
+                        reports.append((job, report))
+                except Exception:
+                    jobs.set_state(job.id, 'failed', traceback.format_exc())
+                    messages.append('{0}\n{1}'.format(f, traceback.format_exc()))
+
+            if reports:
+                loaded, failed, mismatches = load_batch(reports, reportdir, jobs, stagedir, verify)
+                for job, error in failed:
+                    messages.append('{0}\n{1}'.format(os.path.join(reportdir, job.excel_name), error))
+                messages.extend(mismatches)
+            return messages
+
+    finally:
+        for job, report in reports:
+            report.close()
+        for job, heartbeat in zip(batch, heartbeats):
+            heartbeat.stop()
+            if heartbeat.lost:
+                print('  claim on {0} was taken over by another node'.format(job.excel_name))
+
+
+def watch_reports(watcher, reportdir, jobs, node, stop, stagedir=None, stale_after=600, verify=False):
+    """
+    Loads the report files a DirectoryWatcher reports until stop is set,
+    as watch-reports.py does. Each file is queued and claimed in load_job
+    and loaded with run_job; files claimed by other nodes are left to
+    them. Yields the name of each file loaded and run_job's result.
+    """
+    for f in watcher.changes(stop):
+        name = os.path.basename(f)
+        CounterDb.backend.ping(CounterDb.conn)
+        jobs.enqueue(reportdir, [f])
+        jobs.requeue_if_changed(reportdir, name, datetime.fromtimestamp(os.path.getmtime(f)))
+        job = jobs.claim(reportdir, node, [name], stale_after)
+        if job is None:
+            continue
+        print('{0} {1}'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), name))
+        yield name, run_job(job, reportdir, jobs, node, stagedir,
+            heartbeat_interval=max(1, stale_after // 4), verify=verify)
+
+
+def ingest_file(path, platform_names, jobs, node, stagedir, heartbeat_interval=60, verify=False):
+    """
+    Checks, renames and loads a source file as delivered by the vendor,
+    with one pass over a title report's rows: the pass that exports the
+    report to stagedir, under its new name, also gathers what the checks
+    need (see dataloader.preprocess). The file is renamed once it passes
+    them and its load then continues from the staged text files. Item
+    reports are merged as they are read, so they are checked in a pass of
+    their own first.
+
+    Returns the new file name and, when verify found differences, the
+    reconciliation summary (or None). Raises PreprocessError, leaving the
+    file as it is, when a check fails, marks the job failed before raising
+    when the load fails, and raises RuntimeError when another node holds
+    the job.
+    """
+    reportdir = os.path.dirname(os.path.abspath(path))
+    with instrument.stage('open'):
+        report = sniff_report(path)
+    try:
+        target = target_name(report, path)
+        if isinstance(report, ItemMasterReport):
+            check_report(report, path, platform_names)
+        else:
+            with instrument.stage('export'):
+                report.filename = target
+                report.export(staging_sink(stagedir))
+                check_report(report, path, platform_names)
+    finally:
+        report.close()
+
+    # The report's counts and records are kept, so the closed report can
+    # still be loaded once the file is renamed.
+    if os.path.basename(path) != target:
+        os.rename(path, os.path.join(reportdir, target))
+    report.filename = target
+    with instrument.report(target):
+        if ReportInventoryTable().is_loaded(report):
+            print('  already loaded')
+            return target, None
+        # The report is not loaded, so a job that is done or failed was for
+        # an earlier delivery of the file and is queued again.
+        jobs.enqueue(reportdir, [target])
+        jobs.requeue(reportdir, target)
+        job = jobs.claim(reportdir, node, [target])
+        if job is None:
+            raise RuntimeError('{0} was not loaded: it is being loaded by another node'.format(target))
+        heartbeat = Heartbeat(job.id, node, interval=heartbeat_interval)
+        heartbeat.start()
+        try:
+            if isinstance(report, ItemMasterReport):
+                report = open_report(os.path.join(reportdir, target))
+                load_report(report, reportdir, job, jobs, stagedir=stagedir)
+                report.close()
+                return target, None
+            save_quarantined(report, reportdir)
+            jobs.set_state(job.id, 'parsed')
+            load_report(report, reportdir, job, jobs, stagedir=stagedir, exported=True)
+            if verify:
+                # Reconciling reads the report again.
+                report = open_report(os.path.join(reportdir, target))
+                message = verify_report(report)
+                report.close()
+                return target, message
+            return target, None
+        except Exception:
+            jobs.set_state(job.id, 'failed', traceback.format_exc())
+            raise
+        finally:
+            heartbeat.stop()
+
+
+def replay_quarantine(report, rows):
+    """
+    Loads quarantined rows of a report, given as quarantine table rows,
+    and returns the number that loaded. Rows that convert are merged like
+    a normal load and marked replayed; the others keep their entry, with
+    the reason brought up to date. The rows are tagged with the report's
+    load id, so unloading the report removes them too, and the report is
+    marked changed for caches and exports (see ReportInventoryTable.touch).
+    Raises ValueError if the report is not in the inventory.
+    """
+    inv = ReportInventoryTable()
+    load_id = inv.get_load_id(report)
+    if load_id is None:
+        # Rows tagged with no load id could never be unloaded.
+        raise ValueError('{0} is not in the report inventory; load it before replaying its rows'.format(
+            report.filename))
+    replay = ReplayStream(report, [(row.row_num, json.loads(row.row_data)) for row in rows])
+    with StagingLock():
+        replay.export(TempTableSink())
+        merge_staged(load_id)
+        inv.touch(load_id)
+
+    failed = {row.row_num: row for row in replay.quarantined_rows()}
+    quarantine = QuarantineTable()
+    quarantine.set_replayed([row.id for row in rows if row.row_num not in failed])
+    quarantine.insert(rows[0].report_dir, list(failed.values()))
+    return len(rows) - len(failed)
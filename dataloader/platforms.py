@@ -0,0 +1,117 @@
+import csv
+import os
+import string
+import unicodedata
+
+
+# Tab delimited export of the platform_ref table, used when no database
+# connection is available.
+PLATFORM_REF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'sql', 'platform_ref.txt')
+
+
+def repair_mojibake(value):
+    """
+    Undoes UTF-8 text that was decoded as Windows-1252 (or Latin-1), e.g.
+    'AkadÃ©miai' back to 'Akadémiai'. Vendors sometimes repeat the mistake,
+    so the repair is applied until the text stops changing.
+    """
+    for i in range(3):
+        repaired = None
+        for encoding in ('cp1252', 'latin-1'):
+            try:
+                repaired = value.encode(encoding).decode('utf-8')
+                break
+            except UnicodeError:
+                continue
+        if repaired is None or repaired == value:
+            break
+        value = repaired
+    return value
+
+
+def platform_key(name):
+    """
+    Returns the normalized lookup key for a platform name. The key ignores
+    encoding damage, accents, case, punctuation and whitespace, so that
+    'Akadémiai Kiadó', 'AkadÃƒÂ©miai KiadÃƒÂ³' and 'akademiai-kiado' all
+    share the key 'akademiaikiado'.
+    """
+    if not isinstance(name, str):
+        return ''
+    value = repair_mojibake(unicodedata.normalize('NFC', name))
+    value = unicodedata.normalize('NFKD', value)
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    value = value.casefold().replace('&', 'and')
+    return ''.join(c for c in value if c not in string.punctuation and not c.isspace())
+
+
+class PlatformResolver:
+    """
+    Resolves platform names found in reports to platform_ref ids.
+
+    Lookups are dictionary based. An exact match on the registered name is
+    tried first, so existing rows keep resolving to the same id. Otherwise
+    the normalized key of the name is looked up in an index built from the
+    registered names, the aliases (platform_alias table) and the preferred
+    names. Where several platforms share a key, the one registered first
+    (lowest id) wins.
+    """
+
+    def __init__(self, platforms, aliases=()):
+        """
+        platforms is an iterable of (id, name, preferred_name) tuples and
+        aliases an iterable of (alias, platform_id) tuples.
+        """
+        platforms = sorted(platforms, key=lambda p: int(p[0]))
+        self._names = {}
+        self._keys = {}
+        for (platform_id, name, preferred_name) in platforms:
+            self._names.setdefault(name, int(platform_id))
+        for (platform_id, name, preferred_name) in platforms:
+            self._add_key(name, platform_id)
+        for (alias, platform_id) in aliases:
+            self._add_key(alias, platform_id)
+        for (platform_id, name, preferred_name) in platforms:
+            self._add_key(preferred_name, platform_id)
+
+    def _add_key(self, name, platform_id):
+        key = platform_key(name)
+        if key:
+            self._keys.setdefault(key, int(platform_id))
+
+    @classmethod
+    def from_file(cls, ref_file=PLATFORM_REF, alias_file=None):
+        """
+        Builds a resolver from a tab delimited platform_ref export (with
+        id, name and preferred_name columns) and, optionally, an alias file
+        with alias and platform_id columns.
+        """
+        with open(ref_file, newline='', encoding='utf-8') as f:
+            platforms = [(row['id'], row['name'], row['preferred_name'])
+                for row in csv.DictReader(f, dialect='excel-tab')]
+        aliases = []
+        if alias_file is not None:
+            with open(alias_file, newline='', encoding='utf-8') as f:
+                aliases = [(row['alias'], row['platform_id'])
+                    for row in csv.DictReader(f, dialect='excel-tab')]
+        return cls(platforms, aliases)
+
+    def resolve(self, name):
+        """
+        Returns the platform id for the given name, or None if the name
+        cannot be resolved.
+        """
+        platform_id = self._names.get(name)
+        if platform_id is None:
+            platform_id = self._keys.get(platform_key(name))
+        return platform_id
+
+    def names(self):
+        """
+        Returns the registered platform names.
+        """
+        return list(self._names)
+
+    def __contains__(self, name):
+        return self.resolve(name) is not None
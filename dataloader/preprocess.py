@@ -0,0 +1,100 @@
+import os
+
+import openpyxl
+
+from dataloader.irreport import ItemMasterReport
+from dataloader.platforms import PlatformResolver
+from dataloader.textreport import TextTitleMasterReport
+from dataloader.tmreport import TitleMasterReport
+
+
+# The checks and naming applied to vendor files before they are loaded,
+# shared by preprocess-source-files.py and ingest-reports.py.
+#
+# Source files are recognized by their content rather than their name, and
+# renamed after the data they contain, keeping the extension:
+#
+#   <version>-<platform>-<year>-<month range>.<extension>
+#
+# e.g. tr-j3-acm-digital-library-2022-0112.xlsx. A workbook is opened once:
+# sniff_report() hands the open workbook to the report class, and the
+# checks use the row counts and platform names gathered by the report's
+# first pass over its rows, which may be the pass that exports it.
+
+SOURCE_PATTERNS = ['[TI]R*.xl*', 'TR*.tsv', 'TR*.csv']
+
+
+class PreprocessError(Exception):
+    """
+    Raised for a source file that is not a loadable report or fails its
+    checks.
+    """
+
+
+def load_platforms():
+    """
+    Returns the platform resolver from the database, or from
+    sql/platform_ref.txt when no database is available.
+    """
+    try:
+        from dataloader.counter_db import PlatformTable
+        return PlatformTable().get_resolver()
+    except Exception as e:
+        print('Database unavailable ({0}), validating platforms against platform_ref.txt'.format(e))
+        return PlatformResolver.from_file()
+
+
+def sniff_report(path):
+    """
+    Opens a source file as the report class matching its content: a Title
+    or Item Master Report workbook, or a Title Master Report text file.
+    """
+    if os.path.splitext(path)[1].lower() in ('.tsv', '.csv'):
+        return TextTitleMasterReport(path)
+    book = openpyxl.load_workbook(filename=path, data_only=True, read_only=True)
+    worksheet = book.active
+    a1 = worksheet.cell(row=1, column=1).value
+    if a1 == 'Report_Name' and str(worksheet.cell(row=2, column=2).value).startswith('IR'):
+        return ItemMasterReport(path, book=book)
+    if a1 == 'Report_Name':
+        return TitleMasterReport(path, book=book)
+    book.close()
+    if isinstance(a1, str) and a1.startswith('Journal Report 1'):
+        raise PreprocessError('JR1Report is no longer supported with version 5 of Counter specification.')
+    raise PreprocessError('{0}: not a COUNTER R5 title or item report'.format(path))
+
+
+def target_name(report, path):
+    """
+    Returns the conventional file name for the report read from path.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in ('.tsv', '.csv'):
+        extension = '.xlsx'
+    return '{0}-{1}-{2}-{3}{4}'.format(
+        report.report_id.lower().replace('_', '-'),
+        report.platform.lower().replace(' ', '-').replace(':', ''),
+        report.begin_date[0:4],
+        report.begin_date[5:7] + report.end_date[5:7],
+        extension)
+
+
+def check_report(report, path, platform_names):
+    """
+    Raises PreprocessError if a row misses one of its required values or
+    names a platform that is not in platform_ref. Makes a pass over the
+    rows unless one was already made.
+    """
+    if not report.has_all_valid_rows():
+        error_msg = '{0}:  is missing one of (Title, Platform, Access_Type, Metric_Type) on these rows: ['.format(path)
+        for row in report.get_invalid_rows():
+            error_msg += ' {0}'.format(row)
+        error_msg += ' ]\n\n'
+        raise PreprocessError(error_msg)
+    invalid_platforms = report.get_invalid_platforms(platform_names)
+    if invalid_platforms:
+        error_msg = '{0}:  has these platforms not present in the platform_ref table: ['.format(path)
+        for platform in invalid_platforms:
+            error_msg += ' "{0}"'.format(platform)
+        error_msg += ' ]\n\n'
+        raise PreprocessError(error_msg)
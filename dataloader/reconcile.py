@@ -0,0 +1,194 @@
+from collections import namedtuple
+from datetime import datetime
+
+import pandas as pd
+
+from dataloader.counter_db import CounterDb, PlatformTable
+from dataloader.jr1report import JR1Report
+from dataloader.normalize import title_key
+from dataloader.records import cell_text
+from dataloader.tmreport import TitleMasterReport
+
+
+# Checks that the usage loaded into the metric table matches the report it
+# came from. The loader drops Reporting_Period_Total, so this is the only
+# place the report's own totals are used.
+#
+# The report's month columns are summed per row with pandas, rows are
+# grouped by (title_key, access type, metric type), keeping the last row of
+# a key as the loader does, and the result is compared with a single
+# aggregate query over metric for the report's platforms and period. Two
+# kinds of problem are reported:
+#
+#   - rows whose month columns do not add up to Reporting_Period_Total
+#   - titles whose total in the database differs from the report
+#
+# Rows with an unknown access or metric type are not expected in the
+# database (they are quarantined by the loader) and are only counted.
+
+Reconciliation = namedtuple('Reconciliation', ['excel_name', 'rows', 'report_total',
+    'db_total', 'bad_row_totals', 'mismatches', 'unmapped_rows'])
+
+
+def can_reconcile(report):
+    """
+    Returns True if reconcile() supports the report's type.
+    """
+    return isinstance(report, (TitleMasterReport, JR1Report))
+
+
+def report_layout(report):
+    """
+    Returns the positions of the columns used for reconciliation in a data
+    row of the report: a dict of column positions (None where the report
+    has no such column), plus the position of the first month column and
+    the number of months.
+    """
+    begin = datetime.fromisoformat(report.begin_date)
+    end = datetime.fromisoformat(report.end_date)
+    n_months = end.month - begin.month + 1
+    if isinstance(report, TitleMasterReport):
+        columns = report._column_index()
+        positions = {name: columns.get(name) for name in ['Title', 'Publisher', 'Platform',
+            'ISBN', 'YOP', 'Access_Type', 'Metric_Type', 'Reporting_Period_Total']}
+        return positions, columns['Reporting_Period_Total'] + 1, n_months
+    if isinstance(report, JR1Report):
+        positions = {'Title': 0, 'Publisher': 1, 'Platform': 2, 'ISBN': None, 'YOP': None,
+            'Access_Type': None, 'Metric_Type': None, 'Reporting_Period_Total': 7}
+        return positions, 10, n_months
+    raise ValueError('Reconciliation is not supported for {0}'.format(report.filename))
+
+
+def report_frame(report):
+    """
+    Reads the report's data rows into a DataFrame with the identifying
+    columns as text, the access and metric type codes, and the month sum
+    and Reporting_Period_Total of each row.
+    """
+    positions, first_month, n_months = report_layout(report)
+    row_nums = []
+    records = []
+    for row_num, values in report.iter_data_rows():
+        row_nums.append(row_num)
+        records.append(values)
+    raw = pd.DataFrame.from_records(records, columns=range(len(records[0])) if records else [])
+
+    def text(name):
+        if positions[name] is None or positions[name] not in raw:
+            return pd.Series([''] * len(raw), index=raw.index, dtype=object)
+        return raw[positions[name]].map(cell_text)
+
+    def number(frame):
+        return frame.apply(pd.to_numeric, errors='coerce')
+
+    frame = pd.DataFrame({'row_num': row_nums})
+    for name in ['Title', 'Publisher', 'Platform', 'ISBN', 'YOP']:
+        frame[name.lower()] = text(name)
+    if positions['Access_Type'] is not None:
+        frame['access_type'] = text('Access_Type').map(TitleMasterReport.ACCESS_TYPE)
+    else:
+        frame['access_type'] = 1 # Controlled
+    if positions['Metric_Type'] is not None:
+        frame['metric_type'] = text('Metric_Type').map(TitleMasterReport.METRIC_TYPE)
+    else:
+        frame['metric_type'] = 2 # Total_Item_Requests
+
+    # Blank or non-numeric month cells count as zero, as in the loader.
+    months = number(raw.reindex(columns=range(first_month, first_month + n_months)))
+    frame['month_sum'] = months.fillna(0).sum(axis=1).astype('int64')
+    frame['declared_total'] = number(raw.reindex(columns=[positions['Reporting_Period_Total']])).iloc[:, 0]
+
+    # The title key has to be computed row by row, the same way the loader
+    # does, to match title_report.
+    frame['title_key'] = [title_key(t, p, i, y) for t, p, i, y in
+        zip(frame['title'], frame['publisher'], frame['isbn'], frame['yop'])]
+    return frame
+
+
+def db_totals(platform_ids, title_type, begin_date, end_date):
+    """
+    Returns a DataFrame of usage totals in metric by (platform_id,
+    title_key, access_type, metric_type) for the given platforms and
+    period, in one aggregate query.
+    """
+    sql = u"SELECT t.platform_id, t.title_key, m.access_type + 0, m.metric_type + 0, \
+        SUM(m.period_total) \
+        FROM metric m \
+        JOIN title_report t ON t.id = m.title_report_id \
+        WHERE t.platform_id IN ({0}) \
+        AND m.title_type = %s \
+        AND m.period BETWEEN %s AND %s \
+        GROUP BY t.platform_id, t.title_key, m.access_type, m.metric_type".format(
+        ', '.join(['%s'] * len(platform_ids)))
+    params = list(platform_ids) + [title_type, begin_date, end_date]
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(sql, params)
+    return pd.DataFrame(cursor.fetchall(), columns=['platform_id', 'title_key',
+        'access_type', 'metric_type', 'db_total'])
+
+
+def reconcile(report):
+    """
+    Compares a loaded report with the metric table and returns a
+    Reconciliation. mismatches and bad_row_totals are DataFrames, empty
+    when everything matches.
+    """
+    frame = report_frame(report)
+    resolver = PlatformTable().get_resolver()
+    frame['platform_id'] = frame['platform'].map(
+        {name: resolver.resolve(name) for name in frame['platform'].unique()})
+
+    bad_row_totals = frame[frame['declared_total'].notna()
+        & (frame['declared_total'] != frame['month_sum'])]
+
+    mapped = frame.dropna(subset=['access_type', 'metric_type', 'platform_id'])
+    unmapped_rows = len(frame) - len(mapped)
+    keys = ['platform_id', 'title_key', 'access_type', 'metric_type']
+    mapped = mapped.astype({'access_type': 'int64', 'metric_type': 'int64', 'platform_id': 'int64'})
+    # A key repeated in the report is loaded as its last row, which
+    # overwrites the months of the earlier ones.
+    sheet = mapped.sort_values('row_num').groupby(keys, as_index=False).agg(
+        report_total=('month_sum', 'last'), title=('title', 'first'), first_row=('row_num', 'min'))
+
+    platform_ids = sorted(sheet['platform_id'].unique().tolist())
+    if platform_ids:
+        db = db_totals(platform_ids, report.title_type, report.begin_date, report.end_date)
+        db = db.astype({'platform_id': 'int64', 'access_type': 'int64', 'metric_type': 'int64'})
+        merged = sheet.merge(db, on=keys, how='left')
+        merged['db_total'] = merged['db_total'].fillna(0).astype('int64')
+    else:
+        merged = sheet.assign(db_total=0)
+    mismatches = merged[merged['report_total'] != merged['db_total']]
+
+    return Reconciliation(report.filename, len(frame), int(sheet['report_total'].sum()),
+        int(merged['db_total'].sum()), bad_row_totals, mismatches, unmapped_rows)
+
+
+def format_reconciliation(result, limit=10):
+    """
+    Returns a short text summary of a Reconciliation, listing up to limit
+    problem rows of each kind.
+    """
+    lines = ['{0}: {1} rows, report total {2}, database total {3}'.format(result.excel_name,
+        result.rows, result.report_total, result.db_total)]
+    if result.unmapped_rows:
+        lines.append('  {0} rows with an unknown platform, access or metric type'.format(
+            result.unmapped_rows))
+    if len(result.bad_row_totals):
+        lines.append('  {0} rows where the months do not add up to Reporting_Period_Total'.format(
+            len(result.bad_row_totals)))
+        for row in result.bad_row_totals.head(limit).itertuples():
+            lines.append('    row {0}: months {1}, total {2}'.format(row.row_num, row.month_sum,
+                row.declared_total))
+    if len(result.mismatches):
+        lines.append('  {0} titles where the database differs from the report'.format(
+            len(result.mismatches)))
+        for row in result.mismatches.head(limit).itertuples():
+            lines.append('    row {0} {1!r} ({2}/{3}): report {4}, database {5}'.format(row.first_row,
+                row.title, CounterDb.ACCESS_TYPE[row.access_type], CounterDb.METRIC_TYPE[row.metric_type],
+                row.report_total, row.db_total))
+    return '\n'.join(lines)
+
+
+def is_reconciled(result):
+    return len(result.mismatches) == 0 and len(result.bad_row_totals) == 0
@@ -0,0 +1,278 @@
+import csv
+import os
+from collections import namedtuple
+
+from dataloader.normalize import normalize_titles
+
+
+# A title (journal or book) from one report row. The fields follow the
+# columns of the title_report_temp table, less the id and title_report_id
+# columns that are only assigned in the database. title_key is filled in
+# when the record is normalized, see RecordStream.
+TitleRecord = namedtuple('TitleRecord', ['title', 'title_type', 'publisher',
+    'publisher_id', 'platform', 'doi', 'proprietary_id', 'isbn', 'print_issn',
+    'online_issn', 'uri', 'yop', 'excel_name', 'row_num', 'title_key'])
+
+# One month of usage for a report row. The fields follow the columns of the
+# metric_temp table, less id and title_report_id. Access and metric types
+# are the numeric codes used by the metric table ENUMs.
+MetricRecord = namedtuple('MetricRecord', ['title_type', 'access_type',
+    'metric_type', 'period', 'period_total', 'excel_name', 'row_num'])
+
+# A year of usage for a report row in the wide metric layout (see
+# MetricTable): the twelve month totals of one access and metric type in a
+# single record. months is a bit mask of the months the report covers, bit
+# 0 for January, so a month with no data is not confused with zero usage.
+WideMetricRecord = namedtuple('WideMetricRecord', ['title_type', 'access_type',
+    'metric_type', 'year', 'months', 'm01', 'm02', 'm03', 'm04', 'm05', 'm06',
+    'm07', 'm08', 'm09', 'm10', 'm11', 'm12', 'excel_name', 'row_num'])
+
+# An item from one Item Master Report row. The fields follow the columns of
+# the item_report_temp table, except that the platform name is resolved to
+# platform_id during staging.
+ItemRecord = namedtuple('ItemRecord', ['item', 'data_type', 'publisher',
+    'publisher_id', 'platform', 'authors', 'publication_date', 'article_version',
+    'doi', 'proprietary_id', 'isbn', 'print_issn', 'online_issn', 'uri',
+    'parent_title', 'parent_data_type', 'parent_doi', 'parent_proprietary_id',
+    'parent_isbn', 'parent_print_issn', 'parent_online_issn', 'parent_uri',
+    'yop', 'item_key'])
+
+# One month of usage for an Item Master Report row. Items are matched to
+# their metrics by (platform, item_key) rather than by spreadsheet row.
+ItemMetricRecord = namedtuple('ItemMetricRecord', ['platform', 'item_key',
+    'access_type', 'access_method', 'metric_type', 'period', 'period_total'])
+
+# A report row that could not be converted to records, e.g. because of an
+# unknown Metric_Type or a non-numeric count. values holds the raw cells.
+QuarantinedRow = namedtuple('QuarantinedRow', ['excel_name', 'row_num', 'reason', 'values'])
+
+# Errors raised by convert_row() for a bad row. Anything else is a bug or a
+# problem with the file as a whole and still fails the load.
+ROW_ERRORS = (KeyError, ValueError, TypeError, IndexError)
+
+
+def cell_text(value):
+    """
+    Returns a spreadsheet cell value as text. Blank cells become empty
+    strings and newline characters are replaced, as they will break any
+    CSV-based mysqlimport command.
+    """
+    if value is None:
+        return ''
+    return str(value).replace('\n', ' ').strip()
+
+
+def widen(metrics):
+    """
+    Folds the monthly MetricRecords of a report row into WideMetricRecords,
+    one per access type, metric type and year.
+    """
+    wide = {}
+    for metric in metrics:
+        period = str(metric.period)
+        year, month = int(period[0:4]), int(period[5:7])
+        key = (metric.access_type, metric.metric_type, year)
+        if key not in wide:
+            wide[key] = [metric.title_type, metric.access_type, metric.metric_type, year, 0] \
+                + [0] * 12 + [metric.excel_name, metric.row_num]
+        record = wide[key]
+        record[4] |= 1 << (month - 1)
+        record[4 + month] = metric.period_total
+    return [WideMetricRecord._make(record) for record in wide.values()]
+
+
+class RecordStream:
+    """
+    Streaming access to the title and metric records of a report.
+
+    Report classes implement iter_data_rows(), which makes a single pass
+    over the report yielding (row number, raw values) for each data row,
+    and convert_row(), which turns one row into a (TitleRecord,
+    [MetricRecord, ...]) pair. Everything else is built on those, so
+    consumers never need to know the layout of a particular report version.
+
+    A row that convert_row() rejects is quarantined rather than failing the
+    whole report: it is left out of the records and kept, with the reason,
+    in quarantined_rows() so the loader can save it for a later replay.
+
+    convert_row() leaves titles as they appear in the report. Records are
+    then normalized in batches of NORMALIZE_BATCH rows (see
+    normalize_titles), so every consumer sees the canonical title,
+    publisher and title_key that end up in title_report.
+    """
+    NORMALIZE_BATCH = 5000
+
+    def iter_data_rows(self):
+        raise NotImplementedError
+
+    def convert_row(self, row_num, values):
+        raise NotImplementedError
+
+    def iter_records(self):
+        """
+        Yields the (TitleRecord, [MetricRecord, ...]) pair of every data row
+        that converts cleanly, quarantining the others.
+        """
+        self._quarantined = []
+        batch = []
+        for row_num, values in self.iter_data_rows():
+            try:
+                batch.append(self.convert_row(row_num, values))
+            except ROW_ERRORS as e:
+                self.quarantine(row_num, values, e)
+                continue
+            if len(batch) >= self.NORMALIZE_BATCH:
+                yield from self._normalize(batch)
+                batch = []
+        yield from self._normalize(batch)
+
+    def _normalize(self, batch):
+        titles = normalize_titles([title for title, metrics in batch])
+        return zip(titles, [metrics for title, metrics in batch])
+
+    def quarantine(self, row_num, values, error):
+        reason = '{0}: {1}'.format(type(error).__name__, error)
+        self._quarantined.append(QuarantinedRow(self.filename, row_num, reason, values))
+
+    def quarantined_rows(self):
+        """
+        Returns the rows quarantined by the last pass over the records.
+        """
+        return getattr(self, '_quarantined', [])
+
+    def titles(self):
+        """
+        Yields the title record of every data row.
+        """
+        for title, metrics in self.iter_records():
+            yield title
+
+    def metrics(self):
+        """
+        Yields the metric records of every data row.
+        """
+        for title, metrics in self.iter_records():
+            yield from metrics
+
+    def export(self, *sinks):
+        """
+        Writes the report records to one or more sinks in a single pass.
+        Without arguments, the title_report_temp and metric_temp text
+        files used by BulkImport are written next to the report.
+        """
+        if not sinks:
+            sinks = (TsvSink(self._dirname),)
+        try:
+            for title, metrics in self.iter_records():
+                for sink in sinks:
+                    sink.write(title, metrics)
+        finally:
+            for sink in sinks:
+                sink.close()
+
+
+class ReplayStream(RecordStream):
+    """
+    The records of quarantined rows, for loading them again once they have
+    been fixed. Rows are given as (row number, raw values) pairs and are
+    converted by the report they came from, so the same rules apply as in
+    the original load; rows that still fail are quarantined again.
+    """
+
+    def __init__(self, report, rows):
+        self._report = report
+        self._rows = rows
+
+    @property
+    def filename(self):
+        return self._report.filename
+
+    def iter_data_rows(self):
+        return iter(self._rows)
+
+    def convert_row(self, row_num, values):
+        return self._report.convert_row(row_num, values)
+
+
+class TsvSink:
+    """
+    Writes records to the title_report_temp and metric_temp text files, or
+    to title_report_temp and metric_wide_temp with wide set.
+
+    Both files are Excel tab delimited format, which are subsequently loaded
+    with mysqlimport. The file names must match the temp table names.
+    """
+
+    def __init__(self, dirname, wide=False):
+        self._wide = wide
+        self._title_file = open(os.path.join(dirname, 'title_report_temp'), 'w',
+            newline='', encoding='utf-8')
+        self._metric_file = open(os.path.join(dirname, 'metric_wide_temp' if wide else 'metric_temp'),
+            'w', newline='', encoding='utf-8')
+        self._title_writer = csv.writer(self._title_file, dialect='excel-tab', lineterminator='\n')
+        self._metric_writer = csv.writer(self._metric_file, dialect='excel-tab', lineterminator='\n')
+
+    def write(self, title, metrics):
+        # The id columns are placeholders; mysqlimport assigns the id and
+        # title_report_id is filled in once titles are inserted.
+        self._title_writer.writerow(['null'] + list(title[:14]) + [0, title.title_key])
+        if self._wide:
+            metrics = widen(metrics)
+        for metric in metrics:
+            self._metric_writer.writerow(['null', 0] + list(metric))
+
+    def close(self):
+        self._title_file.close()
+        self._metric_file.close()
+
+
+class ParquetSink:
+    """
+    Writes records to title_report.parquet and metric.parquet in the given
+    directory. Rows are written in row groups of BATCH_SIZE, so memory use
+    does not grow with the size of the report.
+
+    Requires the optional pyarrow package.
+    """
+    BATCH_SIZE = 50000
+
+    def __init__(self, dirname):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('ParquetSink requires the pyarrow package')
+        self._pa = pa
+        title_schema = pa.schema([(name, pa.int64() if name == 'row_num' else pa.string())
+            for name in TitleRecord._fields])
+        metric_schema = pa.schema([
+            ('title_type', pa.string()),
+            ('access_type', pa.int8()),
+            ('metric_type', pa.int8()),
+            ('period', pa.string()),
+            ('period_total', pa.int64()),
+            ('excel_name', pa.string()),
+            ('row_num', pa.int64())])
+        self._title_writer = pq.ParquetWriter(os.path.join(dirname, 'title_report.parquet'), title_schema)
+        self._metric_writer = pq.ParquetWriter(os.path.join(dirname, 'metric.parquet'), metric_schema)
+        self._titles = []
+        self._metrics = []
+
+    def _flush(self, writer, rows):
+        if rows:
+            columns = [list(column) for column in zip(*rows)]
+            writer.write_table(self._pa.Table.from_arrays(columns, schema=writer.schema))
+            del rows[:]
+
+    def write(self, title, metrics):
+        self._titles.append(title)
+        self._metrics.extend(metrics)
+        if len(self._metrics) >= self.BATCH_SIZE:
+            self._flush(self._title_writer, self._titles)
+            self._flush(self._metric_writer, self._metrics)
+
+    def close(self):
+        self._flush(self._title_writer, self._titles)
+        self._flush(self._metric_writer, self._metrics)
+        self._title_writer.close()
+        self._metric_writer.close()
@@ -0,0 +1,322 @@
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import urllib3
+
+from dataloader.records import MetricRecord, RecordStream, TitleRecord, cell_text
+
+# ijson parses the report items one at a time; without it the whole
+# response is parsed in memory.
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# Harvesting uses the COUNTER_SUSHI5 API. Vendors are configured in
+# dataloader.config as a list of dicts, for example:
+#
+#   sushi = [
+#       {'platform': 'ACM Digital Library',
+#        'base_url': 'https://example.org/sushi/r5',
+#        'customer_id': '12345',
+#        'requestor_id': 'abcde',     # optional
+#        'api_key': None,             # optional
+#        'requests_per_second': 1},   # optional, defaults to 1
+#   ]
+#
+# base_url may point at a local stub server for testing, e.g.
+# http://localhost:8000/r5.
+
+TITLE_REPORTS = ['tr_j1', 'tr_j3', 'tr_b1', 'tr_b3']
+
+
+class SushiError(Exception):
+    """
+    Raised when a SUSHI server returns an error exception instead of usage.
+    """
+
+
+class RateLimiter:
+    """
+    Spaces out requests to a single vendor. Threads calling wait() are let
+    through no more often than the configured rate.
+    """
+
+    def __init__(self, requests_per_second):
+        self._interval = 1.0 / requests_per_second
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self._interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SushiClient:
+    """
+    Fetches COUNTER R5 reports from one vendor's SUSHI server.
+
+    All clients share one urllib3 PoolManager, so connections to a vendor
+    are kept alive and reused between reports.
+    """
+    POOL = urllib3.PoolManager(maxsize=4, retries=urllib3.Retry(total=3, backoff_factor=2,
+        status_forcelist=(429, 500, 502, 503, 504), respect_retry_after_header=True))
+    CHUNK_SIZE = 65536
+
+    def __init__(self, platform, base_url, customer_id, requestor_id=None, api_key=None,
+        requests_per_second=1):
+        self._platform = platform
+        self._base_url = base_url.rstrip('/')
+        self._customer_id = customer_id
+        self._requestor_id = requestor_id
+        self._api_key = api_key
+        self._limiter = RateLimiter(requests_per_second)
+
+    @property
+    def platform(self):
+        return self._platform
+
+    def fetch(self, report, begin_date, end_date, reportdir):
+        """
+        Downloads a report for the given period into the report directory
+        and returns it as a SushiReport. The response body is streamed to
+        disk, so memory use does not depend on the size of the report.
+        """
+        fields = {'customer_id': self._customer_id, 'begin_date': begin_date,
+            'end_date': end_date}
+        if self._requestor_id:
+            fields['requestor_id'] = self._requestor_id
+        if self._api_key:
+            fields['api_key'] = self._api_key
+
+        slug = re.sub('[^a-z0-9]+', '-', self._platform.lower()).strip('-')
+        path = os.path.join(reportdir, 'sushi-{0}-{1}-{2}-{3}.json'.format(
+            report, slug, begin_date, end_date))
+
+        self._limiter.wait()
+        response = self.POOL.request('GET', '{0}/reports/{1}'.format(self._base_url, report),
+            fields=fields, preload_content=False)
+        try:
+            if response.status != 200:
+                raise SushiError('{0} {1}: HTTP {2}'.format(self._platform, report, response.status))
+            with open(path, 'wb') as f:
+                for chunk in response.stream(self.CHUNK_SIZE):
+                    f.write(chunk)
+        finally:
+            response.release_conn()
+
+        return SushiReport(path, self._platform)
+
+
+class SushiHarvester:
+    """
+    Harvests reports from every configured vendor concurrently.
+
+    Each (vendor, report) pair is fetched on a worker thread. Requests to
+    the same vendor are rate limited by that vendor's client, while
+    different vendors proceed in parallel.
+    """
+
+    def __init__(self, vendors, reportdir, max_workers=8):
+        self._clients = [SushiClient(**vendor) for vendor in vendors]
+        self._reportdir = reportdir
+        self._max_workers = max_workers
+
+    def harvest(self, begin_date, end_date, reports=('tr_j3', 'tr_b3')):
+        """
+        Yields (platform, report, SushiReport or exception) as downloads
+        complete, so loading can start before the slowest vendor is done.
+        """
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = {}
+            for client in self._clients:
+                for report in reports:
+                    future = executor.submit(client.fetch, report, begin_date, end_date,
+                        self._reportdir)
+                    futures[future] = (client.platform, report)
+            for future in as_completed(futures):
+                platform, report = futures[future]
+                try:
+                    yield platform, report, future.result()
+                except Exception as e:
+                    yield platform, report, e
+
+
+class SushiReport(RecordStream):
+    """
+    Represents a Title Master Report harvested from a SUSHI server as JSON.
+
+    It exposes the same interface as TitleMasterReport, so harvested reports
+    are staged, merged and inventoried exactly like spreadsheets. Each JSON
+    report item becomes one row; its Performance entries are expanded to one
+    metric record per month and metric type, with zero for the months the
+    server leaves out.
+    """
+
+    ACCESS_TYPE = {'Controlled': 1, 'OA_Gold': 2, 'Other_Free_To_Read': 3}
+    METRIC_TYPE = {'Total_Item_Investigations': 1, 'Total_Item_Requests': 2, 'Unique_Item_Investigations': 3,
+        'Unique_Item_Requests': 4, 'Unique_Title_Investigations': 5, 'Unique_Title_Requests': 6,
+        'Limit_Exceeded': 7, 'No_License': 8}
+    # Exception codes that mean "no usage" rather than failure.
+    NO_USAGE = [3030]
+
+    def __init__(self, path, platform=None):
+        self._path = path
+        self._filename = os.path.basename(path)
+        self._dirname = os.path.dirname(path)
+        self._header = self._read_header()
+        self._check_exceptions()
+        filters = {f['Name']: f['Value'] for f in self._header.get('Report_Filters', [])}
+        self._report_id = self._header['Report_ID']
+        self._begin_date = filters['Begin_Date'][0:10]
+        self._end_date = filters['End_Date'][0:10]
+        self._run_date = self._header.get('Created')
+        self._platform = platform or filters.get('Platform')
+        self._num_rows = None
+
+    def _items(self, f):
+        if ijson is not None:
+            return ijson.items(f, 'Report_Items.item', use_float=True)
+        return json.load(f).get('Report_Items', [])
+
+    def _read_header(self):
+        with open(self._path, 'rb') as f:
+            if ijson is not None:
+                header = next(ijson.items(f, 'Report_Header'), None)
+            else:
+                data = json.load(f)
+                header = data.get('Report_Header') if isinstance(data, dict) else None
+        if header is None:
+            # Servers answer an error with a bare exception object (or a
+            # list of them) instead of a report. These are small.
+            with open(self._path, 'rb') as f:
+                error = json.load(f)
+            if isinstance(error, list):
+                error = error[0] if error else {}
+            raise SushiError('{0}: {1} {2}'.format(self._filename, error.get('Code'), error.get('Message')))
+        return header
+
+    def _check_exceptions(self):
+        """
+        Raises SushiError if the server reported an error. Informational
+        exceptions and "no usage available" leave an empty report.
+        """
+        for e in self._header.get('Exceptions', []):
+            if e.get('Code', 0) >= 1000 and e.get('Code') not in self.NO_USAGE:
+                raise SushiError('{0}: {1} {2}'.format(self._filename, e.get('Code'), e.get('Message')))
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def report_id(self):
+        return self._report_id
+
+    @property
+    def begin_date(self):
+        return self._begin_date
+
+    @property
+    def end_date(self):
+        return self._end_date
+
+    @property
+    def run_date(self):
+        if self._run_date is None:
+            return '0000-00-00'
+        else:
+            return str(self._run_date)[0:10]
+
+    @property
+    def title_type(self):
+        return self.report_id[3:4]
+
+    @property
+    def platform(self):
+        return self._platform
+
+    @property
+    def row_count(self):
+        return len(self.data_rows())
+
+    def data_rows(self):
+        """
+        Returns a range with one entry per report item, numbered like
+        spreadsheet rows so row numbers line up with the temp tables.
+        """
+        if self._num_rows is None:
+            with open(self._path, 'rb') as f:
+                self._num_rows = sum(1 for item in self._items(f))
+        return range(1, 1 + self._num_rows)
+
+    def close(self):
+        pass
+
+    def _identifiers(self, item):
+        return {i['Type']: i['Value'] for i in item.get('Item_ID', [])}
+
+    def _periods(self):
+        if getattr(self, '_period_list', None) is None:
+            report_begin = datetime.fromisoformat(self.begin_date)
+            report_end = datetime.fromisoformat(self.end_date)
+            self._period_list = [datetime(report_begin.year, i, 1).strftime('%Y-%m-%d')
+                for i in range(report_begin.month, report_end.month + 1)]
+        return self._period_list
+
+    def iter_data_rows(self):
+        """
+        Yields (row number, report item) for each JSON report item.
+        """
+        with open(self._path, 'rb') as f:
+            yield from enumerate(self._items(f), 1)
+
+    def convert_row(self, row_num, item):
+        title_type = self.title_type
+        ids = self._identifiers(item)
+        publisher_ids = item.get('Publisher_ID', [])
+        title = TitleRecord(
+            title=cell_text(item.get('Title')),
+            title_type=title_type,
+            publisher=cell_text(item.get('Publisher')),
+            publisher_id=cell_text(publisher_ids[0]['Value'] if publisher_ids else None),
+            platform=cell_text(item.get('Platform') or self._platform),
+            doi=cell_text(ids.get('DOI')),
+            proprietary_id=cell_text(ids.get('Proprietary')),
+            isbn=cell_text(ids.get('ISBN')),
+            print_issn=cell_text(ids.get('Print_ISSN')),
+            online_issn=cell_text(ids.get('Online_ISSN')),
+            uri=cell_text(ids.get('URI')),
+            yop=cell_text(item.get('YOP')),
+            excel_name=self._filename,
+            row_num=row_num,
+            title_key=None)
+        access_type = self.ACCESS_TYPE[item.get('Access_Type', 'Controlled')]
+
+        # Collect counts by metric type and month, then emit every
+        # month of the reporting period for each metric type seen.
+        counts = {}
+        for performance in item.get('Performance', []):
+            period = performance['Period']['Begin_Date'][0:7] + '-01'
+            for instance in performance.get('Instance', []):
+                metric_type = self.METRIC_TYPE[instance['Metric_Type']]
+                months = counts.setdefault(metric_type, {})
+                months[period] = months.get(period, 0) + int(instance['Count'])
+
+        metrics = []
+        for metric_type in sorted(counts):
+            for period in self._periods():
+                metrics.append(MetricRecord(title_type, access_type, metric_type, period,
+                    counts[metric_type].get(period, 0), self._filename, row_num))
+
+        return title, metrics
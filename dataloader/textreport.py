@@ -0,0 +1,86 @@
+import csv
+import os
+
+from dataloader.tmreport import TitleMasterReport
+
+class TextTitleMasterReport(TitleMasterReport):
+    """
+    Represents a Title Master Report delivered as a TSV or CSV file.
+
+    The R5 Code of Practice allows tabular reports in these formats with the
+    same layout as the Excel version: a 13 row header block, the column
+    names on row 14 and the data from row 15. This class exposes the same
+    interface as TitleMasterReport but reads the file with the csv module,
+    so there is no zip or XML decoding. The delimiter follows the file
+    extension (.tsv or .csv).
+    """
+
+    DELIMITERS = {'.tsv': '\t', '.csv': ','}
+
+    def __init__(self, report_file):
+        self._path = report_file
+        self._delimiter = self.DELIMITERS[os.path.splitext(report_file)[1].lower()]
+        self._filename = os.path.basename(report_file)
+        self._dirname = os.path.dirname(report_file)
+
+        header = self._read_header()
+        self._report_id = self._header_value(header, 1)
+        self._reporting_period = self._header_value(header, 9)
+        self._run_date = self._header_value(header, 10) or None
+        self._columns = [name.strip() for name in header[self.HEADER_ROW - 1] if name.strip()]
+        self._required_columns()
+
+        # The platform is taken from the first data row, like the Platform
+        # cell of the Excel version. Rows are counted and validated by the
+        # first full pass over them, see TitleMasterReport.iter_data_rows.
+        first_row = header[self.HEADER_ROW]
+        platform_col = self._column_index()['Platform']
+        self._platform = first_row[platform_col] if platform_col < len(first_row) else None
+        self._num_rows = None
+        self._platform_names = None
+        self._invalid_rows = None
+
+    def _open(self):
+        return open(self._path, newline='', encoding='utf-8-sig')
+
+    def _read_header(self):
+        """
+        Returns the first HEADER_ROW rows of the file and the first data
+        row.
+        """
+        with self._open() as f:
+            reader = csv.reader(f, delimiter=self._delimiter)
+            return [next(reader, []) for i in range(self.HEADER_ROW + 1)]
+
+    def _header_value(self, header, i):
+        row = header[i]
+        return row[1].strip() if len(row) > 1 else ''
+
+    def close(self):
+        pass
+
+    def _data_cols(self):
+        return range(self.DATA_COL_START, self.DATA_COL_START + len(self._columns))
+
+    def _column_index(self):
+        return {name: i for i, name in enumerate(self._columns)}
+
+    def _iter_rows(self):
+        """
+        Yields (row number, cell values) for each data row. The data ends at
+        the first row with a blank first cell. Short rows are padded, since
+        some exports drop trailing empty cells.
+        """
+        width = len(self._columns)
+        with self._open() as f:
+            reader = csv.reader(f, delimiter=self._delimiter)
+            for i in range(self.HEADER_ROW):
+                next(reader, None)
+            row_num = self.DATA_ROW_START
+            for values in reader:
+                if not values or values[0] == '':
+                    break
+                if len(values) < width:
+                    values = values + [''] * (width - len(values))
+                yield row_num, values
+                row_num += 1
@@ -1,11 +1,12 @@
 import openpyxl
-import pandas as pd
 
 import collections
-import os, csv
+import os
 from datetime import datetime
 
-class TitleMasterReport:
+from dataloader.records import MetricRecord, RecordStream, TitleRecord, cell_text
+
+class TitleMasterReport(RecordStream):
     """
     Represents a Title Master Report.
 
@@ -27,8 +28,13 @@ class TitleMasterReport:
     DATA_ROW_START = 15
     DATA_COL_START = 1
 
-    def __init__(self, workbook):
-        self._workbook = openpyxl.load_workbook(filename=workbook, data_only=True, read_only=True)
+    def __init__(self, workbook, book=None):
+        """
+        Opens the report at path workbook. book may be the same workbook
+        already opened read-only, e.g. by dataloader.pipeline.sniff_report,
+        so the file is not opened twice.
+        """
+        self._workbook = book or openpyxl.load_workbook(filename=workbook, data_only=True, read_only=True)
         self._worksheet = self._workbook.active
         self._report_id = self._worksheet.cell(row=2, column=2).value
         self._reporting_period = self._worksheet.cell(row=10, column=2).value
@@ -36,35 +42,42 @@ class TitleMasterReport:
         self._platform = self._worksheet.cell(row=15, column=4).value
         self._filename = os.path.basename(workbook)
         self._dirname = os.path.dirname(workbook)
+        self._required_columns()
 
-        # Perform checks on important report values.
+        # Row count and validation results are gathered by the first full
+        # pass over the data rows, see iter_data_rows.
+        self._num_rows = None
+        self._platform_names = None
+        self._invalid_rows = None
+
+    def _required_columns(self):
+        """
+        Returns the columns every data row must have a value in.
+        """
         if self._report_id in ['TR_J3', 'TR_B3']:
-            required_columns = ['Title', 'Platform', 'Access_Type', 'Metric_Type']
-        else:
-            assert self._report_id in ['TR_J1', 'TR_B1']
-            required_columns = ['Title', 'Platform', 'Metric_Type']
-        skiprows = self.HEADER_ROW - 1
-        data = pd.read_excel(workbook, skiprows=skiprows, header=0, usecols=required_columns)
-        self._num_rows = data.shape[0]
-
-        # Track the platform names used in the report, because they must be pre-registered
-        # in the platform_ref table to be considered valid.
-        self._platform_names = data['Platform'].unique()
-
-        # Check for rows missing key values and record row numbers
-        data['row_index'] = data.index + (self.HEADER_ROW + 1)
-        invalid_data = data[data.isna().any(axis=1)]
-        invalid_rows = invalid_data['row_index'].values
-        self._invalid_rows = invalid_rows
+            return ['Title', 'Platform', 'Access_Type', 'Metric_Type']
+        assert self._report_id in ['TR_J1', 'TR_B1']
+        return ['Title', 'Platform', 'Metric_Type']
+
+    def _scan(self):
+        """
+        Makes a pass over the data rows to count and check them, unless an
+        earlier pass (e.g. an export) already did.
+        """
+        if self._num_rows is None:
+            for row in self.iter_data_rows():
+                pass
 
     def has_valid_platforms(self, platform_names):
-        is_valid = True
-        for name in self._platform_names:
-            if name not in platform_names:
-                is_valid = False
-        return is_valid
+        """
+        Checks that every platform in the report is registered. The
+        platform_names argument is usually a PlatformResolver, which also
+        accepts encoding and spelling variants of registered names.
+        """
+        return len(self.get_invalid_platforms(platform_names)) == 0
 
     def get_invalid_platforms(self, platform_names):
+        self._scan()
         invalid_names = []
         for name in self._platform_names:
             if name not in platform_names:
@@ -72,16 +85,24 @@ class TitleMasterReport:
         return invalid_names
 
     def has_all_valid_rows(self):
+        self._scan()
         is_valid = len(self._invalid_rows) == 0
         return is_valid
 
     def get_invalid_rows(self):
+        self._scan()
         return self._invalid_rows
 
     @property
     def filename(self):
         return self._filename
 
+    @filename.setter
+    def filename(self, filename):
+        # Records carry the file name, so a report that will be renamed
+        # once it is validated can be exported under its new name.
+        self._filename = filename
+
     @property
     def report_id(self):
         return self._report_id
@@ -155,12 +176,10 @@ class TitleMasterReport:
 
     def num_rows(self):
         """
-        Returns the number of rows loaded into the pandas data frame.
-        Much faster than looping over non-blank rows in the original spreadsheet.
+        Returns the number of data rows.
         """
-        num_rows = self._num_rows
-        #assert(num_rows == len(self.data_rows()))
-        return num_rows
+        self._scan()
+        return self._num_rows
 
     def data_rows(self):
         """
@@ -168,15 +187,8 @@ class TitleMasterReport:
         15 and onwards. The actual number of rows in a given report is
         variable and depends on the publisher.
         """
-
-        n = 0
-        for row in self._worksheet.iter_rows(min_row=self.DATA_ROW_START, min_col=1,
-            max_row=self.MAX_ROWS, max_col=1, values_only=True):
-            if row[0] is None: # When no more data, the first cell in the row will be blank
-                break
-            n += 1
-
-        return range(self.DATA_ROW_START, self.DATA_ROW_START + n)
+        self._scan()
+        return range(self.DATA_ROW_START, self.DATA_ROW_START + self._num_rows)
 
     def _data_cols(self):
         """
@@ -241,106 +253,132 @@ class TitleMasterReport:
         # datetime object containing current date and time
         now = datetime.now()
         dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
+        self._scan()
         print(" found {0:>6} rows ({1}).".format(self._num_rows, dt_string), end='')
 
 
-    def export(self):
+    def _column_index(self):
+        """
+        Returns a dict mapping the column names in the header row to their
+        position in a data row.
+        """
+        header = next(self._worksheet.iter_rows(min_row=self.HEADER_ROW, max_row=self.HEADER_ROW,
+            values_only=True))
+        index = {}
+        for i, name in enumerate(header):
+            if name is None:
+                break
+            index[str(name).strip()] = i
+        return index
+
+    def iter_data_rows(self):
+        """
+        Yields (row number, cell values) for each data row.
+
+        A complete pass also counts the rows and records the platforms
+        used, which must be registered in platform_ref, and the rows
+        missing a required value. A report that is exported is thus
+        validated by the same pass.
+        """
+        columns = self._column_index()
+        required = [columns[name] for name in self._required_columns()]
+        platform_col = columns['Platform']
+        platform_names = []
+        seen = set()
+        invalid_rows = []
+        n = 0
+        for row_num, values in self._iter_rows():
+            if any(i >= len(values) or values[i] is None or values[i] == '' for i in required):
+                invalid_rows.append(row_num)
+            platform = values[platform_col] if platform_col < len(values) else None
+            if platform not in (None, '') and platform not in seen:
+                seen.add(platform)
+                platform_names.append(platform)
+            n += 1
+            yield row_num, values
+        self._num_rows = n
+        self._platform_names = platform_names
+        self._invalid_rows = invalid_rows
+
+    def _iter_rows(self):
         """
-        Makes text files of the raw spreadsheet data for bulk import into the DB.
+        Yields (row number, cell values) for each data row. The data ends at
+        the first row with a blank first cell.
         """
-        # Start with titles data.
-        title_report_temp = '{0}/title_report_temp'.format(self._dirname)
-        with open(title_report_temp, 'w', newline='', encoding='utf-8') as csvfile:
-            csvwriter = csv.writer(csvfile, dialect='excel-tab', lineterminator='\n')
-        
-            # Iterate through the spreadsheet rows starting at the first data row (row 10).
-            datarows = self.data_rows() # Range of rows in the spreadsheet.
-            row_num = min(datarows) # Spreadsheet row number.
-            for row in self._worksheet.iter_rows(min_row=min(datarows), min_col=1, max_row=max(datarows), max_col=11):
-                # Start building a list of field values. The actual fields and their sequence
-                # must correspond to the title_report_temp table. See schema for details.
-                datarow = list()
-                datarow.append('null') # id
-                i = 0
-                while i < len(row):
-                    if i == 1:
-                        datarow.append(self.title_type) # title_type
-                    if i == 6 and self.title_type == 'J':
-                        datarow.append('') # isbn
-                    if i == 9 and self.title_type == 'J':
-                        datarow.append('') # yop
-                        break
-
-                    if row[i].value is None:
-                        datarow.append('')
-                    else:
-                        # Replace newline characters, as they will break any CSV-based mysqlimport command.
-                        value = str(row[i].value)
-                        value = value.replace('\n', ' ').strip()
-                        datarow.append(value)
-                    i += 1
-                datarow.append(self._filename) # excel_name
-                datarow.append(row_num) # row_num
-                datarow.append(0) # title_report_id
-                csvwriter.writerow(datarow)
-                row_num += 1
-
-
-        # Export metrics.
-
-        # The J1 and B1 reports have no "Access Type" column, so different column logic is needed
-        j1_or_b1 = self.report_id in ['TR_J1', 'TR_B1']
-
-        metric_temp = '{0}/metric_temp'.format(self._dirname)
-        with open(metric_temp, 'w', newline='', encoding='utf-8') as csvfile:
-            csvwriter = csv.writer(csvfile, dialect='excel-tab', lineterminator='\n')
+        row_num = self.DATA_ROW_START
+        for values in self._worksheet.iter_rows(min_row=self.DATA_ROW_START, min_col=1,
+            max_row=self.MAX_ROWS, max_col=len(self._data_cols()), values_only=True):
+            if values[0] is None:
+                break
+            yield row_num, values
+            row_num += 1
 
+    def _row_context(self):
+        """
+        Returns what convert_row() needs to know about the layout: the
+        column index, the periods and the position of the first month.
+        """
+        if getattr(self, '_context', None) is None:
+            columns = self._column_index()
             report_begin = datetime.fromisoformat(self.begin_date)
             report_end = datetime.fromisoformat(self.end_date)
+            periods = [datetime(report_begin.year, i, 1).strftime('%Y-%m-%d')
+                for i in range(report_begin.month, report_end.month + 1)]
+            self._context = (columns, periods, columns['Reporting_Period_Total'] + 1)
+        return self._context
 
-            # Iterate through the spreadsheet rows starting at the first data row (row 15).
-            # Period columns either start at J(10) for journals or L(12) for books for B3/J3 reports.
-            if j1_or_b1:
-                min_col = {'J': 9, 'B': 11}
+    def convert_row(self, row_num, values):
+        """
+        Returns the (TitleRecord, [MetricRecord, ...]) pair for a data row.
+
+        Columns are located by their header names, so the same code handles
+        journal and book reports with or without an Access_Type column. One
+        metric record is produced for each month column in the reporting
+        period; the month columns follow Reporting_Period_Total. Raises
+        KeyError for an unknown access or metric type and ValueError for a
+        count that is not a number.
+        """
+        columns, periods, first_month = self._row_context()
+        title_type = self.title_type
+
+        def get(name):
+            if name not in columns:
+                return ''
+            return cell_text(values[columns[name]])
+
+        title = TitleRecord(
+            title=get('Title'),
+            title_type=title_type,
+            publisher=get('Publisher'),
+            publisher_id=get('Publisher_ID'),
+            platform=get('Platform'),
+            doi=get('DOI'),
+            proprietary_id=get('Proprietary_ID'),
+            isbn=get('ISBN'),
+            print_issn=get('Print_ISSN'),
+            online_issn=get('Online_ISSN'),
+            uri=get('URI'),
+            yop=get('YOP'),
+            excel_name=self._filename,
+            row_num=row_num,
+            title_key=None)
+
+        # Access Type column is missing in J1/B1 reports and is assumed to always be "Controlled"
+        if 'Access_Type' in columns:
+            access_type = self.ACCESS_TYPE[get('Access_Type')]
+        else:
+            access_type = self.ACCESS_TYPE['Controlled']
+        metric_type = self.METRIC_TYPE[get('Metric_Type')]
+
+        metrics = []
+        for n, period in enumerate(periods):
+            # If monthly total is missing, treat it as "zero"
+            value = values[first_month + n]
+            if not value:
+                month_total = 0
             else:
-                min_col = {'J': 10, 'B': 12}
-            datarows = self.data_rows()
-            row_num = min(datarows)
-            for row in self._worksheet.iter_rows(min_row=min(datarows), min_col=min_col[self.title_type],
-                max_row=max(datarows), max_col=len(self._data_cols())):
-
-                # A row will be inserted for each month column in the source
-                # spreadsheet. The actual number of months is determined from
-                # the start and end dates contained in the report header.
-                n = 3
-                for i in range(report_begin.month, report_end.month + 1):
-                    period = datetime(report_begin.year, i, 1).strftime('%Y-%m-%d')
-
-                    # If monthly total is missing, treat it as "zero"
-                    if not row[n].value:
-                        month_total = 0
-                    else:
-                        month_total = int(float(row[n].value)) # float conversion deals with cases of '0.0'
-
-                    # Access Type column is missing in J1/B1 reports and is assumed to always be "Controlled"
-                    if j1_or_b1:
-                        access_type = 'Controlled'
-                    else:
-                        access_type = self.ACCESS_TYPE[str(row[0].value).strip()]
-                    metric_type = self.METRIC_TYPE[str(row[1].value).strip()]
-
-                    # Start building a list of field values. The actual fields and their sequence
-                    # must correspond to the title_report_temp table. See schema for details.
-                    datarow = list()
-                    datarow.append('null') # id
-                    datarow.append(0) # title_report_id
-                    datarow.append(self.title_type) # title_type
-                    datarow.append(access_type) # access_type
-                    datarow.append(metric_type) # metric_type
-                    datarow.append(period)
-                    datarow.append(month_total)
-                    datarow.append(self.filename)
-                    datarow.append(row_num)
-                    csvwriter.writerow(datarow)
-                    n += 1
-                row_num += 1
+                month_total = int(float(value)) # float conversion deals with cases of '0.0'
+            metrics.append(MetricRecord(title_type, access_type, metric_type, period,
+                month_total, self._filename, row_num))
+
+        return title, metrics
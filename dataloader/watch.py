@@ -0,0 +1,105 @@
+import fnmatch
+import os
+import time
+
+# inotify_simple is only available on Linux; elsewhere, or without the
+# package, the directory is polled.
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+class DirectoryWatcher:
+    """
+    Watches a report directory for new or changed report files.
+
+    Files are only reported once they have stopped changing: their size and
+    modification time must stay the same for settle_seconds, so a workbook
+    that is still being copied in is not opened half written. Changes are
+    picked up with inotify where available and by scanning the directory
+    every poll_seconds otherwise.
+    """
+
+    def __init__(self, reportdir, patterns, settle_seconds=30, poll_seconds=10):
+        self._reportdir = reportdir
+        self._patterns = patterns
+        self._settle = settle_seconds
+        self._poll = poll_seconds
+        # path -> (size, mtime, time first seen with that size and mtime)
+        self._candidates = {}
+        # path -> (size, mtime) when last reported
+        self._reported = {}
+        self._inotify = None
+        if INotify is not None:
+            self._inotify = INotify()
+            self._inotify.add_watch(reportdir,
+                flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.MODIFY)
+
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None
+
+    def _matches(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self._patterns)
+
+    def _scan(self):
+        return [entry.name for entry in os.scandir(self._reportdir)
+            if entry.is_file() and self._matches(entry.name)]
+
+    def _wait(self, stop_event):
+        """
+        Waits for changes and returns the names of the files that may have
+        changed. With inotify, the wait ends as soon as an event arrives,
+        but never lasts longer than needed to recheck settling files.
+        """
+        timeout = self._settle if self._candidates else self._poll
+        if self._inotify is None:
+            stop_event.wait(min(timeout, self._poll))
+            return self._scan()
+        events = self._inotify.read(timeout=int(min(timeout, self._poll) * 1000))
+        return [event.name for event in events if event.name and self._matches(event.name)]
+
+    def _check(self, name, now):
+        """
+        Returns True if the file has been unchanged for the settle time and
+        was not already reported in this state.
+        """
+        path = os.path.join(self._reportdir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._candidates.pop(path, None)
+            return False
+        state = (stat.st_size, stat.st_mtime)
+        if self._reported.get(path) == state or stat.st_size == 0:
+            self._candidates.pop(path, None)
+            return False
+        previous = self._candidates.get(path)
+        if previous is None or previous[:2] != state:
+            self._candidates[path] = state + (now,)
+            return False
+        if now - previous[2] < self._settle:
+            return False
+        del self._candidates[path]
+        self._reported[path] = state
+        return True
+
+    def changes(self, stop_event):
+        """
+        Yields the paths of report files as they become ready, starting
+        with the files already in the directory, until stop_event is set.
+        """
+        names = self._scan()
+        while not stop_event.is_set():
+            now = time.monotonic()
+            for name in set(names) | {os.path.basename(p) for p in self._candidates}:
+                if self._check(name, now):
+                    yield os.path.join(self._reportdir, name)
+                if stop_event.is_set():
+                    return
+            names = self._wait(stop_event)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
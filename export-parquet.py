@@ -0,0 +1,29 @@
+import argparse
+import sys
+from datetime import datetime
+
+from dataloader.export import ParquetExporter
+
+
+# Exports the usage warehouse to Parquet files partitioned by year and
+# platform, for the BI tools to read instead of querying MySQL.
+#
+# By default only the partitions touched by reports loaded since the last
+# export are rewritten; --full rewrites all of them. loader.py runs the
+# same incremental export after a batch when given --export-parquet.
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage='python export-parquet.py <output directory> [--full]')
+    parser.add_argument('outdir')
+    parser.add_argument('--full', action='store_true',
+        help='rewrite every partition, not only those touched by new loads')
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+    else:
+        args = parser.parse_args()
+        start = datetime.now()
+        n = ParquetExporter(args.outdir).export(full=args.full)
+        print('Exported {0} partitions in {1}'.format(n, str(datetime.now() - start).split('.')[0]))
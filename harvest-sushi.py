@@ -0,0 +1,73 @@
+import argparse
+import os
+import socket
+import sys
+import traceback
+from datetime import datetime
+
+import dataloader.config
+from dataloader.counter_db import LoadJobTable
+from dataloader.pipeline import run_job
+from dataloader.sushi import SushiHarvester, TITLE_REPORTS
+
+
+# Harvests Title Master Reports from the SUSHI servers configured in
+# dataloader.config.sushi and loads them into the database.
+#
+# Downloads run concurrently, one worker thread per (vendor, report), with
+# each vendor rate limited separately. As soon as a download completes, its
+# records are written straight into the temp tables and merged. Each file
+# is queued, claimed and loaded with heartbeats in load_job exactly as by
+# loader.py, so a harvest can run next to loaders on other nodes. The
+# downloaded JSON files are kept in the report directory for reference.
+
+def write_error(err_msg):
+    logfile = open('errors.log', 'at')
+    logfile.write(datetime.now().isoformat() + '\n')
+    logfile.write(err_msg + '\n')
+    logfile.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage='python harvest-sushi.py <report directory> <begin date> <end date> [--reports tr_j3 tr_b3] [--node NAME]')
+    parser.add_argument('reportdir')
+    parser.add_argument('begin_date', help='first month to harvest, e.g. 2022-01-01')
+    parser.add_argument('end_date', help='last month to harvest, e.g. 2022-12-31')
+    parser.add_argument('--reports', nargs='+', choices=TITLE_REPORTS, default=['tr_j3', 'tr_b3'])
+    parser.add_argument('--workers', type=int, default=8, help='concurrent downloads')
+    parser.add_argument('--node', default='{0}:{1}'.format(socket.gethostname(), os.getpid()),
+        help='name of this loader process in load_job, defaults to host:pid')
+    parser.add_argument('--stale-minutes', type=float, default=10,
+        help='take over files whose claim has had no heartbeat for this long')
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+    else:
+        args = parser.parse_args()
+        reportdir = os.path.abspath(args.reportdir)
+        stale_after = int(args.stale_minutes * 60)
+        jobs = LoadJobTable()
+
+        harvester = SushiHarvester(dataloader.config.sushi, reportdir, args.workers)
+        for platform, report_name, result in harvester.harvest(args.begin_date, args.end_date, args.reports):
+            if isinstance(result, Exception):
+                print('{0} {1}: ERROR (see errors.log)'.format(platform, report_name))
+                write_error('{0} {1}\n{2}'.format(platform, report_name,
+                    ''.join(traceback.format_exception(type(result), result, result.__traceback__))))
+                continue
+
+            report = result
+            print('{0} {1}: {2}'.format(platform, report_name, report.filename))
+            jobs.enqueue(reportdir, [report.filename])
+            jobs.requeue_if_changed(reportdir, report.filename,
+                datetime.fromtimestamp(os.path.getmtime(os.path.join(reportdir, report.filename))))
+            job = jobs.claim(reportdir, args.node, [report.filename], stale_after)
+            if job is None:
+                continue
+            message = run_job(job, reportdir, jobs, args.node, heartbeat_interval=max(1, stale_after // 4),
+                report=report, direct=True)
+            if message:
+                print('  ERROR (see errors.log)')
+                write_error(message)
@@ -0,0 +1,105 @@
+import argparse
+import glob
+import os
+import socket
+import sys
+import traceback
+from datetime import datetime
+
+from dataloader.preprocess import SOURCE_PATTERNS, PreprocessError, check_report, load_platforms, sniff_report, \
+    target_name
+
+
+# Checks, renames and loads the vendor files in a directory in one step,
+# in place of preprocess-source-files.py followed by loader.py:
+#
+#   python ingest-reports.py /data/incoming
+#
+# Each file is recognized by its content, checked against platform_ref and
+# renamed to the conventional name (see dataloader/preprocess.py), then
+# loaded like loader.py does. A title report is read once: the pass that
+# writes its staging files also counts its rows and collects the platforms
+# it uses, and the file is only renamed and merged if the checks pass.
+# Files that fail a check keep their name and are logged in errors.log,
+# like those preprocess-source-files.py rejects.
+#
+# With --dry-run, the files are only checked and the name each would get
+# is printed; nothing is renamed or loaded, and platforms are read from
+# sql/platform_ref.txt if there is no database.
+#
+# The loads are recorded in load_job under the new names, so loader.py can
+# retry a failed one later with --retry-failed.
+
+def check_file(f, platform_names):
+    """
+    Returns the name the file would get, or raises PreprocessError.
+    """
+    report = sniff_report(f)
+    try:
+        check_report(report, f, platform_names)
+        return target_name(report, f)
+    finally:
+        report.close()
+
+
+def write_error(err_msg):
+    logfile = open('errors.log', 'at')
+    logfile.write(datetime.now().isoformat() + '\n')
+    logfile.write(err_msg + '\n')
+    logfile.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage='python ingest-reports.py <source directory> [--dry-run] [--verify] [--node NAME]')
+    parser.add_argument('sourcedir')
+    parser.add_argument('--dry-run', action='store_true',
+        help='only check the files and print the names they would get')
+    parser.add_argument('--verify', action='store_true',
+        help='after loading each report, check the loaded totals against it')
+    parser.add_argument('--node', default='{0}:{1}'.format(socket.gethostname(), os.getpid()),
+        help='name of this process in load_job, defaults to host:pid')
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+        sys.exit(0)
+
+    args = parser.parse_args()
+    sourcedir = os.path.abspath(args.sourcedir)
+    files = sorted(f for pattern in SOURCE_PATTERNS for f in glob.glob(os.path.join(sourcedir, pattern)))
+    platform_names = load_platforms()
+
+    if not args.dry_run:
+        # The database is only needed to load.
+        from dataloader.counter_db import LoadJobTable
+        from dataloader.pipeline import ingest_file
+        jobs = LoadJobTable()
+        stagedir = os.path.join(sourcedir, '.staging', args.node.replace(os.sep, '_').replace(':', '_'))
+        os.makedirs(stagedir, exist_ok=True)
+
+    start = datetime.now()
+    counts = {'ok': 0, 'rejected': 0, 'failed': 0}
+    for i, f in enumerate(files):
+        print('({0} of {1}) {2:<50}: '.format(i + 1, len(files), os.path.basename(f)), end='', flush=True)
+        try:
+            if args.dry_run:
+                target, message = check_file(f, platform_names), None
+            else:
+                target, message = ingest_file(f, platform_names, jobs, args.node, stagedir, verify=args.verify)
+            print(target)
+            if message:
+                write_error(message)
+            counts['ok'] += 1
+        except PreprocessError as e:
+            print('REJECTED (see errors.log)')
+            write_error('{0} | {1}'.format(f, e))
+            counts['rejected'] += 1
+        except Exception:
+            print('ERROR (see errors.log)')
+            write_error('{0}\n{1}'.format(f, traceback.format_exc()))
+            counts['failed'] += 1
+
+    print('Finished in {0}: {1} {2}, {3} rejected, {4} failed'.format(
+        str(datetime.now() - start).split('.')[0], counts['ok'], 'checked' if args.dry_run else 'loaded',
+        counts['rejected'], counts['failed']))
@@ -1,90 +1,188 @@
+import argparse
 import glob
 import os
+import socket
 import sys
-import traceback
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
 # For PyCharm Debugging
 #import pydevd_pycharm
 #pydevd_pycharm.settrace('localhost', port=6666, stdoutToServer=True, stderrToServer=True, suspend=False)
 
-from dataloader.counter_db import BulkImport, TitleReportTable, MetricTable, ReportInventoryTable
-from dataloader.jr1report import JR1Report
-from dataloader.tmreport import TitleMasterReport
+from dataloader.counter_db import CounterDb, LoadJobTable
+from dataloader.export import ParquetExporter
+from dataloader.instrument import Instrumentation
+from dataloader.pipeline import run_batch, run_job
 
 
 # Running this script requires two arguments representing the directory
-# containing the Excel COUNTER reports and the year to process.
+# containing the COUNTER reports and the year to process. The reports are
+# expected to have been renamed by preprocess-source-files.py;
+# ingest-reports.py does both steps for each file in one pass.
 #
 # Given that this is a batch process, each spreadsheet in turn will have
 # data extracted and written to the database. Each of the main database
 # tables will be loaded in sequence to ensure dependencies are maintained.
+#
+# Progress is recorded per file in the load_job table. If a run is
+# interrupted, running the same command again skips the files that are
+# done and resumes the others from the last completed step. Files that
+# failed are left alone unless --retry-failed is given.
+#
+# The same command can run on several machines (or several times on one
+# machine) against the same database to share the work. Each process
+# claims one file at a time from load_job and sends heartbeats while it
+# works on it; files claimed by a process that stopped sending heartbeats
+# for --stale-minutes are taken over by the others, so a process only
+# finishes once no file is left claimed by another. Claims are released
+# when a file is done or has failed. For example, to try it with three
+# local processes:
+#
+#   for i in 1 2 3; do python loader.py /data/reports 2022 --node local-$i & done
+#
+# Each process writes its text files to its own staging directory under
+# <report directory>/.staging, and the shared temp tables are used by one
+# process at a time.
+#
+# For a large backfill, --batch-size N claims N files at a time and loads
+# them with one staging cycle: the titles the files share are resolved
+# once and metrics are merged in a few statements per batch, rather than
+# once per file. Every file still gets its own report_inventory row and
+# job state, and a file that fails does not fail the rest of its batch
+# (see load_batch in dataloader/pipeline.py).
+#
+# --instrument prints, after each file, the statements and commits it ran
+# by stage and its most frequent statements, to spot per-row queries (see
+# dataloader/instrument.py). --statement-budget N also checks each file
+# against a maximum of N statements per 1,000 rows and exits with status
+# 1 at the end if any file went over.
+
+# Title reports may be delivered as Excel workbooks or as TSV/CSV text files.
+REPORT_EXTENSIONS = ['xlsx', 'tsv', 'csv']
 
 def write_error(err_msg):
     logfile = open('errors.log', 'at')
     logfile.write(datetime.now().isoformat() + '\n')
     logfile.write(err_msg + '\n')
     logfile.close()
-    
+
+
+def format_eta(started, processed, remaining):
+    """
+    Returns the estimated time left for the batch as a string, based on
+    the average time per file so far in this run.
+    """
+    if processed == 0:
+        return '--:--:--'
+    elapsed = datetime.now() - started
+    eta = timedelta(seconds=int(elapsed.total_seconds() / processed * remaining))
+    return str(eta)
+
+
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(
+        usage='python loader.py <report directory> <year> [--retry-failed] [--node NAME] [--verify] [--merge-connections N] [--batch-size N] [--export-parquet DIR] [--instrument] [--statement-budget N]')
+    parser.add_argument('reportdir')
+    parser.add_argument('year')
+    parser.add_argument('--retry-failed', action='store_true',
+        help='requeue files that failed in an earlier run')
+    parser.add_argument('--node', default='{0}:{1}'.format(socket.gethostname(), os.getpid()),
+        help='name of this loader process in load_job, defaults to host:pid')
+    parser.add_argument('--stale-minutes', type=float, default=10,
+        help='take over files whose claim has had no heartbeat for this long')
+    parser.add_argument('--verify', action='store_true',
+        help='after loading each report, check the loaded totals against it')
+    parser.add_argument('--merge-connections', type=int,
+        help='merge each report over this many connections (see dataloader/merge.py)')
+    parser.add_argument('--batch-size', type=int, default=1,
+        help='load this many files at a time with one staging cycle')
+    parser.add_argument('--export-parquet', metavar='DIR',
+        help='afterwards, rewrite the Parquet partitions touched by this batch')
+    parser.add_argument('--instrument', action='store_true',
+        help='print the database statements run for each file')
+    parser.add_argument('--statement-budget', type=float, metavar='N',
+        help='fail the run if a file takes more than N statements per 1,000 rows (implies --instrument)')
+
     if len(sys.argv) == 1:
-        print('Usage: python loader.py <report directory> <year>')
+        parser.print_usage()
     else:
-        
-        # Begin processing individual reports. If something 
+        args = parser.parse_args()
+        if args.merge_connections:
+            CounterDb.merge_connections = args.merge_connections
+        instrumentation = None
+        if args.instrument or args.statement_budget is not None:
+            instrumentation = Instrumentation(budget=args.statement_budget, echo=True)
+            instrumentation.install()
+
+        # Begin processing individual reports. If something
         # goes wrong, write a log entry and move on to the
         # next report.
-        reportdir = sys.argv[1]
-        reportyr = sys.argv[2]
-        files = glob.glob('{0}/tr*{1}*.xlsx'.format(reportdir, reportyr))
+        reportdir = os.path.abspath(args.reportdir)
+        files = []
+        for ext in REPORT_EXTENSIONS:
+            files.extend(glob.glob('{0}/[ijt]r*{1}*.{2}'.format(reportdir, args.year, ext)))
         files.sort()
 
-        trt = TitleReportTable()
-        mt = MetricTable()
-        inv = ReportInventoryTable()
-        for f in files:
-            try:
-
-                # Instantiate the report instance according to the report
-                # version, i.e. COUNTER R4 or R5. 
-                if os.path.basename(f).startswith('jr'):
-                    report = JR1Report(f)
-                if os.path.basename(f).startswith('tr'):
-                    report = TitleMasterReport(f)
-                
-                # Check if spreadsheet has already been loaded. A record of
-                # which reports have been loaded and when is maintained in
-                # the inventory table.
-                is_loaded = inv.is_loaded(report)
-                if not is_loaded:
-                    print(os.path.basename(f))
-
-                    # Process the data in the spreadsheet. The method currently
-                    # used relies on the use of temporary tables that are bulk
-                    # loaded from CSV versions of the spreadsheet data. Inserts
-                    # and updates are then handled from the temp tables.
-                    load_start = datetime.now().isoformat()
-
-                    # First step is to export title and metric data from the report
-                    # into equivalent CSV files.
-                    report.export()
-
-                    # Next step is bulk importing of CSV files into temp tables.
-                    bi = BulkImport(reportdir)
-                    bi.import_all()
-                    
-                    # Finally, perform inserts into main tables from the temps.
-                    trt.insert_from_temp()
-                    mt.insert_from_temp()
-
-                    load_end = datetime.now().isoformat()
-                    
-                    # Update the report inventory.
-                    inv.insert(report, load_start, load_end)
-
-                    # Clean up.
-                    report.close()
-                    
-            except Exception as e:
-                write_error('{0}\n{1}'.format(f, traceback.format_exc()))
+        jobs = LoadJobTable()
+        jobs.enqueue(reportdir, files)
+        pending = [job for job in jobs.pending(reportdir, args.retry_failed)
+            if os.path.join(reportdir, job.excel_name) in files]
+        counts = jobs.counts(reportdir)
+        print('{0} files: {1} done, {2} failed, {3} to process'.format(
+            len(files), counts['done'], counts['failed'], len(pending)))
+
+        stagedir = os.path.join(reportdir, '.staging', args.node.replace(os.sep, '_').replace(':', '_'))
+        os.makedirs(stagedir, exist_ok=True)
+        names = [os.path.basename(f) for f in files]
+        stale_after = int(args.stale_minutes * 60)
+
+        batch_start = datetime.now()
+        n = 0
+        while True:
+            # A node may claim its own jobs again, so the files already in
+            # the batch are left out of the next claim.
+            batch = []
+            while len(batch) < args.batch_size:
+                claimed = [j.excel_name for j in batch]
+                job = jobs.claim(reportdir, args.node, [f for f in names if f not in claimed], stale_after)
+                if job is None:
+                    break
+                batch.append(job)
+            if not batch:
+                # Files claimed by other nodes are left to them, but if a
+                # node has died, its files can be taken over once its
+                # claims go stale, so the run waits for them.
+                waiting = jobs.claimed_elsewhere(reportdir, args.node, names)
+                if not waiting:
+                    break
+                print('Waiting for {0} files claimed by other nodes'.format(waiting))
+                time.sleep(max(1, stale_after // 4))
+                continue
+            remaining = jobs.counts(reportdir)
+            remaining = sum(remaining[s] for s in ('queued', 'parsed', 'staged', 'merged'))
+            print('({0} by this node, {1} left, ETA {2}) {3}'.format(n + 1, remaining,
+                format_eta(batch_start, n, remaining), ', '.join(job.excel_name for job in batch)))
+            if len(batch) == 1:
+                messages = [run_job(batch[0], reportdir, jobs, args.node, stagedir,
+                    heartbeat_interval=max(1, stale_after // 4), verify=args.verify)]
+            else:
+                messages = run_batch(batch, reportdir, jobs, args.node, stagedir,
+                    heartbeat_interval=max(1, stale_after // 4), verify=args.verify)
+            for message in messages:
+                if message:
+                    write_error(message)
+            n += len(batch)
+
+        counts = jobs.counts(reportdir)
+        print('Finished in {0}: {1} done, {2} failed'.format(
+            str(datetime.now() - batch_start).split('.')[0], counts['done'], counts['failed']))
+
+        if args.export_parquet:
+            ParquetExporter(args.export_parquet).export()
+
+        if instrumentation is not None and instrumentation.over_budget():
+            print('Over the budget of {0} statements per 1,000 rows: {1}'.format(args.statement_budget,
+                ', '.join(stats.name for stats in instrumentation.over_budget())))
+            sys.exit(1)
@@ -0,0 +1,130 @@
+import sys
+
+from dataloader.counter_db import CounterDb
+from dataloader.normalize import title_key
+
+
+# One-off migration that adds the title_key column to an existing counter5
+# database. New databases created from sql/counter-r5.sql already have it.
+#
+# The migration runs in four steps:
+#
+#   1. Add a nullable title_key column to title_report and title_report_temp.
+#   2. Compute the key for every existing title_report row in batches.
+#   3. Merge titles that now share a key. Before the key existed, escaped
+#      titles never matched their stored (unescaped) form, so the same title
+#      may have been inserted more than once. Metric rows are moved to the
+#      lowest id; where both rows have a value for the same period, the
+#      value already on the surviving title is kept.
+#   4. Make the column NOT NULL and replace idx_dupe_check with the unique
+#      idx_title_key index.
+#
+# The script can safely be re-run; steps already done are skipped.
+
+BATCH_SIZE = 5000
+
+
+def has_column(cursor, table, column):
+    sql = u"SELECT COUNT(*) FROM information_schema.columns \
+        WHERE table_schema = DATABASE() \
+        AND table_name = %s \
+        AND column_name = %s"
+    cursor.execute(sql, (table, column))
+    return cursor.fetchone()[0] > 0
+
+
+def has_index(cursor, table, index):
+    sql = u"SELECT COUNT(*) FROM information_schema.statistics \
+        WHERE table_schema = DATABASE() \
+        AND table_name = %s \
+        AND index_name = %s"
+    cursor.execute(sql, (table, index))
+    return cursor.fetchone()[0] > 0
+
+
+def add_columns(conn):
+    cursor = conn.cursor()
+    if not has_column(cursor, 'title_report', 'title_key'):
+        cursor.execute('ALTER TABLE title_report \
+            ADD COLUMN title_key CHAR(40) CHARACTER SET ascii NULL AFTER yop')
+    if not has_column(cursor, 'title_report_temp', 'title_key'):
+        cursor.execute('ALTER TABLE title_report_temp \
+            ADD COLUMN title_key CHAR(40) CHARACTER SET ascii NULL')
+
+
+def backfill_keys(conn):
+    """
+    Computes title_key for all rows that do not have one yet. Rows are read
+    in id order, one batch at a time, so memory use stays flat.
+    """
+    select_sql = u"SELECT id, title, publisher, isbn, yop FROM title_report \
+        WHERE title_key IS NULL AND id > %s ORDER BY id LIMIT %s"
+    update_sql = u"UPDATE title_report SET title_key = %s WHERE id = %s"
+    cursor = conn.cursor()
+    last_id = 0
+    total = 0
+    while True:
+        cursor.execute(select_sql, (last_id, BATCH_SIZE))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        params = [(title_key(title, publisher, isbn, yop), rowid)
+            for (rowid, title, publisher, isbn, yop) in rows]
+        cursor.executemany(update_sql, params)
+        conn.commit()
+        last_id = rows[-1][0]
+        total += len(rows)
+        print(' keyed {0} titles'.format(total))
+
+
+def merge_duplicates(conn):
+    """
+    Collapses titles sharing (platform_id, title_key) onto the lowest id.
+    """
+    cursor = conn.cursor()
+    cursor.execute(u"SELECT platform_id, title_key, MIN(id), COUNT(*) \
+        FROM title_report \
+        GROUP BY platform_id, title_key \
+        HAVING COUNT(*) > 1")
+    groups = cursor.fetchall()
+    for (platform_id, key, keep_id, count) in groups:
+        cursor.execute(u"SELECT id FROM title_report \
+            WHERE platform_id = %s AND title_key = %s AND id <> %s",
+            (platform_id, key, keep_id))
+        dupe_ids = [row[0] for row in cursor.fetchall()]
+        for dupe_id in dupe_ids:
+            # Rows that would collide with an existing metric on the
+            # surviving title stay behind and are removed with the dupe.
+            cursor.execute(u"UPDATE IGNORE metric SET title_report_id = %s \
+                WHERE title_report_id = %s", (keep_id, dupe_id))
+            cursor.execute(u"DELETE FROM metric WHERE title_report_id = %s", (dupe_id,))
+            cursor.execute(u"DELETE FROM title_report WHERE id = %s", (dupe_id,))
+        conn.commit()
+    print(' merged {0} duplicate title groups'.format(len(groups)))
+
+
+def add_unique_index(conn):
+    cursor = conn.cursor()
+    cursor.execute('ALTER TABLE title_report \
+        MODIFY title_key CHAR(40) CHARACTER SET ascii NOT NULL')
+    if has_index(cursor, 'title_report', 'idx_dupe_check'):
+        cursor.execute('ALTER TABLE title_report DROP INDEX idx_dupe_check')
+    if not has_index(cursor, 'title_report', 'idx_title_key'):
+        cursor.execute('ALTER TABLE title_report \
+            ADD UNIQUE INDEX idx_title_key (platform_id, title_key)')
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        print('Usage: python migrate-title-key.py')
+    else:
+        conn = CounterDb.conn
+        print('Adding title_key columns')
+        add_columns(conn)
+        print('Computing title keys')
+        backfill_keys(conn)
+        print('Merging duplicate titles')
+        merge_duplicates(conn)
+        print('Adding unique index')
+        add_unique_index(conn)
@@ -1,9 +1,6 @@
 import os, glob, sys
-import openpyxl
 import datetime
-from dataloader.jr1report import JR1Report
-from dataloader.tmreport import TitleMasterReport
-from dataloader.counter_db import PlatformTable
+from dataloader.preprocess import SOURCE_PATTERNS, check_report, load_platforms, sniff_report, target_name
 
 
 # For PyCharm Debugging
@@ -17,8 +14,9 @@ from dataloader.counter_db import PlatformTable
 # 
 # The first step in the renaming process is to copy all files to be loaded into
 # a working directory, separate from where they are normally kept on the Q: drive.
-# The following code assumes all files are Excel (.xlsx) files. The common file
-# is constructed from data contained within the Excel file itself:
+# The following code assumes all files are Excel (.xlsx) files, or TSV/CSV
+# text files for vendors delivering those. The common file name is constructed
+# from data contained within the file itself, keeping the original extension:
 #
 # <version>-<platform>-<year>-<date range>.xlsx
 #
@@ -29,6 +27,10 @@ from dataloader.counter_db import PlatformTable
 #
 # Once all the files have been renamed, they can be processed. If any errors
 # occur, the offending file will be logged in an error log.
+#
+# ingest-reports.py does the same checks and renaming and loads each file
+# in the same pass; this script only checks and renames (see
+# dataloader/preprocess.py).
 
 def log_message(error_message):
     """Write message to log file with locale-specific timestamp
@@ -45,81 +47,31 @@ def get_timestamp():
     return timestamp
 
 
-class CounterReport:
-    """
-    Represents a COUNTER report in Excel format.
-    """
-
-    def __init__(self, file):
-        self._workbook = openpyxl.load_workbook(filename=file, data_only=True)
-        self._worksheet = self._workbook.active
-        self._a1 = self._worksheet.cell(row=1, column=1).value
-        self._version = None
-        self._report = None
-        if self._a1.startswith('Journal Report 1'):
-            raise Exception("JR1Report is no longer supported with version 5 of Counter specification.")
-            self._report = JR1Report(file)
-            self._version = 'jr1'
-        elif self._a1 == 'Report_Name':
-            self._report = TitleMasterReport(file)
-            self._version = self._report.report_id.lower().replace('_', '-')
-        else:
-            raise Exception
-
-    def report(self):
-        return self._report
-
-    @property
-    def version(self):
-        return self._version
-
-
 if __name__ == "__main__":
 
     os.chdir(sys.argv[1])
-    files = glob.glob('TR*.xl*')
+    files = [f for pattern in SOURCE_PATTERNS for f in glob.glob(pattern)]
     files.sort()
     num_files = len(files)
     num_files_processed = 0
-    platform_table = PlatformTable()
-    platform_names = platform_table.get_platform_names()
+    platform_names = load_platforms()
 
     log_message("\n\n")
     log_message("   ### Started preprocessing at:  " + get_timestamp() + "\n")
     for f in files:
         num_files_processed += 1
-        sourcefile = f
         filename = os.path.basename(f)
         print(" ({0} of {1}): {2:<50}: ".format(num_files_processed, num_files, filename), end='')
         try:
-            source = CounterReport(f)
-            report = source.report()
-            report.print_stats()
-            report_year = report.begin_date[0:4]
-            report_range = report.begin_date[5:7] + report.end_date[5:7]
-            if report.has_all_valid_rows() and report.has_valid_platforms(platform_names):
-                targetfile = '{0}-{1}-{2}-{3}.xlsx'.format(
-                    source.version,
-                    report.platform.lower().replace(' ', '-').replace(':', ''),
-                    report_year,
-                    report_range)
-                os.rename(sourcefile, targetfile)
-                print('\n')
-            elif not report.has_all_valid_rows():
-                error_msg = '{0}:  is missing one of (Title, Platform, Access_Type, Metric_Type) on these rows: ['.format(f)
-                invalid_rows = report.get_invalid_rows()
-                for row in invalid_rows:
-                    error_msg += ' {0}'.format(row)
-                error_msg += ' ]\n\n'
-                raise Exception(error_msg)
-            else:
-                invalid_platforms = report.get_invalid_platforms(platform_names)
-                assert (len(invalid_platforms) > 0)
-                error_msg = '{0}:  has these platforms not present in the platform_ref table: ['.format(f)
-                for platform in invalid_platforms:
-                    error_msg += ' "{0}"'.format(platform)
-                error_msg += ' ]\n\n'
-                raise Exception(error_msg)
+            report = sniff_report(f)
+            try:
+                report.print_stats()
+                check_report(report, f, platform_names)
+                targetfile = target_name(report, f)
+            finally:
+                report.close()
+            os.rename(f, targetfile)
+            print('\n')
         except Exception as e:
             print("  ERROR: failed to preprocess (see errors.log)\n")
             err_message = '{0} | {1}\n'.format(f, e)
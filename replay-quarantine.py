@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+import traceback
+from datetime import datetime
+from itertools import groupby
+
+from dataloader.counter_db import QuarantineTable
+from dataloader.pipeline import open_report, replay_quarantine
+
+
+# Loads report rows that were quarantined during an earlier load, after
+# they have been fixed. A row is fixed either by editing its row_data (the
+# raw cell values as a JSON array) in the quarantine table, or by changing
+# the reference data or code that rejected it.
+#
+# Each report file is opened again so its rows are converted with the same
+# layout as the original load. Rows that still fail stay in quarantine
+# with an updated reason. The report must still be in the inventory: the
+# replayed rows are tagged with its load id, and the report is marked
+# changed, so cached filter results are dropped and the next incremental
+# export rewrites its partitions.
+
+def write_error(err_msg):
+    logfile = open('errors.log', 'at')
+    logfile.write(datetime.now().isoformat() + '\n')
+    logfile.write(err_msg + '\n')
+    logfile.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage='python replay-quarantine.py [--file <report file name>] [--list]')
+    parser.add_argument('--file', help='only replay the rows of this report')
+    parser.add_argument('--list', action='store_true',
+        help='list the quarantined rows instead of replaying them')
+    args = parser.parse_args()
+
+    rows = QuarantineTable().pending(args.file)
+    if not rows:
+        print('No quarantined rows')
+        sys.exit(0)
+
+    for (reportdir, excel_name), group in groupby(rows, key=lambda r: (r.report_dir, r.excel_name)):
+        group = list(group)
+        if args.list:
+            for row in group:
+                print('{0} row {1}: {2}'.format(excel_name, row.row_num, row.reason))
+            continue
+
+        f = os.path.join(reportdir, excel_name)
+        try:
+            report = open_report(f)
+            loaded = replay_quarantine(report, group)
+            report.close()
+            print('{0}: {1} of {2} rows loaded'.format(excel_name, loaded, len(group)))
+        except Exception:
+            print('{0}: ERROR (see errors.log)'.format(excel_name))
+            write_error('{0}\n{1}'.format(f, traceback.format_exc()))
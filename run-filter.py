@@ -0,0 +1,44 @@
+import argparse
+import sys
+
+from dataloader.counter_db import FilterTable
+from dataloader.filters import FilterEngine, FilterError
+
+
+# Runs a saved filter from the filter table and prints a page of its
+# results as tab separated text. Without a filter id, lists the saved
+# filters. See dataloader/filters.py for the params format.
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage='python run-filter.py [<filter id>] [--page N] [--page-size N] [--sql]')
+    parser.add_argument('filter_id', nargs='?', type=int)
+    parser.add_argument('--page', type=int, default=1)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--sql', action='store_true', help='print the compiled SQL instead')
+    args = parser.parse_args()
+
+    if args.filter_id is None:
+        for row in FilterTable().get_filters():
+            print('{0}\t{1}\t{2}\t{3}'.format(row.id, row.title_type, row.name, row.params))
+        sys.exit(0)
+
+    engine = FilterEngine()
+    try:
+        if args.sql:
+            sql, values = engine.compile(args.filter_id)
+            print(' '.join(sql.split()))
+            print(values)
+            sys.exit(0)
+        result = engine.run(args.filter_id, args.page, args.page_size)
+    except FilterError as e:
+        print(e)
+        sys.exit(1)
+
+    if result.rows:
+        print('\t'.join(result.rows[0]._fields))
+    for row in result.rows:
+        print('\t'.join(str(v) for v in row))
+    print('Page {0} of {1} ({2} rows, data version {3})'.format(result.page,
+        max(1, -(-result.total_rows // result.page_size)), result.total_rows, result.data_version))
@@ -0,0 +1,11 @@
+-- Adds the data_version table to an existing counter5 database. The
+-- loader increments the version with every report_inventory insert, and
+-- cached filter results are keyed by it.
+
+CREATE TABLE IF NOT EXISTS data_version (
+    id TINYINT NOT NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (id)
+);
+
+INSERT IGNORE INTO data_version (id, version) VALUES (1, 0);
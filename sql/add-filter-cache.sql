@@ -0,0 +1,12 @@
+-- Adds the filter_cache table to an existing counter5 database. Filter
+-- results are stored there, keyed by the hash of the compiled filter and
+-- the data version, so that a run of run-filter.py can reuse the result
+-- of an earlier one.
+
+CREATE TABLE IF NOT EXISTS filter_cache (
+    filter_hash CHAR(40) NOT NULL,
+    data_version BIGINT NOT NULL,
+    result LONGTEXT NOT NULL,
+    cached_at DATETIME NOT NULL,
+    PRIMARY KEY (filter_hash, data_version)
+);
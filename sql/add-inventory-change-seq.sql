@@ -0,0 +1,17 @@
+-- Adds report_inventory.change_seq to an existing counter5 database. Each
+-- completed load records the data version it bumped there, and the
+-- Parquet export (dataloader/export.py) rewrites the partitions of rows
+-- with a change_seq above the last one it exported.
+--
+-- Existing completed rows are numbered in id order, and the version is
+-- raised past them if needed. Run export-parquet.py --full once
+-- afterwards.
+
+ALTER TABLE report_inventory
+    ADD COLUMN change_seq BIGINT NULL AFTER load_date,
+    ADD INDEX idx_change_seq (change_seq);
+
+SET @seq = 0;
+UPDATE report_inventory SET change_seq = (@seq := @seq + 1)
+    WHERE load_end IS NOT NULL ORDER BY id;
+UPDATE data_version SET version = GREATEST(version, @seq) WHERE id = 1;
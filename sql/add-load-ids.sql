@@ -0,0 +1,42 @@
+-- Adds the load id columns to an existing counter5 database. The loader
+-- tags every title_report and metric row it writes with the
+-- report_inventory id of the report, and keeps the values it overwrote in
+-- the prev_ columns, so unload-report.py can take a report back out.
+-- Rows loaded before this ran have no load id and are never unloaded.
+--
+-- Run this before sql/use-metric-wide.sql. If the database already uses
+-- the wide layout, metric is a view: leave out the ALTER TABLE metric
+-- statement. Leave out the ALTER TABLE metric_wide statement if the
+-- database has no metric_wide table.
+
+ALTER TABLE title_report
+    ADD COLUMN load_id INT NULL AFTER title_key,
+    ADD INDEX idx_load_id (load_id);
+
+ALTER TABLE metric
+    ADD COLUMN load_id INT NULL AFTER period_total,
+    ADD COLUMN prev_period_total INT NULL AFTER load_id,
+    ADD COLUMN prev_load_id INT NULL AFTER prev_period_total,
+    ADD INDEX idx_load_id (load_id, title_report_id);
+
+ALTER TABLE metric_wide
+    ADD COLUMN load_id INT NULL,
+    ADD COLUMN prev_months SMALLINT UNSIGNED NULL,
+    ADD COLUMN prev_m01 INT NULL,
+    ADD COLUMN prev_m02 INT NULL,
+    ADD COLUMN prev_m03 INT NULL,
+    ADD COLUMN prev_m04 INT NULL,
+    ADD COLUMN prev_m05 INT NULL,
+    ADD COLUMN prev_m06 INT NULL,
+    ADD COLUMN prev_m07 INT NULL,
+    ADD COLUMN prev_m08 INT NULL,
+    ADD COLUMN prev_m09 INT NULL,
+    ADD COLUMN prev_m10 INT NULL,
+    ADD COLUMN prev_m11 INT NULL,
+    ADD COLUMN prev_m12 INT NULL,
+    ADD COLUMN prev_load_id INT NULL,
+    ADD INDEX idx_load_id (load_id, title_report_id);
+
+-- A report's inventory row is written when its load starts and completed
+-- when it is done.
+ALTER TABLE report_inventory MODIFY load_end DATETIME NULL;
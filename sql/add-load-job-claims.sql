@@ -0,0 +1,7 @@
+-- Adds the claim columns to the load_job table of an existing counter5
+-- database, so several loader processes can share the queue. Requires
+-- MySQL 8.0 or later for SELECT ... FOR UPDATE SKIP LOCKED.
+
+ALTER TABLE load_job
+    ADD COLUMN claimed_by VARCHAR(100) NULL AFTER finished_at,
+    ADD COLUMN heartbeat_at DATETIME NULL AFTER claimed_by;
@@ -0,0 +1,10 @@
+-- Adds the platform_alias table to an existing counter5 database.
+-- Aliases map alternative platform names found in reports to a
+-- platform_ref row, in addition to the normalized name matching.
+
+CREATE TABLE IF NOT EXISTS platform_alias (
+    alias VARCHAR(100) NOT NULL,
+    platform_id INT NOT NULL,
+    PRIMARY KEY (alias),
+    FOREIGN KEY fk_alias_platform_id (platform_id) REFERENCES platform_ref (id)
+);
@@ -0,0 +1,16 @@
+-- Adds the quarantine table to an existing counter5 database. Rows that
+-- cannot be loaded are kept here, with the reason and the raw cell values
+-- as JSON, until replay-quarantine.py loads them.
+
+CREATE TABLE IF NOT EXISTS quarantine (
+    id INT AUTO_INCREMENT,
+    report_dir VARCHAR(255) NOT NULL,
+    excel_name VARCHAR(100) NOT NULL,
+    row_num INT NOT NULL,
+    reason VARCHAR(255) NOT NULL,
+    row_data TEXT NOT NULL,
+    quarantined_at DATETIME NOT NULL,
+    replayed_at DATETIME NULL,
+    PRIMARY KEY (id),
+    UNIQUE INDEX idx_report_dir_excel_name_row_num (report_dir, excel_name, row_num)
+);
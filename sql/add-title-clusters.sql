@@ -0,0 +1,18 @@
+-- Adds the title cluster tables to an existing counter5 database. The
+-- loader places every new title_report row in a cluster; run
+-- build-title-clusters.py once afterwards to cluster the titles already
+-- loaded.
+
+CREATE TABLE IF NOT EXISTS title_cluster (
+    title_report_id INT NOT NULL,
+    cluster_id INT NOT NULL,
+    PRIMARY KEY (title_report_id),
+    INDEX idx_cluster_id (cluster_id)
+);
+
+CREATE TABLE IF NOT EXISTS title_cluster_key (
+    norm_key VARCHAR(20) CHARACTER SET ascii NOT NULL,
+    cluster_id INT NOT NULL,
+    PRIMARY KEY (norm_key),
+    INDEX idx_cluster_id (cluster_id)
+);
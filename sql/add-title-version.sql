@@ -0,0 +1,6 @@
+-- Adds the titles counter to data_version in an existing counter5
+-- database. unload-report.py increments it when it deletes title_report
+-- rows, and running loaders then drop their cached title ids (see
+-- TitleReportTable in dataloader/counter_db.py).
+
+INSERT IGNORE INTO data_version (id, version) VALUES (2, 0);
@@ -0,0 +1,334 @@
+-- Embedded DuckDB version of counter-r5.sql, used with backend = 'duckdb'.
+--
+--   duckdb counter5.duckdb < sql/counter-r5-duckdb.sql
+--
+-- Differences from the MySQL schema:
+--   - AUTO_INCREMENT ids use sequences.
+--   - access_type, access_method and metric_type are stored as the numeric
+--     codes the loader stages; the *_ref tables hold their names.
+--   - Foreign keys and secondary indexes are left out. DuckDB scans columns
+--     quickly, and only the unique keys used by the upserts are declared.
+
+CREATE SEQUENCE seq_title_report;
+CREATE SEQUENCE seq_title_report_temp;
+CREATE SEQUENCE seq_metric;
+CREATE SEQUENCE seq_metric_temp;
+CREATE SEQUENCE seq_metric_wide_temp;
+CREATE SEQUENCE seq_item_report;
+CREATE SEQUENCE seq_item_metric;
+CREATE SEQUENCE seq_filter;
+CREATE SEQUENCE seq_report_inventory;
+CREATE SEQUENCE seq_load_job;
+CREATE SEQUENCE seq_quarantine;
+
+CREATE TABLE access_type_ref (id UTINYINT PRIMARY KEY, name VARCHAR NOT NULL);
+INSERT INTO access_type_ref VALUES (1, 'Controlled'), (2, 'OA_Gold'), (3, 'Other_Free_To_Read');
+
+CREATE TABLE access_method_ref (id UTINYINT PRIMARY KEY, name VARCHAR NOT NULL);
+INSERT INTO access_method_ref VALUES (1, 'Regular'), (2, 'TDM');
+
+CREATE TABLE metric_type_ref (id UTINYINT PRIMARY KEY, name VARCHAR NOT NULL);
+INSERT INTO metric_type_ref VALUES (1, 'Total_Item_Investigations'), (2, 'Total_Item_Requests'),
+    (3, 'Unique_Item_Investigations'), (4, 'Unique_Item_Requests'), (5, 'Unique_Title_Investigations'),
+    (6, 'Unique_Title_Requests'), (7, 'Limit_Exceeded'), (8, 'No_License');
+
+CREATE TABLE platform_ref (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR NOT NULL,
+    preferred_name VARCHAR NOT NULL,
+    has_faq TINYINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE platform_alias (
+    alias VARCHAR PRIMARY KEY,
+    platform_id INTEGER NOT NULL
+);
+
+CREATE TABLE title_report (
+    id INTEGER PRIMARY KEY DEFAULT nextval('seq_title_report'),
+    title VARCHAR NOT NULL,
+    title_type CHAR(1) NOT NULL,
+    publisher VARCHAR,
+    publisher_id VARCHAR,
+    platform_id INTEGER NOT NULL,
+    doi VARCHAR,
+    proprietary_id VARCHAR,
+    isbn VARCHAR,
+    print_issn VARCHAR,
+    online_issn VARCHAR,
+    uri VARCHAR,
+    yop VARCHAR,
+    title_key VARCHAR NOT NULL,
+    load_id INTEGER,
+    create_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    update_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (platform_id, title_key)
+);
+
+CREATE TABLE title_cluster (
+    title_report_id INTEGER PRIMARY KEY,
+    cluster_id INTEGER NOT NULL
+);
+
+CREATE TABLE title_cluster_key (
+    norm_key VARCHAR PRIMARY KEY,
+    cluster_id INTEGER NOT NULL
+);
+
+CREATE TABLE title_report_temp (
+    id INTEGER PRIMARY KEY DEFAULT nextval('seq_title_report_temp'),
+    title VARCHAR,
+    title_type CHAR(1),
+    publisher VARCHAR,
+    publisher_id VARCHAR,
+    platform VARCHAR,
+    doi VARCHAR,
+    proprietary_id VARCHAR,
+    isbn VARCHAR,
+    print_issn VARCHAR,
+    online_issn VARCHAR,
+    uri VARCHAR,
+    yop VARCHAR,
+    excel_name VARCHAR,
+    row_num INTEGER,
+    title_report_id INTEGER,
+    title_key VARCHAR
+);
+
+CREATE TABLE metric (
+    id BIGINT PRIMARY KEY DEFAULT nextval('seq_metric'),
+    title_report_id INTEGER NOT NULL,
+    title_type CHAR(1) NOT NULL,
+    access_type UTINYINT NOT NULL,
+    metric_type UTINYINT NOT NULL,
+    period DATE NOT NULL,
+    period_total INTEGER NOT NULL DEFAULT 0,
+    load_id INTEGER,
+    prev_period_total INTEGER,
+    prev_load_id INTEGER,
+    create_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    update_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (title_report_id, access_type, metric_type, period)
+);
+
+CREATE TABLE metric_temp (
+    id INTEGER PRIMARY KEY DEFAULT nextval('seq_metric_temp'),
+    title_report_id INTEGER,
+    title_type CHAR(1),
+    access_type UTINYINT,
+    metric_type UTINYINT,
+    period DATE,
+    period_total INTEGER,
+    excel_name VARCHAR,
+    row_num INTEGER
+);
+
+CREATE TABLE metric_wide (
+    title_report_id INTEGER NOT NULL,
+    title_type CHAR(1) NOT NULL,
+    access_type UTINYINT NOT NULL,
+    metric_type UTINYINT NOT NULL,
+    year SMALLINT NOT NULL,
+    months USMALLINT NOT NULL DEFAULT 0,
+    m01 INTEGER NOT NULL DEFAULT 0,
+    m02 INTEGER NOT NULL DEFAULT 0,
+    m03 INTEGER NOT NULL DEFAULT 0,
+    m04 INTEGER NOT NULL DEFAULT 0,
+    m05 INTEGER NOT NULL DEFAULT 0,
+    m06 INTEGER NOT NULL DEFAULT 0,
+    m07 INTEGER NOT NULL DEFAULT 0,
+    m08 INTEGER NOT NULL DEFAULT 0,
+    m09 INTEGER NOT NULL DEFAULT 0,
+    m10 INTEGER NOT NULL DEFAULT 0,
+    m11 INTEGER NOT NULL DEFAULT 0,
+    m12 INTEGER NOT NULL DEFAULT 0,
+    load_id INTEGER,
+    prev_months USMALLINT,
+    prev_m01 INTEGER,
+    prev_m02 INTEGER,
+    prev_m03 INTEGER,
+    prev_m04 INTEGER,
+    prev_m05 INTEGER,
+    prev_m06 INTEGER,
+    prev_m07 INTEGER,
+    prev_m08 INTEGER,
+    prev_m09 INTEGER,
+    prev_m10 INTEGER,
+    prev_m11 INTEGER,
+    prev_m12 INTEGER,
+    prev_load_id INTEGER,
+    PRIMARY KEY (title_report_id, access_type, metric_type, year)
+);
+
+CREATE TABLE metric_wide_temp (
+    id INTEGER PRIMARY KEY DEFAULT nextval('seq_metric_wide_temp'),
+    title_report_id INTEGER,
+    title_type CHAR(1),
+    access_type UTINYINT,
+    metric_type UTINYINT,
+    year SMALLINT,
+    months USMALLINT,
+    m01 INTEGER,
+    m02 INTEGER,
+    m03 INTEGER,
+    m04 INTEGER,
+    m05 INTEGER,
+    m06 INTEGER,
+    m07 INTEGER,
+    m08 INTEGER,
+    m09 INTEGER,
+    m10 INTEGER,
+    m11 INTEGER,
+    m12 INTEGER,
+    excel_name VARCHAR,
+    row_num INTEGER
+);
+
+CREATE TABLE item_report (
+    id INTEGER PRIMARY KEY DEFAULT nextval('seq_item_report'),
+    item VARCHAR NOT NULL,
+    data_type VARCHAR,
+    publisher VARCHAR,
+    publisher_id VARCHAR,
+    platform_id INTEGER NOT NULL,
+    authors VARCHAR,
+    publication_date VARCHAR,
+    article_version VARCHAR,
+    doi VARCHAR,
+    proprietary_id VARCHAR,
+    isbn VARCHAR,
+    print_issn VARCHAR,
+    online_issn VARCHAR,
+    uri VARCHAR,
+    parent_title VARCHAR,
+    parent_data_type VARCHAR,
+    parent_doi VARCHAR,
+    parent_proprietary_id VARCHAR,
+    parent_isbn VARCHAR,
+    parent_print_issn VARCHAR,
+    parent_online_issn VARCHAR,
+    parent_uri VARCHAR,
+    yop VARCHAR,
+    item_key VARCHAR NOT NULL,
+    create_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (platform_id, item_key)
+);
+
+CREATE TABLE item_report_temp (
+    item VARCHAR,
+    data_type VARCHAR,
+    publisher VARCHAR,
+    publisher_id VARCHAR,
+    platform_id INTEGER,
+    authors VARCHAR,
+    publication_date VARCHAR,
+    article_version VARCHAR,
+    doi VARCHAR,
+    proprietary_id VARCHAR,
+    isbn VARCHAR,
+    print_issn VARCHAR,
+    online_issn VARCHAR,
+    uri VARCHAR,
+    parent_title VARCHAR,
+    parent_data_type VARCHAR,
+    parent_doi VARCHAR,
+    parent_proprietary_id VARCHAR,
+    parent_isbn VARCHAR,
+    parent_print_issn VARCHAR,
+    parent_online_issn VARCHAR,
+    parent_uri VARCHAR,
+    yop VARCHAR,
+    item_key VARCHAR
+);
+
+CREATE TABLE item_metric (
+    id BIGINT PRIMARY KEY DEFAULT nextval('seq_item_metric'),
+    item_report_id INTEGER NOT NULL,
+    access_type UTINYINT NOT NULL,
+    access_method UTINYINT NOT NULL,
+    metric_type UTINYINT NOT NULL,
+    period DATE NOT NULL,
+    period_total INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (item_report_id, access_type, access_method, metric_type, period)
+);
+
+CREATE TABLE item_metric_temp (
+    platform_id INTEGER,
+    item_key VARCHAR,
+    access_type UTINYINT,
+    access_method UTINYINT,
+    metric_type UTINYINT,
+    period DATE,
+    period_total INTEGER
+);
+
+CREATE TABLE filter (
+    id INTEGER PRIMARY KEY DEFAULT nextval('seq_filter'),
+    name VARCHAR NOT NULL,
+    description VARCHAR,
+    params VARCHAR NOT NULL,
+    title_type CHAR(1) NOT NULL,
+    create_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    update_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    owner VARCHAR NOT NULL
+);
+
+CREATE TABLE report_inventory (
+    id INTEGER PRIMARY KEY DEFAULT nextval('seq_report_inventory'),
+    excel_name VARCHAR NOT NULL,
+    platform VARCHAR NOT NULL,
+    run_date DATE NOT NULL,
+    begin_date DATE NOT NULL,
+    end_date DATE NOT NULL,
+    row_cnt INTEGER NOT NULL,
+    load_start TIMESTAMP NOT NULL,
+    load_end TIMESTAMP,
+    load_date DATE NOT NULL,
+    change_seq BIGINT,
+    UNIQUE (platform, begin_date, end_date, row_cnt)
+);
+
+CREATE TABLE data_version (
+    id TINYINT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO data_version VALUES (1, 0), (2, 0);
+
+CREATE TABLE filter_cache (
+    filter_hash CHAR(40) NOT NULL,
+    data_version BIGINT NOT NULL,
+    result VARCHAR NOT NULL,
+    cached_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (filter_hash, data_version)
+);
+
+CREATE TABLE quarantine (
+    id INTEGER PRIMARY KEY DEFAULT nextval('seq_quarantine'),
+    report_dir VARCHAR NOT NULL,
+    excel_name VARCHAR NOT NULL,
+    row_num INTEGER NOT NULL,
+    reason VARCHAR NOT NULL,
+    row_data VARCHAR NOT NULL,
+    quarantined_at TIMESTAMP NOT NULL,
+    replayed_at TIMESTAMP,
+    UNIQUE (report_dir, excel_name, row_num)
+);
+
+CREATE TABLE load_job (
+    id INTEGER PRIMARY KEY DEFAULT nextval('seq_load_job'),
+    report_dir VARCHAR NOT NULL,
+    excel_name VARCHAR NOT NULL,
+    state VARCHAR NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error VARCHAR,
+    queued_at TIMESTAMP NOT NULL,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    claimed_by VARCHAR,
+    heartbeat_at TIMESTAMP,
+    update_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (report_dir, excel_name)
+);
+
+-- platform_ref is loaded from the tab delimited export kept in the repo.
+INSERT INTO platform_ref SELECT * FROM read_csv('sql/platform_ref.txt', delim='\t', header=true);
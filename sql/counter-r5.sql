@@ -10,6 +10,13 @@ CREATE TABLE platform_ref (
     PRIMARY KEY (id)
 );
 
+CREATE TABLE platform_alias (
+    alias VARCHAR(100) NOT NULL,
+    platform_id INT NOT NULL,
+    PRIMARY KEY (alias),
+    FOREIGN KEY fk_alias_platform_id (platform_id) REFERENCES platform_ref (id)
+);
+
 CREATE TABLE title_report (
     id INT AUTO_INCREMENT,
     title VARCHAR(400) NOT NULL,
@@ -24,13 +31,30 @@ CREATE TABLE title_report (
     online_issn VARCHAR(20) NULL,
     uri VARCHAR(200) NULL,
     yop VARCHAR(4) NULL,
+    title_key CHAR(40) CHARACTER SET ascii NOT NULL,
+    load_id INT NULL,
     create_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     update_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     PRIMARY KEY (id),
-    INDEX idx_dupe_check (title(50), publisher(50), platform_id, isbn, yop),
+    UNIQUE INDEX idx_title_key (platform_id, title_key),
+    INDEX idx_load_id (load_id),
     FOREIGN KEY fk_platform_id (platform_id) REFERENCES platform_ref (id)
 );
 
+CREATE TABLE title_cluster (
+    title_report_id INT NOT NULL,
+    cluster_id INT NOT NULL,
+    PRIMARY KEY (title_report_id),
+    INDEX idx_cluster_id (cluster_id)
+);
+
+CREATE TABLE title_cluster_key (
+    norm_key VARCHAR(20) CHARACTER SET ascii NOT NULL,
+    cluster_id INT NOT NULL,
+    PRIMARY KEY (norm_key),
+    INDEX idx_cluster_id (cluster_id)
+);
+
 CREATE TABLE title_report_temp (
     id INT AUTO_INCREMENT,
     title VARCHAR(400),
@@ -48,6 +72,7 @@ CREATE TABLE title_report_temp (
     excel_name VARCHAR(100),
     row_num INT,
     title_report_id INT,
+    title_key CHAR(40) CHARACTER SET ascii,
     PRIMARY KEY (id),
     UNIQUE INDEX idx_excel_name_row_num (excel_name, row_num)
 );
@@ -62,10 +87,14 @@ CREATE TABLE metric (
         'No_License') NOT NULL,
     period DATE NOT NULL,
     period_total INT NOT NULL DEFAULT 0,
+    load_id INT NULL,
+    prev_period_total INT NULL,
+    prev_load_id INT NULL,
     create_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     update_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     PRIMARY KEY (id),
     UNIQUE INDEX idx_dupe_check (title_report_id, access_type, metric_type, period),
+    INDEX idx_load_id (load_id, title_report_id),
     FOREIGN KEY fk_title_report_id (title_report_id) REFERENCES title_report (id)
 );
 
@@ -82,6 +111,162 @@ CREATE TABLE metric_temp (
     PRIMARY KEY (id)
 );
 
+-- Wide layout for metric, used with metric_layout = 'wide' (see
+-- sql/use-metric-wide.sql): one row per year with a column per month.
+-- months is a bit mask of the months loaded, bit 0 for January.
+CREATE TABLE metric_wide (
+    title_report_id INT NOT NULL,
+    title_type CHAR(1) NOT NULL,
+    access_type ENUM('Controlled','OA_Gold','Other_Free_To_Read') NOT NULL,
+    metric_type ENUM('Total_Item_Investigations','Total_Item_Requests','Unique_Item_Investigations',
+        'Unique_Item_Requests','Unique_Title_Investigations','Unique_Title_Requests','Limit_Exceeded',
+        'No_License') NOT NULL,
+    year SMALLINT NOT NULL,
+    months SMALLINT UNSIGNED NOT NULL DEFAULT 0,
+    m01 INT NOT NULL DEFAULT 0,
+    m02 INT NOT NULL DEFAULT 0,
+    m03 INT NOT NULL DEFAULT 0,
+    m04 INT NOT NULL DEFAULT 0,
+    m05 INT NOT NULL DEFAULT 0,
+    m06 INT NOT NULL DEFAULT 0,
+    m07 INT NOT NULL DEFAULT 0,
+    m08 INT NOT NULL DEFAULT 0,
+    m09 INT NOT NULL DEFAULT 0,
+    m10 INT NOT NULL DEFAULT 0,
+    m11 INT NOT NULL DEFAULT 0,
+    m12 INT NOT NULL DEFAULT 0,
+    load_id INT NULL,
+    prev_months SMALLINT UNSIGNED NULL,
+    prev_m01 INT NULL,
+    prev_m02 INT NULL,
+    prev_m03 INT NULL,
+    prev_m04 INT NULL,
+    prev_m05 INT NULL,
+    prev_m06 INT NULL,
+    prev_m07 INT NULL,
+    prev_m08 INT NULL,
+    prev_m09 INT NULL,
+    prev_m10 INT NULL,
+    prev_m11 INT NULL,
+    prev_m12 INT NULL,
+    prev_load_id INT NULL,
+    PRIMARY KEY (title_report_id, access_type, metric_type, year),
+    INDEX idx_load_id (load_id, title_report_id),
+    FOREIGN KEY fk_wide_title_report_id (title_report_id) REFERENCES title_report (id)
+);
+
+CREATE TABLE metric_wide_temp (
+    id INT AUTO_INCREMENT,
+    title_report_id INT,
+    title_type CHAR(1),
+    access_type INT,
+    metric_type INT,
+    year SMALLINT,
+    months SMALLINT UNSIGNED,
+    m01 INT,
+    m02 INT,
+    m03 INT,
+    m04 INT,
+    m05 INT,
+    m06 INT,
+    m07 INT,
+    m08 INT,
+    m09 INT,
+    m10 INT,
+    m11 INT,
+    m12 INT,
+    excel_name VARCHAR(100),
+    row_num INT,
+    PRIMARY KEY (id)
+);
+
+-- Item Master Report (IR, IR_A1, IR_M1) tables. item_metric has no
+-- timestamps, as it holds an order of magnitude more rows than metric.
+CREATE TABLE item_report (
+    id INT AUTO_INCREMENT,
+    item VARCHAR(600) NOT NULL,
+    data_type VARCHAR(50) NULL,
+    publisher VARCHAR(200) NULL,
+    publisher_id VARCHAR(50) NULL,
+    platform_id INT NOT NULL,
+    authors VARCHAR(1000) NULL,
+    publication_date VARCHAR(20) NULL,
+    article_version VARCHAR(10) NULL,
+    doi VARCHAR(100) NULL,
+    proprietary_id VARCHAR(200) NULL,
+    isbn VARCHAR(20) NULL,
+    print_issn VARCHAR(20) NULL,
+    online_issn VARCHAR(20) NULL,
+    uri VARCHAR(200) NULL,
+    parent_title VARCHAR(400) NULL,
+    parent_data_type VARCHAR(50) NULL,
+    parent_doi VARCHAR(100) NULL,
+    parent_proprietary_id VARCHAR(200) NULL,
+    parent_isbn VARCHAR(20) NULL,
+    parent_print_issn VARCHAR(20) NULL,
+    parent_online_issn VARCHAR(20) NULL,
+    parent_uri VARCHAR(200) NULL,
+    yop VARCHAR(4) NULL,
+    item_key CHAR(40) CHARACTER SET ascii NOT NULL,
+    create_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id),
+    UNIQUE INDEX idx_item_key (platform_id, item_key),
+    FOREIGN KEY fk_item_platform_id (platform_id) REFERENCES platform_ref (id)
+);
+
+CREATE TABLE item_report_temp (
+    item VARCHAR(600),
+    data_type VARCHAR(50),
+    publisher VARCHAR(200),
+    publisher_id VARCHAR(50),
+    platform_id INT,
+    authors VARCHAR(1000),
+    publication_date VARCHAR(20),
+    article_version VARCHAR(10),
+    doi VARCHAR(100),
+    proprietary_id VARCHAR(200),
+    isbn VARCHAR(20),
+    print_issn VARCHAR(20),
+    online_issn VARCHAR(20),
+    uri VARCHAR(200),
+    parent_title VARCHAR(400),
+    parent_data_type VARCHAR(50),
+    parent_doi VARCHAR(100),
+    parent_proprietary_id VARCHAR(200),
+    parent_isbn VARCHAR(20),
+    parent_print_issn VARCHAR(20),
+    parent_online_issn VARCHAR(20),
+    parent_uri VARCHAR(200),
+    yop VARCHAR(4),
+    item_key CHAR(40) CHARACTER SET ascii
+);
+
+CREATE TABLE item_metric (
+    id BIGINT AUTO_INCREMENT,
+    item_report_id INT NOT NULL,
+    access_type ENUM('Controlled','OA_Gold','Other_Free_To_Read') NOT NULL,
+    access_method ENUM('Regular','TDM') NOT NULL,
+    metric_type ENUM('Total_Item_Investigations','Total_Item_Requests','Unique_Item_Investigations',
+        'Unique_Item_Requests','Unique_Title_Investigations','Unique_Title_Requests','Limit_Exceeded',
+        'No_License') NOT NULL,
+    period DATE NOT NULL,
+    period_total INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (id),
+    UNIQUE INDEX idx_dupe_check (item_report_id, access_type, access_method, metric_type, period),
+    FOREIGN KEY fk_item_report_id (item_report_id) REFERENCES item_report (id)
+);
+
+CREATE TABLE item_metric_temp (
+    platform_id INT,
+    item_key CHAR(40) CHARACTER SET ascii,
+    access_type INT,
+    access_method INT,
+    metric_type INT,
+    period DATE,
+    period_total INT,
+    INDEX idx_item (platform_id, item_key)
+);
+
 CREATE TABLE filter (
     id INT AUTO_INCREMENT,
     name VARCHAR(100) NOT NULL,
@@ -103,8 +288,57 @@ CREATE TABLE report_inventory (
     end_date DATE NOT NULL,
     row_cnt INT NOT NULL,
     load_start DATETIME NOT NULL,
-    load_end DATETIME NOT NULL,
+    load_end DATETIME NULL,
     load_date DATE NOT NULL,
+    change_seq BIGINT NULL,
+    PRIMARY KEY (id),
+    UNIQUE INDEX idx_platform_begin_end (platform, begin_date, end_date, row_cnt),
+    INDEX idx_change_seq (change_seq)
+);
+
+CREATE TABLE data_version (
+    id TINYINT NOT NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (id)
+);
+
+INSERT INTO data_version (id, version) VALUES (1, 0), (2, 0);
+
+CREATE TABLE filter_cache (
+    filter_hash CHAR(40) NOT NULL,
+    data_version BIGINT NOT NULL,
+    result LONGTEXT NOT NULL,
+    cached_at DATETIME NOT NULL,
+    PRIMARY KEY (filter_hash, data_version)
+);
+
+CREATE TABLE quarantine (
+    id INT AUTO_INCREMENT,
+    report_dir VARCHAR(255) NOT NULL,
+    excel_name VARCHAR(100) NOT NULL,
+    row_num INT NOT NULL,
+    reason VARCHAR(255) NOT NULL,
+    row_data TEXT NOT NULL,
+    quarantined_at DATETIME NOT NULL,
+    replayed_at DATETIME NULL,
+    PRIMARY KEY (id),
+    UNIQUE INDEX idx_report_dir_excel_name_row_num (report_dir, excel_name, row_num)
+);
+
+CREATE TABLE load_job (
+    id INT AUTO_INCREMENT,
+    report_dir VARCHAR(255) NOT NULL,
+    excel_name VARCHAR(100) NOT NULL,
+    state ENUM('queued','parsed','staged','merged','done','failed') NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    error TEXT NULL,
+    queued_at DATETIME NOT NULL,
+    started_at DATETIME NULL,
+    finished_at DATETIME NULL,
+    claimed_by VARCHAR(100) NULL,
+    heartbeat_at DATETIME NULL,
+    update_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     PRIMARY KEY (id),
-    UNIQUE INDEX idx_platform_begin_end (platform, begin_date, end_date, row_cnt)
+    UNIQUE INDEX idx_report_dir_excel_name (report_dir, excel_name),
+    INDEX idx_state (state)
 );
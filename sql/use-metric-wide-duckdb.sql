@@ -0,0 +1,76 @@
+-- DuckDB version of use-metric-wide.sql, for a database created from
+-- counter-r5-duckdb.sql:
+--
+--   duckdb counter5.duckdb < sql/use-metric-wide-duckdb.sql
+--
+-- and set metric_layout = 'wide' in dataloader/config.py. The usage in
+-- metric is copied into metric_wide and metric is replaced by a view of
+-- the same shape; the old table is kept as metric_long.
+
+-- title_type and load_id of a wide row come from the month written last.
+-- update_date is not maintained here, so that is the month with the
+-- highest load id.
+INSERT INTO metric_wide (title_report_id, title_type, access_type, metric_type, year, months,
+    m01, m02, m03, m04, m05, m06, m07, m08, m09, m10, m11, m12, load_id)
+SELECT m.title_report_id, l.title_type, m.access_type, m.metric_type, year(m.period),
+    BIT_OR(1 << (month(m.period) - 1)),
+    SUM(CASE WHEN month(m.period) = 1 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN month(m.period) = 2 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN month(m.period) = 3 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN month(m.period) = 4 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN month(m.period) = 5 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN month(m.period) = 6 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN month(m.period) = 7 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN month(m.period) = 8 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN month(m.period) = 9 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN month(m.period) = 10 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN month(m.period) = 11 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN month(m.period) = 12 THEN m.period_total ELSE 0 END),
+    l.load_id
+FROM metric m
+JOIN (SELECT title_report_id, access_type, metric_type, year(period) AS period_year, title_type, load_id,
+        ROW_NUMBER() OVER (PARTITION BY title_report_id, access_type, metric_type, year(period)
+            ORDER BY load_id DESC NULLS LAST, id DESC) AS row_rank
+    FROM metric) l
+    ON l.title_report_id = m.title_report_id AND l.access_type = m.access_type
+    AND l.metric_type = m.metric_type AND l.period_year = year(m.period) AND l.row_rank = 1
+GROUP BY m.title_report_id, m.access_type, m.metric_type, year(m.period), l.title_type, l.load_id;
+
+ALTER TABLE metric RENAME TO metric_long;
+
+CREATE VIEW metric AS
+SELECT title_report_id, title_type, access_type, metric_type, make_date(year, 1, 1) AS period, m01 AS period_total
+    FROM metric_wide WHERE months & 1 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, make_date(year, 2, 1) AS period, m02 AS period_total
+    FROM metric_wide WHERE months & 2 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, make_date(year, 3, 1) AS period, m03 AS period_total
+    FROM metric_wide WHERE months & 4 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, make_date(year, 4, 1) AS period, m04 AS period_total
+    FROM metric_wide WHERE months & 8 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, make_date(year, 5, 1) AS period, m05 AS period_total
+    FROM metric_wide WHERE months & 16 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, make_date(year, 6, 1) AS period, m06 AS period_total
+    FROM metric_wide WHERE months & 32 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, make_date(year, 7, 1) AS period, m07 AS period_total
+    FROM metric_wide WHERE months & 64 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, make_date(year, 8, 1) AS period, m08 AS period_total
+    FROM metric_wide WHERE months & 128 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, make_date(year, 9, 1) AS period, m09 AS period_total
+    FROM metric_wide WHERE months & 256 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, make_date(year, 10, 1) AS period, m10 AS period_total
+    FROM metric_wide WHERE months & 512 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, make_date(year, 11, 1) AS period, m11 AS period_total
+    FROM metric_wide WHERE months & 1024 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, make_date(year, 12, 1) AS period, m12 AS period_total
+    FROM metric_wide WHERE months & 2048 <> 0;
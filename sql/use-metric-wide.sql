@@ -0,0 +1,145 @@
+-- Switches an existing counter5 database to the wide metric layout. Set
+--
+--   metric_layout = 'wide'
+--
+-- in dataloader/config.py once this has run, and stop the loaders while it
+-- runs. The usage in metric is copied into metric_wide, the metric table is
+-- renamed to metric_long and replaced by a view with the same columns as
+-- before (less id and the timestamps), so queries work unchanged.
+--
+-- metric_long is kept so the copy can be checked; drop it afterwards to
+-- reclaim the space.
+
+CREATE TABLE IF NOT EXISTS metric_wide (
+    title_report_id INT NOT NULL,
+    title_type CHAR(1) NOT NULL,
+    access_type ENUM('Controlled','OA_Gold','Other_Free_To_Read') NOT NULL,
+    metric_type ENUM('Total_Item_Investigations','Total_Item_Requests','Unique_Item_Investigations',
+        'Unique_Item_Requests','Unique_Title_Investigations','Unique_Title_Requests','Limit_Exceeded',
+        'No_License') NOT NULL,
+    year SMALLINT NOT NULL,
+    months SMALLINT UNSIGNED NOT NULL DEFAULT 0,
+    m01 INT NOT NULL DEFAULT 0,
+    m02 INT NOT NULL DEFAULT 0,
+    m03 INT NOT NULL DEFAULT 0,
+    m04 INT NOT NULL DEFAULT 0,
+    m05 INT NOT NULL DEFAULT 0,
+    m06 INT NOT NULL DEFAULT 0,
+    m07 INT NOT NULL DEFAULT 0,
+    m08 INT NOT NULL DEFAULT 0,
+    m09 INT NOT NULL DEFAULT 0,
+    m10 INT NOT NULL DEFAULT 0,
+    m11 INT NOT NULL DEFAULT 0,
+    m12 INT NOT NULL DEFAULT 0,
+    load_id INT NULL,
+    prev_months SMALLINT UNSIGNED NULL,
+    prev_m01 INT NULL,
+    prev_m02 INT NULL,
+    prev_m03 INT NULL,
+    prev_m04 INT NULL,
+    prev_m05 INT NULL,
+    prev_m06 INT NULL,
+    prev_m07 INT NULL,
+    prev_m08 INT NULL,
+    prev_m09 INT NULL,
+    prev_m10 INT NULL,
+    prev_m11 INT NULL,
+    prev_m12 INT NULL,
+    prev_load_id INT NULL,
+    PRIMARY KEY (title_report_id, access_type, metric_type, year),
+    INDEX idx_load_id (load_id, title_report_id),
+    FOREIGN KEY fk_wide_title_report_id (title_report_id) REFERENCES title_report (id)
+);
+
+CREATE TABLE IF NOT EXISTS metric_wide_temp (
+    id INT AUTO_INCREMENT,
+    title_report_id INT,
+    title_type CHAR(1),
+    access_type INT,
+    metric_type INT,
+    year SMALLINT,
+    months SMALLINT UNSIGNED,
+    m01 INT,
+    m02 INT,
+    m03 INT,
+    m04 INT,
+    m05 INT,
+    m06 INT,
+    m07 INT,
+    m08 INT,
+    m09 INT,
+    m10 INT,
+    m11 INT,
+    m12 INT,
+    excel_name VARCHAR(100),
+    row_num INT,
+    PRIMARY KEY (id)
+);
+
+-- The months of a title, access type, metric type and year are folded into
+-- one row. title_type and load_id come from the month written last, as a
+-- merge into metric_wide would have left them.
+INSERT INTO metric_wide (title_report_id, title_type, access_type, metric_type, year, months,
+    m01, m02, m03, m04, m05, m06, m07, m08, m09, m10, m11, m12, load_id)
+SELECT m.title_report_id, l.title_type, m.access_type, m.metric_type, YEAR(m.period),
+    BIT_OR(1 << (MONTH(m.period) - 1)),
+    SUM(CASE WHEN MONTH(m.period) = 1 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN MONTH(m.period) = 2 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN MONTH(m.period) = 3 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN MONTH(m.period) = 4 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN MONTH(m.period) = 5 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN MONTH(m.period) = 6 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN MONTH(m.period) = 7 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN MONTH(m.period) = 8 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN MONTH(m.period) = 9 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN MONTH(m.period) = 10 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN MONTH(m.period) = 11 THEN m.period_total ELSE 0 END),
+    SUM(CASE WHEN MONTH(m.period) = 12 THEN m.period_total ELSE 0 END),
+    l.load_id
+FROM metric m
+JOIN (SELECT title_report_id, access_type, metric_type, YEAR(period) AS period_year, title_type, load_id,
+        ROW_NUMBER() OVER (PARTITION BY title_report_id, access_type, metric_type, YEAR(period)
+            ORDER BY update_date DESC, id DESC) AS row_rank
+    FROM metric) l
+    ON l.title_report_id = m.title_report_id AND l.access_type = m.access_type
+    AND l.metric_type = m.metric_type AND l.period_year = YEAR(m.period) AND l.row_rank = 1
+GROUP BY m.title_report_id, m.access_type, m.metric_type, YEAR(m.period), l.title_type, l.load_id;
+
+RENAME TABLE metric TO metric_long;
+
+CREATE VIEW metric AS
+SELECT title_report_id, title_type, access_type, metric_type, MAKEDATE(year, 1) AS period, m01 AS period_total
+    FROM metric_wide WHERE months & 1 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, MAKEDATE(year, 1) + INTERVAL 1 MONTH AS period, m02 AS period_total
+    FROM metric_wide WHERE months & 2 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, MAKEDATE(year, 1) + INTERVAL 2 MONTH AS period, m03 AS period_total
+    FROM metric_wide WHERE months & 4 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, MAKEDATE(year, 1) + INTERVAL 3 MONTH AS period, m04 AS period_total
+    FROM metric_wide WHERE months & 8 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, MAKEDATE(year, 1) + INTERVAL 4 MONTH AS period, m05 AS period_total
+    FROM metric_wide WHERE months & 16 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, MAKEDATE(year, 1) + INTERVAL 5 MONTH AS period, m06 AS period_total
+    FROM metric_wide WHERE months & 32 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, MAKEDATE(year, 1) + INTERVAL 6 MONTH AS period, m07 AS period_total
+    FROM metric_wide WHERE months & 64 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, MAKEDATE(year, 1) + INTERVAL 7 MONTH AS period, m08 AS period_total
+    FROM metric_wide WHERE months & 128 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, MAKEDATE(year, 1) + INTERVAL 8 MONTH AS period, m09 AS period_total
+    FROM metric_wide WHERE months & 256 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, MAKEDATE(year, 1) + INTERVAL 9 MONTH AS period, m10 AS period_total
+    FROM metric_wide WHERE months & 512 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, MAKEDATE(year, 1) + INTERVAL 10 MONTH AS period, m11 AS period_total
+    FROM metric_wide WHERE months & 1024 <> 0
+UNION ALL
+SELECT title_report_id, title_type, access_type, metric_type, MAKEDATE(year, 1) + INTERVAL 11 MONTH AS period, m12 AS period_total
+    FROM metric_wide WHERE months & 2048 <> 0;
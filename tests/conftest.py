@@ -0,0 +1,147 @@
+import os
+import sys
+import types
+
+import duckdb
+import pytest
+
+# The tests run against embedded DuckDB databases created from
+# sql/counter-r5-duckdb.sql, so they need the duckdb package but no
+# MySQL server. CounterDb connects when dataloader.counter_db is first
+# imported, so a config selecting an in-memory DuckDB database is put in
+# place before that, instead of dataloader/config.py.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+config = types.ModuleType('dataloader.config')
+config.backend = 'duckdb'
+config.duckdb_path = ':memory:'
+sys.modules['dataloader.config'] = config
+import dataloader
+dataloader.config = config
+
+
+def create_schema(conn, metric_layout='long'):
+    """
+    Creates the COUNTER tables from the DuckDB schema scripts over a
+    duckdb connection.
+    """
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        conn.execute(open('sql/counter-r5-duckdb.sql').read())
+        if metric_layout == 'wide':
+            conn.execute(open('sql/use-metric-wide-duckdb.sql').read())
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def database(tmp_path):
+    """
+    Switches the table classes to a new DuckDB database file, with the
+    long metric layout, and returns its path.
+    """
+    from dataloader.backends import DuckDbBackend
+    from dataloader.counter_db import CounterDb, TitleReportTable
+    from dataloader.merge import ParallelMerge
+
+    path = str(tmp_path / 'counter5.duckdb')
+    conn = duckdb.connect(path)
+    create_schema(conn)
+    conn.close()
+    CounterDb.use(DuckDbBackend(path), 'long')
+    CounterDb.merge_connections = 1
+    TitleReportTable.clear_cache()
+    yield path
+    ParallelMerge.close_pool()
+    CounterDb.conn.close()
+    CounterDb.use(DuckDbBackend(':memory:'))
+
+
+@pytest.fixture(params=['long', 'wide'])
+def memory_database(request):
+    """
+    Switches the table classes to a new in-memory DuckDB database, once
+    for each metric layout. Only CounterDb.conn can reach the database,
+    so the tests must not open other connections (merge pools, heartbeat
+    threads that get to run).
+    """
+    from dataloader.backends import DuckDbBackend, DuckDbConnection
+    from dataloader.counter_db import CounterDb, TitleReportTable
+
+    conn = duckdb.connect(':memory:')
+    create_schema(conn, request.param)
+    CounterDb.backend = DuckDbBackend(':memory:')
+    CounterDb.conn = DuckDbConnection(conn)
+    CounterDb.metric_layout = request.param
+    CounterDb.merge_connections = 1
+    TitleReportTable.clear_cache()
+    yield request.param
+    conn.close()
+    CounterDb.use(DuckDbBackend(':memory:'), 'long')
+
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def write_report(path, rows, year=2022, created='2023-01-15T10:00:00Z'):
+    """
+    Writes a TR_J3 report as a TSV file. Each row is (title, platform,
+    metric type, list of twelve monthly counts for year), optionally
+    followed by the print ISSN.
+    """
+    header = [
+        ['Report_Name', 'Journal Requests (Excluding OA_Gold)'],
+        ['Report_ID', 'TR_J3'],
+        ['Release', '5'],
+        ['Institution_Name', 'Test'],
+        ['Institution_ID', ''],
+        ['Metric_Types', ''],
+        ['Report_Filters', ''],
+        ['Report_Attributes', ''],
+        ['Exceptions', ''],
+        ['Reporting_Period', 'Begin_Date={0}-01-01; End_Date={0}-12-31'.format(year)],
+        ['Created', created],
+        ['Created_By', 'Test'],
+        [],
+        ['Title', 'Publisher', 'Publisher_ID', 'Platform', 'DOI', 'Proprietary_ID', 'Print_ISSN',
+            'Online_ISSN', 'URI', 'Access_Type', 'Metric_Type', 'Reporting_Period_Total']
+            + ['{0}-{1}'.format(month, year) for month in MONTHS],
+    ]
+    with open(path, 'w') as f:
+        for line in header:
+            f.write('\t'.join(line) + '\n')
+        for row in rows:
+            title, platform, metric_type, counts = row[:4]
+            print_issn = row[4] if len(row) > 4 else ''
+            f.write('\t'.join([title, 'Publisher', '', platform, '', '', print_issn, '', '', 'Controlled',
+                metric_type, str(sum(counts))] + [str(n) for n in counts]) + '\n')
+    return str(path)
+
+
+def load_files(paths, batch=False):
+    """
+    Loads report files like loader.py and fails the test if any load
+    fails. With batch set, the files are loaded with one staging cycle.
+    """
+    from dataloader.counter_db import LoadJobTable
+    from dataloader.pipeline import run_batch, run_job
+
+    reportdir = os.path.dirname(paths[0])
+    names = [os.path.basename(path) for path in paths]
+    jobs = LoadJobTable()
+    jobs.enqueue(reportdir, paths)
+    claimed = []
+    while True:
+        job = jobs.claim(reportdir, 'test', [name for name in names if name not in [j.excel_name for j in claimed]])
+        if job is None:
+            break
+        claimed.append(job)
+    if batch:
+        messages = run_batch(claimed, reportdir, jobs, 'test')
+    else:
+        messages = [run_job(job, reportdir, jobs, 'test') for job in claimed]
+    assert not any(messages), messages
+    assert jobs.counts(reportdir)['failed'] == 0
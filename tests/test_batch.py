@@ -0,0 +1,69 @@
+import os
+
+from conftest import write_report
+from dataloader.counter_db import CounterDb, LoadJobTable, MetricTable, PlatformTable
+from dataloader.pipeline import load_batch, merge_rounds, open_report
+
+
+def claim_all(reportdir, paths):
+    jobs = LoadJobTable()
+    jobs.enqueue(reportdir, paths)
+    claimed = []
+    for path in paths:
+        claimed.append(jobs.claim(reportdir, 'test', [os.path.basename(path)]))
+    return jobs, claimed
+
+
+def count(table):
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT COUNT(*) FROM {0}".format(table))
+    return cursor.fetchone()[0]
+
+
+def test_rounds_compare_resolved_platforms(database, tmp_path):
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"INSERT INTO platform_alias VALUES ('ACM DL', 2)")
+    PlatformTable().refresh()
+    first = write_report(tmp_path / 'tr_j3-acm-2022.tsv',
+        [('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12)])
+    second = write_report(tmp_path / 'tr_j3-acm-2022b.tsv',
+        [('Journal A', 'ACM DL', 'Total_Item_Requests', [2] * 12)])
+    try:
+        assert len(merge_rounds([open_report(first), open_report(second)])) == 2
+    finally:
+        cursor.execute(u"DELETE FROM platform_alias")
+        PlatformTable().refresh()
+
+
+def test_batch_verifies_reports_before_they_are_overwritten(database, tmp_path):
+    paths = [
+        write_report(tmp_path / 'tr_j3-acm-2022.tsv',
+            [('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12)]),
+        write_report(tmp_path / 'tr_j3-acm-2022b.tsv', [
+            ('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [2] * 12),
+            ('Journal B', 'ACM Digital Library', 'Total_Item_Requests', [3] * 12),
+        ]),
+    ]
+    jobs, claimed = claim_all(str(tmp_path), paths)
+    loaded, failed, messages = load_batch([(job, open_report(path)) for job, path in zip(claimed, paths)],
+        str(tmp_path), jobs, str(tmp_path), verify=True)
+    assert (len(loaded), failed, messages) == (2, [], [])
+
+
+def test_failed_batch_leaves_nothing_behind(database, tmp_path, monkeypatch):
+    def fail(self, *args, **kwargs):
+        raise ValueError('merge failed')
+    monkeypatch.setattr(MetricTable, 'merge_sql', fail)
+
+    paths = [
+        write_report(tmp_path / 'tr_j3-acm-2022.tsv',
+            [('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12)]),
+        write_report(tmp_path / 'tr_j3-ieee-2022.tsv',
+            [('Journal B', 'IEEE Xplore', 'Total_Item_Requests', [2] * 12)]),
+    ]
+    jobs, claimed = claim_all(str(tmp_path), paths)
+    loaded, failed, messages = load_batch([(job, open_report(path)) for job, path in zip(claimed, paths)],
+        str(tmp_path), jobs, str(tmp_path))
+    assert (loaded, len(failed)) == ([], 2)
+    assert jobs.counts(str(tmp_path))['failed'] == 2
+    assert (count('report_inventory'), count('title_report'), count('metric')) == (0, 0, 0)
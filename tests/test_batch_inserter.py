@@ -0,0 +1,53 @@
+import duckdb
+
+from dataloader.backends import BatchInserter, DuckDbBackend, DuckDbConnection
+
+
+class RecordingConnection(DuckDbConnection):
+    """
+    A DuckDB connection that records the rows and value bytes of every
+    INSERT its cursors execute.
+    """
+
+    def __init__(self, con):
+        super().__init__(con)
+        self.batches = []
+
+    def cursor(self, named_tuple=False, **kwargs):
+        cursor = super().cursor(named_tuple, **kwargs)
+        execute = cursor.execute
+
+        def recording_execute(sql, params=None):
+            if sql.startswith('INSERT'):
+                self.batches.append((len(params) // 2, sum(len(str(v)) for v in params)))
+            return execute(sql, params)
+        cursor.execute = recording_execute
+        return cursor
+
+
+class SmallPacketBackend(DuckDbBackend):
+
+    def max_packet(self, cursor):
+        return 4000
+
+
+def test_batches_stay_inside_the_packet_when_rows_grow(monkeypatch):
+    monkeypatch.setattr(BatchInserter, 'MAX_ROWS', 50)
+    con = duckdb.connect(':memory:')
+    con.execute(u"CREATE TABLE t (n INTEGER, s VARCHAR)")
+    conn = RecordingConnection(con)
+
+    # Short rows first, as a sample of the first rows would see, then rows
+    # a hundred times longer.
+    rows = [(i, 'x') for i in range(120)] + [(i, 'y' * 100) for i in range(120, 160)] + [(160, 'z' * 3000)]
+    inserter = BatchInserter(SmallPacketBackend(':memory:'), conn, 't', ['n', 's'])
+    for row in rows:
+        inserter.add(row)
+    inserter.close()
+
+    assert con.execute(u"SELECT n, s FROM t ORDER BY n").fetchall() == rows
+    assert [n for n, size in conn.batches][0:2] == [50, 50]
+    # Every batch but the oversized row on its own stays under half the
+    # packet, value overhead included.
+    assert all(size + n * 2 * BatchInserter.VALUE_OVERHEAD <= 2000 for n, size in conn.batches[:-1])
+    assert conn.batches[-1] == (1, 3003)
@@ -0,0 +1,56 @@
+from conftest import load_files, write_report
+from dataloader.counter_db import CounterDb, TitleClusterTable
+from dataloader.normalize import identifier_keys
+
+
+def clusters():
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT title_report_id, cluster_id FROM title_cluster ORDER BY title_report_id")
+    titles = cursor.fetchall()
+    cursor.execute(u"SELECT norm_key, cluster_id FROM title_cluster_key ORDER BY norm_key")
+    return titles, cursor.fetchall()
+
+
+def test_identifier_keys():
+    # Hyphens, spaces and the case of the check digit do not matter, and
+    # the same ISSN given twice is one key.
+    assert identifier_keys('1234-567x', ' 1234567X ', None) == ['issn:1234567X']
+    assert identifier_keys('0000-0019', '2049-3630', '') == ['issn:00000019', 'issn:20493630']
+    # ISBN-10s become the ISBN-13 of the same book.
+    assert identifier_keys(None, None, '0-306-40615-2') == ['isbn:9780306406157']
+    assert identifier_keys('', '', '978-0-306-40615-7') == ['isbn:9780306406157']
+    assert identifier_keys('1234-56789', 'n/a', '12345') == []
+
+
+def test_titles_cluster_on_normalized_identifiers(database, tmp_path):
+    load_files([
+        write_report(tmp_path / 'tr_j3-acm-2022.tsv',
+            [('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12, '1234-567x')]),
+        write_report(tmp_path / 'tr_j3-ieee-2022.tsv', [
+            ('Journal of A', 'IEEE Xplore', 'Total_Item_Requests', [1] * 12, '1234567X'),
+            ('Journal B', 'IEEE Xplore', 'Total_Item_Requests', [1] * 12, '2049-3630'),
+        ]),
+    ])
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT title, id FROM title_report")
+    ids = dict(cursor.fetchall())
+    assert sorted(TitleClusterTable().get_cluster_titles(ids['Journal A'])) == \
+        sorted([ids['Journal A'], ids['Journal of A']])
+    assert TitleClusterTable().get_cluster_titles(ids['Journal B']) == [ids['Journal B']]
+
+
+def test_bridging_title_merges_two_clusters(database):
+    table = TitleClusterTable()
+    table.add([(11, '1111-1111', None, None), (12, None, '1111-1111', None)])
+    table.add([(13, '2222-2222', None, '0-306-40615-2'), (14, None, None, '9780306406157')])
+    CounterDb.conn.commit()
+    assert clusters() == ([(11, 11), (12, 11), (13, 13), (14, 13)],
+        [('isbn:9780306406157', 13), ('issn:11111111', 11), ('issn:22222222', 13)])
+
+    # A print ISSN of one cluster and the online ISSN of the other join
+    # them, under the smaller cluster id, keys included.
+    table.add([(15, '2222-2222', '1111-1111', None)])
+    CounterDb.conn.commit()
+    assert clusters() == ([(11, 11), (12, 11), (13, 11), (14, 11), (15, 11)],
+        [('isbn:9780306406157', 11), ('issn:11111111', 11), ('issn:22222222', 11)])
+    assert sorted(table.get_cluster_titles(14)) == [11, 12, 13, 14, 15]
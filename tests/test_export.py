@@ -0,0 +1,63 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from conftest import load_files, write_report
+from dataloader.counter_db import CounterDb, ReportInventoryTable
+from dataloader.pipeline import open_report
+
+pytest.importorskip('pyarrow')
+from dataloader.export import ParquetExporter
+
+ACM = 2
+IEEE = 38
+
+
+def test_unfinished_load_does_not_stall_export(database, tmp_path):
+    exporter = ParquetExporter(str(tmp_path / 'parquet'))
+    acm = write_report(tmp_path / 'tr_j3-acm-2022.tsv',
+        [('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12)])
+    ieee = write_report(tmp_path / 'tr_j3-ieee-2022.tsv',
+        [('Journal B', 'IEEE Xplore', 'Total_Item_Requests', [2] * 12)])
+
+    # A load that started and failed leaves an inventory row without a
+    # load_end, before the next report is loaded.
+    ReportInventoryTable().start(open_report(acm), datetime.now().isoformat())
+    load_files([ieee])
+    assert exporter.export() == 1
+    assert exporter.touched_partitions(exporter._last_change_seq())[1] == set()
+
+    # Once the failed report loads, it is exported under its old id.
+    load_files([acm])
+    assert exporter.touched_partitions(exporter._last_change_seq())[1] == {(2022, ACM)}
+    exporter.export()
+
+    # So is a report loaded again, e.g. a corrected delivery.
+    ieee_b = write_report(tmp_path / 'tr_j3-ieee-2022b.tsv',
+        [('Journal B', 'IEEE Xplore', 'Total_Item_Requests', [3] * 12)], created='2023-02-01T10:00:00Z')
+    load_files([ieee_b])
+    assert len(ReportInventoryTable().find(ieee_b)) == 1
+    assert exporter.touched_partitions(exporter._last_change_seq())[1] == {(2022, IEEE)}
+
+
+def test_partitions_come_from_the_loaded_rows(database, tmp_path):
+    exporter = ParquetExporter(str(tmp_path / 'parquet'))
+    # The inventory row only records the platform of the first row.
+    both = write_report(tmp_path / 'tr_j3-acm-2022.tsv',
+        [('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12),
+         ('Journal B', 'IEEE Xplore', 'Total_Item_Requests', [2] * 12)])
+    load_files([both])
+    assert exporter.touched_partitions()[1] == {(2022, ACM), (2022, IEEE)}
+    assert exporter.export() == 2
+
+    # A full export covers usage without an inventory row, and removes
+    # partitions left without usage.
+    CounterDb.conn.cursor().execute(u"DELETE FROM report_inventory")
+    CounterDb.conn.cursor().execute(u"DELETE FROM metric WHERE title_report_id IN \
+        (SELECT id FROM title_report WHERE platform_id = %s)", (IEEE,))
+    CounterDb.conn.commit()
+    assert exporter.export(full=True) == 2
+    assert os.path.exists(exporter._partition_path(2022, ACM))
+    assert not os.path.exists(exporter._partition_path(2022, IEEE))
+    assert exporter.export(full=True) == 1
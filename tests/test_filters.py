@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from conftest import load_files, write_report
+from dataloader.counter_db import CounterDb, DataVersion, PlatformTable
+from dataloader.filters import FilterEngine, FilterError
+
+
+def save_filter(params, title_type='J'):
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"INSERT INTO filter (name, params, title_type, owner) VALUES (%s, %s, %s, %s) RETURNING id",
+        ('test', json.dumps(params), title_type, 'test'))
+    filter_id = cursor.fetchone()[0]
+    CounterDb.conn.commit()
+    return filter_id
+
+
+@pytest.fixture
+def usage(database, tmp_path):
+    load_files([
+        write_report(tmp_path / 'tr_j3-acs-2022.tsv', [
+            ('Journal A', 'ACS Publications', 'Total_Item_Requests', [1] * 12),
+            ('Journal B', 'ACS Publications', 'Total_Item_Requests', [2] * 12),
+        ]),
+        write_report(tmp_path / 'tr_j3-ieee-2022.tsv', [
+            ('Journal C', 'IEEE Xplore', 'Total_Item_Requests', [5] * 12),
+        ]),
+    ])
+
+
+def test_platform_matches_names_preferred_names_and_aliases(usage):
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"INSERT INTO platform_alias VALUES ('ACS Pubs', 3)")
+    PlatformTable().refresh()
+    try:
+        engine = FilterEngine()
+        for name in ['ACS Publications', 'American Chemical Society', 'ACS Pubs', 'acs publications', 3]:
+            result = engine.run(save_filter({'platform': name}))
+            assert [(row.title, row.total) for row in result.rows] == [('Journal B', 24), ('Journal A', 12)]
+        result = engine.run(save_filter({'platform': ['ACS Pubs', 'IEEE Xplore'], 'group_by': 'platform'}))
+        assert [(row.platform_id, row.total) for row in result.rows] == [(38, 60), (3, 36)]
+    finally:
+        cursor.execute(u"DELETE FROM platform_alias")
+        PlatformTable().refresh()
+
+
+def test_unknown_platform(usage):
+    with pytest.raises(FilterError, match='Unknown platform: Nowhere'):
+        FilterEngine().run(save_filter({'platform': ['IEEE Xplore', 'Nowhere']}))
+
+
+def test_results_are_cached_in_the_database_until_the_data_changes(usage):
+    filter_id = save_filter({'group_by': 'month', 'end': '2022-02'})
+    first = FilterEngine().run(filter_id)
+    assert [tuple(row) for row in first.rows] == [('2022-01-01', 8), ('2022-02-01', 8)]
+
+    # Usage changed behind the data version's back is not seen by a new
+    # engine, as by a later run of run-filter.py.
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"DELETE FROM metric WHERE period = '2022-01-01'")
+    CounterDb.conn.commit()
+    assert FilterEngine().run(filter_id) == first
+    cursor.execute(u"SELECT COUNT(*) FROM filter_cache")
+    assert cursor.fetchone()[0] == 1
+
+    DataVersion().bump(cursor)
+    CounterDb.conn.commit()
+    second = FilterEngine().run(filter_id)
+    assert [tuple(row) for row in second.rows] == [('2022-02-01', 8)]
+    assert second.data_version == first.data_version + 1
+    cursor.execute(u"SELECT data_version FROM filter_cache")
+    assert cursor.fetchall() == [(second.data_version,)]
+
+
+def test_pages_of_a_cached_result(usage):
+    filter_id = save_filter({})
+    engine = FilterEngine()
+    assert [row.title for row in engine.run(filter_id, page=1, page_size=2).rows] == ['Journal C', 'Journal B']
+    result = engine.run(filter_id, page=2, page_size=2)
+    assert ([row.title for row in result.rows], result.total_rows) == (['Journal A'], 3)
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from conftest import write_report
+from dataloader.counter_db import LoadJobTable, PlatformTable
+from dataloader.pipeline import ingest_file, run_job
+from dataloader.textreport import TextTitleMasterReport
+
+TARGET = 'tr-j3-acm-digital-library-2022-0112.tsv'
+
+
+def source_file(tmp_path):
+    return write_report(tmp_path / 'TR_J3_acm.tsv',
+        [('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12)])
+
+
+def job_states(reportdir):
+    counts = LoadJobTable().counts(reportdir)
+    return {state: n for state, n in counts.items() if n}
+
+
+def test_failed_job_is_loaded_again_when_redelivered(database, tmp_path):
+    reportdir = str(tmp_path)
+    jobs = LoadJobTable()
+    jobs.enqueue(reportdir, [TARGET])
+    job = jobs.claim(reportdir, 'other', [TARGET])
+    jobs.set_state(job.id, 'failed', 'error')
+
+    target, message = ingest_file(source_file(tmp_path), PlatformTable().get_resolver(), jobs, 'test', reportdir)
+    assert (target, message) == (TARGET, None)
+    assert job_states(reportdir) == {'done': 1}
+
+
+def test_job_held_by_another_node_is_an_error(database, tmp_path):
+    reportdir = str(tmp_path)
+    jobs = LoadJobTable()
+    jobs.enqueue(reportdir, [TARGET])
+    jobs.claim(reportdir, 'other', [TARGET])
+
+    with pytest.raises(RuntimeError):
+        ingest_file(source_file(tmp_path), PlatformTable().get_resolver(), jobs, 'test', reportdir)
+
+
+def test_new_report_is_read_once(database, tmp_path, monkeypatch):
+    passes = []
+    iter_rows = TextTitleMasterReport._iter_rows
+    def counted(self):
+        passes.append(self.filename)
+        return iter_rows(self)
+    monkeypatch.setattr(TextTitleMasterReport, '_iter_rows', counted)
+
+    path = write_report(tmp_path / 'tr_j3-acm-2022.tsv',
+        [('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12)])
+    reportdir = str(tmp_path)
+    jobs = LoadJobTable()
+    jobs.enqueue(reportdir, [path])
+    job = jobs.claim(reportdir, 'test', [os.path.basename(path)])
+    assert run_job(job, reportdir, jobs, 'test') is None
+    assert passes == [os.path.basename(path)]
+    assert job_states(reportdir) == {'done': 1}
@@ -0,0 +1,79 @@
+import pytest
+
+import dataloader.counter_db
+from conftest import load_files, write_report
+from dataloader.counter_db import CounterDb
+from dataloader.instrument import InstrumentedConnection, Instrumentation, StatementBudgetError
+from dataloader.merge import ParallelMerge
+
+
+def journals(n, prefix='Journal'):
+    return [('{0} {1}'.format(prefix, i), 'ACM Digital Library', 'Total_Item_Requests', [1] * 12)
+        for i in range(n)]
+
+
+def instrumented_load(instrumentation, paths):
+    instrumentation.install()
+    try:
+        load_files(paths)
+    finally:
+        instrumentation.uninstall()
+
+
+def test_merge_connections_opened_before_install_are_counted(database, tmp_path):
+    CounterDb.merge_connections = 2
+    ParallelMerge(2)
+    instrumentation = Instrumentation()
+    instrumentation.install()
+    try:
+        assert all(isinstance(conn, InstrumentedConnection) for conn in ParallelMerge._pool)
+        load_files([write_report(tmp_path / 'tr_j3-acm-2022.tsv',
+            [('Journal {0}'.format(i), 'ACM Digital Library', 'Total_Item_Requests', [1] * 12)
+                for i in range(50)])])
+    finally:
+        instrumentation.uninstall()
+    assert not any(isinstance(conn, InstrumentedConnection) for conn in ParallelMerge._pool)
+
+    shapes = {}
+    for stats in instrumentation.reports.values():
+        for stage in stats.statements.values():
+            for shape, s in stage.items():
+                shapes[shape] = shapes.get(shape, 0) + s.calls
+    # The metric upserts run on the pool connections.
+    assert any(shape.startswith('INSERT INTO metric (') for shape in shapes)
+    # New titles are inserted in batches, not one statement per title.
+    assert sum(n for shape, n in shapes.items() if shape.startswith('INSERT INTO title_report (')) <= 2
+
+
+def test_executemany_counts_each_update(database):
+    instrumentation = Instrumentation()
+    instrumentation.install()
+    try:
+        cursor = CounterDb.conn.cursor()
+        cursor.executemany(u"INSERT INTO platform_alias VALUES (%s, %s)", [('A', 2), ('B', 2), ('C', 2)])
+        cursor.executemany(u"UPDATE platform_alias SET platform_id = %s WHERE alias = %s",
+            [(38, 'A'), (38, 'B'), (38, 'C')])
+        cursor.executemany(u"DELETE FROM platform_alias WHERE alias = %s", [])
+    finally:
+        instrumentation.uninstall()
+    calls = {shape.split()[0]: s.calls for shape, s in instrumentation.reports['(outside reports)']
+        .statements['other'].items()}
+    assert calls == {'INSERT': 1, 'UPDATE': 3}
+
+
+def test_set_based_load_is_within_budget(database, tmp_path):
+    instrumentation = Instrumentation(budget=50)
+    instrumented_load(instrumentation, [write_report(tmp_path / 'tr_j3-acm-2022.tsv', journals(1000))])
+    assert instrumentation.reports['tr_j3-acm-2022.tsv'].rows == 1000
+    instrumentation.check_budget()
+
+
+def test_row_by_row_load_is_over_budget(database, tmp_path, monkeypatch):
+    def upsert_each(backend, cursor, table, columns, rows, keys, batch=1000):
+        return [backend.upsert_id(cursor, table, columns, row, keys) for row in rows]
+    monkeypatch.setattr(dataloader.counter_db, 'upsert_ids', upsert_each)
+
+    instrumentation = Instrumentation(budget=50)
+    instrumented_load(instrumentation, [write_report(tmp_path / 'tr_j3-acm-2022.tsv', journals(200))])
+    with pytest.raises(StatementBudgetError, match='tr_j3-acm-2022.tsv'):
+        instrumentation.check_budget()
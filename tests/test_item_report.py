@@ -0,0 +1,89 @@
+import openpyxl
+import pytest
+
+from dataloader.counter_db import CounterDb, LoadJobTable
+from dataloader.pipeline import load_report, open_report
+
+
+def write_item_report(path, rows, year=2022):
+    """
+    Writes an IR_A1 report as a workbook. Each row is (item, platform,
+    metric type, list of twelve monthly counts for year).
+    """
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    header = [
+        ['Report_Name', 'Journal Article Requests'],
+        ['Report_ID', 'IR_A1'],
+        ['Release', '5'],
+        ['Institution_Name', 'Test'],
+        ['Institution_ID', ''],
+        ['Metric_Types', ''],
+        ['Report_Filters', ''],
+        ['Report_Attributes', ''],
+        ['Exceptions', ''],
+        ['Reporting_Period', 'Begin_Date={0}-01-01; End_Date={0}-12-31'.format(year)],
+        ['Created', '2023-01-15'],
+        ['Created_By', 'Test'],
+        [],
+        ['Item', 'Publisher', 'Publisher_ID', 'Platform', 'DOI', 'Proprietary_ID', 'Print_ISSN',
+            'Online_ISSN', 'URI', 'Parent_Title', 'Metric_Type', 'Reporting_Period_Total']
+            + ['{0}-{1:02d}'.format(year, month) for month in range(1, 13)],
+    ]
+    for line in header:
+        ws.append(line)
+    for item, platform, metric_type, counts in rows:
+        ws.append([item, 'Publisher', '', platform, '', '', '', '', '', 'Journal A', metric_type,
+            sum(counts)] + counts)
+    wb.save(path)
+    return str(path)
+
+
+def load(path, times=1):
+    """
+    Loads an item report under one job, times times over, as when a job
+    is run again after failing once its rows were merged.
+    """
+    reportdir = str(path.parent)
+    jobs = LoadJobTable()
+    jobs.enqueue(reportdir, [path.name])
+    job = jobs.claim(reportdir, 'test', [path.name])
+    for _ in range(times):
+        report = open_report(str(path))
+        try:
+            load_report(report, reportdir, job, jobs)
+        finally:
+            report.close()
+
+
+ROWS = [
+    ('Article 1', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12),
+    ('Article 2', 'ACM Digital Library', 'Total_Item_Requests', [2] * 12),
+]
+
+
+def test_reloading_an_item_report_updates_its_inventory_row(database, tmp_path):
+    path = tmp_path / 'ir_a1.xlsx'
+    write_item_report(path, ROWS)
+    load(path, times=2)
+
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT excel_name, row_cnt FROM report_inventory")
+    assert cursor.fetchall() == [('ir_a1.xlsx', 2)]
+    cursor.execute(u"SELECT SUM(period_total) FROM item_metric")
+    assert cursor.fetchone()[0] == 36
+
+
+def test_failed_item_import_is_not_recorded(database, tmp_path, monkeypatch):
+    path = tmp_path / 'ir_a1.xlsx'
+    write_item_report(path, ROWS)
+
+    def bulk_load(conn, reportdir, tables):
+        raise OSError('mysqlimport failed')
+    monkeypatch.setattr(CounterDb.backend, 'bulk_load', bulk_load)
+
+    with pytest.raises(OSError, match='0 rows of 2 were imported into item_report_temp'):
+        load(path)
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT COUNT(*) FROM report_inventory")
+    assert cursor.fetchone()[0] == 0
@@ -0,0 +1,88 @@
+import subprocess
+import sys
+
+from conftest import ROOT
+from dataloader.counter_db import CounterDb, LoadJobTable
+
+# Runs one claim in a separate loader process, which exits without
+# finishing the job, as if it had been killed.
+CLAIM_SCRIPT = u"""
+import sys, types
+sys.path.insert(0, {root!r})
+config = types.ModuleType('dataloader.config')
+config.backend = 'duckdb'
+config.duckdb_path = {path!r}
+sys.modules['dataloader.config'] = config
+import dataloader
+dataloader.config = config
+from dataloader.counter_db import LoadJobTable
+job = LoadJobTable().claim({reportdir!r}, {node!r}, {names!r})
+print(job.excel_name if job else '')
+"""
+
+REPORTDIR = '/data/reports'
+NAMES = ['tr-j3-acm-2022-0112.tsv', 'tr-j3-ieee-2022-0112.tsv']
+
+
+def claim_in_process(path, node):
+    """
+    Claims a job as node in a new process and returns its file name, or
+    '' when there was nothing to claim.
+    """
+    # DuckDB lets one process at a time open the file.
+    CounterDb.conn.close()
+    try:
+        script = CLAIM_SCRIPT.format(root=ROOT, path=path, reportdir=REPORTDIR, node=node, names=NAMES)
+        output = subprocess.check_output([sys.executable, '-c', script], universal_newlines=True)
+    finally:
+        CounterDb.conn = CounterDb.backend.connect()
+    return output.strip()
+
+
+def job_row(name):
+    cursor = CounterDb.conn.cursor(named_tuple=True)
+    cursor.execute(u"SELECT * FROM load_job WHERE excel_name = %s", (name,))
+    return cursor.fetchone()
+
+
+def test_claims_survive_a_restart(database):
+    jobs = LoadJobTable()
+    jobs.enqueue(REPORTDIR, NAMES)
+
+    # The first process claims the first file and dies.
+    assert claim_in_process(database, 'host:1') == NAMES[0]
+
+    # The next process takes the other file, and releases it when done.
+    job = jobs.claim(REPORTDIR, 'host:2', NAMES)
+    assert job.excel_name == NAMES[1]
+    jobs.set_state(job.id, 'done')
+    assert job_row(NAMES[1]).claimed_by is None
+
+    # The dead process's file is not claimable until its claim is stale,
+    # but it is still counted so the run does not end without it.
+    assert jobs.claim(REPORTDIR, 'host:2', NAMES) is None
+    assert jobs.claimed_elsewhere(REPORTDIR, 'host:2', NAMES) == 1
+    job = jobs.claim(REPORTDIR, 'host:2', NAMES, stale_after=0)
+    assert job.excel_name == NAMES[0]
+    jobs.set_state(job.id, 'failed', 'error')
+    assert job_row(NAMES[0]).claimed_by is None
+    assert jobs.claimed_elsewhere(REPORTDIR, 'host:3', NAMES) == 0
+
+    # Retrying the failed file, a restarted process can claim it at once.
+    assert [j.excel_name for j in jobs.pending(REPORTDIR, retry_failed=True)] == [NAMES[0]]
+    assert claim_in_process(database, 'host:3') == NAMES[0]
+    assert job_row(NAMES[0]).claimed_by == 'host:3'
+
+
+def test_requeue_and_unload_release_claims(database):
+    jobs = LoadJobTable()
+    jobs.enqueue(REPORTDIR, NAMES[:1])
+    job = jobs.claim(REPORTDIR, 'host:1', NAMES)
+    jobs.set_state(job.id, 'done')
+    jobs.mark_unloaded(NAMES[0])
+    row = job_row(NAMES[0])
+    assert (row.state, row.claimed_by, row.heartbeat_at) == ('failed', None, None)
+
+    jobs.requeue_if_changed(REPORTDIR, NAMES[0], row.finished_at.replace(year=row.finished_at.year + 1))
+    assert job_row(NAMES[0]).state == 'queued'
+    assert jobs.claim(REPORTDIR, 'host:2', NAMES).excel_name == NAMES[0]
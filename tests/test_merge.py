@@ -0,0 +1,32 @@
+import threading
+
+from conftest import load_files, write_report
+from dataloader.counter_db import CounterDb, DataVersion, TitleReportTable
+
+
+def test_parallel_merge_checks_the_title_cache_on_the_main_thread(database, tmp_path, monkeypatch):
+    CounterDb.merge_connections = 3
+    threads = []
+    get = DataVersion.get
+    def recording_get(self, *args):
+        threads.append(threading.current_thread())
+        return get(self, *args)
+    monkeypatch.setattr(DataVersion, 'get', recording_get)
+
+    titles = [('Journal {0}'.format(i), 'ACM Digital Library', 'Total_Item_Requests', [i] * 12)
+        for i in range(60)]
+    load_files([write_report(tmp_path / 'tr_j3-acm-2022.tsv', titles)])
+    assert threads and all(thread is threading.main_thread() for thread in threads)
+
+    # A cache left over from before titles were deleted elsewhere is
+    # dropped before the workers read it.
+    TitleReportTable._title_ids = {key: -1 for key in TitleReportTable._title_ids}
+    TitleReportTable._cache_version = -1
+    load_files([write_report(tmp_path / 'tr_j3-acm-2022b.tsv', titles[:30],
+        created='2023-02-01T10:00:00Z')])
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT COUNT(*) FROM metric m LEFT JOIN title_report t ON t.id = m.title_report_id \
+        WHERE t.id IS NULL")
+    assert cursor.fetchone() == (0,)
+    cursor.execute(u"SELECT COUNT(*), SUM(period_total) FROM metric")
+    assert cursor.fetchone() == (720, 12 * sum(range(60)))
@@ -0,0 +1,19 @@
+import os
+
+import duckdb
+
+from conftest import ROOT, create_schema
+
+
+def test_switch_to_wide_keeps_the_last_written_values():
+    conn = duckdb.connect(':memory:')
+    create_schema(conn)
+    # January was written last, by load 2, with a title type that sorts
+    # lower than February's.
+    conn.execute(u"INSERT INTO metric (title_report_id, title_type, access_type, metric_type, \
+        period, period_total, load_id) VALUES \
+        (1, 'B', 1, 2, DATE '2022-01-01', 3, 2), \
+        (1, 'J', 1, 2, DATE '2022-02-01', 5, 1)")
+    conn.execute(open(os.path.join(ROOT, 'sql', 'use-metric-wide-duckdb.sql')).read())
+    rows = conn.execute(u"SELECT title_type, months, m01, m02, load_id FROM metric_wide").fetchall()
+    assert rows == [('B', 3, 3, 5, 2)]
@@ -0,0 +1,63 @@
+import json
+import os
+
+import pytest
+
+from conftest import load_files, write_report
+from dataloader.counter_db import CounterDb, DataVersion, QuarantineTable, ReportInventoryTable
+from dataloader.pipeline import open_report, replay_quarantine
+
+
+def change_seq(load_id):
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT change_seq FROM report_inventory WHERE id = %s", (load_id,))
+    return cursor.fetchone()[0]
+
+
+class NullSink:
+    def write(self, title, metrics):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_replay_marks_the_report_changed(database, tmp_path):
+    path = write_report(tmp_path / 'tr_j3-acm-2022.tsv', [
+        ('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12),
+        ('Journal B', 'ACM Digital Library', 'Total_Requests', [2] * 12),
+    ])
+    load_files([path])
+    rows = QuarantineTable().pending()
+    assert len(rows) == 1
+
+    # Fix the metric type in place and replay the row.
+    values = json.loads(rows[0].row_data)
+    values[values.index('Total_Requests')] = 'Total_Item_Requests'
+    CounterDb.conn.cursor().execute(u"UPDATE quarantine SET row_data = %s", (json.dumps(values),))
+    CounterDb.conn.commit()
+    version = DataVersion().get()
+    load_id = ReportInventoryTable().find(os.path.basename(path))[0].id
+    before = change_seq(load_id)
+
+    report = open_report(path)
+    assert replay_quarantine(report, QuarantineTable().pending()) == 1
+    assert DataVersion().get() > version
+    assert change_seq(load_id) > before
+
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT COUNT(*), SUM(period_total) FROM metric WHERE load_id = %s", (load_id,))
+    assert cursor.fetchone() == (24, 36)
+
+
+def test_replay_needs_a_loaded_report(database, tmp_path):
+    path = write_report(tmp_path / 'tr_j3-acm-2022.tsv',
+        [('Journal B', 'ACM Digital Library', 'Total_Requests', [2] * 12)])
+    report = open_report(path)
+    report.export(NullSink())
+    QuarantineTable().insert(str(tmp_path), report.quarantined_rows())
+    with pytest.raises(ValueError, match='not in the report inventory'):
+        replay_quarantine(report, QuarantineTable().pending())
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT COUNT(*) FROM metric")
+    assert cursor.fetchone() == (0,)
@@ -0,0 +1,47 @@
+import os
+
+from conftest import load_files, write_report
+from dataloader import pipeline
+from dataloader.counter_db import LoadJobTable
+from dataloader.pipeline import open_report, run_job
+from dataloader.reconcile import is_reconciled, reconcile
+
+
+def test_repeated_rows_reconcile_as_the_last_row(database, tmp_path):
+    path = write_report(tmp_path / 'tr_j3-acm-2022.tsv', [
+        ('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12),
+        ('Journal B', 'ACM Digital Library', 'Total_Item_Requests', [5] * 12),
+        ('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [2] * 12),
+    ])
+    load_files([path])
+    result = reconcile(open_report(path))
+    assert is_reconciled(result)
+    assert (result.report_total, result.db_total) == (84, 84)
+
+
+def test_repeated_rows_keep_the_last_row_in_both_layouts(memory_database, tmp_path):
+    # The later row has lower counts, which MAX() would have dropped.
+    path = write_report(tmp_path / 'tr_j3-acm-2022.tsv', [
+        ('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [5] * 12),
+        ('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [2] * 6 + [0] * 6),
+    ])
+    load_files([path])
+    result = reconcile(open_report(path))
+    assert is_reconciled(result)
+    assert (result.report_total, result.db_total) == (12, 12)
+
+
+def test_verify_error_does_not_fail_a_loaded_job(database, tmp_path, monkeypatch):
+    path = write_report(tmp_path / 'tr_j3-acm-2022.tsv',
+        [('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12)])
+    def fail(report):
+        raise ValueError('cannot reconcile')
+    monkeypatch.setattr(pipeline, 'reconcile', fail)
+
+    jobs = LoadJobTable()
+    reportdir = str(tmp_path)
+    jobs.enqueue(reportdir, [path])
+    job = jobs.claim(reportdir, 'test', [os.path.basename(path)])
+    message = run_job(job, reportdir, jobs, 'test', verify=True)
+    assert 'cannot reconcile' in message
+    assert jobs.counts(reportdir)['done'] == 1
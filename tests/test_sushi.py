@@ -0,0 +1,169 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from dataloader.counter_db import CounterDb, LoadJobTable
+from dataloader.pipeline import run_job
+from dataloader.sushi import SushiClient, SushiError, SushiHarvester, SushiReport
+
+PLATFORM = 'ACM Digital Library'
+
+
+class StubSushiServer(ThreadingHTTPServer):
+    """
+    A SUSHI server on localhost serving canned responses. responses maps a
+    report path (e.g. '/r5/reports/tr_j3') to a list of (status, body)
+    pairs, served in turn; the last one is repeated. Requests are recorded
+    as (path, query fields).
+    """
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubSushiHandler)
+        self.responses = {}
+        self.requests = []
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{0}/r5'.format(self.server_address[1])
+
+
+class StubSushiHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append((url.path, parse_qs(url.query)))
+        responses = self.server.responses.get(url.path, [(404, {'Code': 3000, 'Message': 'Not found'})])
+        status, body = responses.pop(0) if len(responses) > 1 else responses[0]
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def sushi_server():
+    server = StubSushiServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def tr_j3(items, exceptions=(), begin='2022-01-01', end='2022-12-31'):
+    """
+    Returns a TR_J3 response. Each item is (title, print ISSN, {month:
+    count}) with Total_Item_Requests counts.
+    """
+    return {
+        'Report_Header': {
+            'Report_Name': 'Journal Requests (Excluding OA_Gold)',
+            'Report_ID': 'TR_J3',
+            'Release': '5',
+            'Created': '2023-01-15T10:00:00Z',
+            'Report_Filters': [{'Name': 'Begin_Date', 'Value': begin}, {'Name': 'End_Date', 'Value': end}],
+            'Exceptions': list(exceptions),
+        },
+        'Report_Items': [{
+            'Title': title,
+            'Item_ID': [{'Type': 'Print_ISSN', 'Value': issn}],
+            'Platform': PLATFORM,
+            'Publisher': 'Publisher',
+            'Access_Type': 'Controlled',
+            'Performance': [{
+                'Period': {'Begin_Date': '2022-{0:02d}-01'.format(month),
+                    'End_Date': '2022-{0:02d}-28'.format(month)},
+                'Instance': [{'Metric_Type': 'Total_Item_Requests', 'Count': count}],
+            } for month, count in sorted(counts.items())],
+        } for title, issn, counts in items],
+    }
+
+
+def client(server, **kwargs):
+    return SushiClient(PLATFORM, server.base_url, 'cust', requests_per_second=100, **kwargs)
+
+
+def test_fetch_reads_every_item_of_a_large_response(sushi_server, tmp_path):
+    # Far more than one CHUNK_SIZE of JSON, so the body arrives in pieces.
+    items = [('Journal {0}'.format(i), '', {1: i, 7: 1}) for i in range(2000)]
+    sushi_server.responses['/r5/reports/tr_j3'] = [(200, tr_j3(items))]
+
+    report = client(sushi_server, requestor_id='req').fetch('tr_j3', '2022-01-01', '2022-12-31', str(tmp_path))
+    path, fields = sushi_server.requests[0]
+    assert fields == {'customer_id': ['cust'], 'requestor_id': ['req'],
+        'begin_date': ['2022-01-01'], 'end_date': ['2022-12-31']}
+    assert report.row_count == 2000
+    rows = list(report.iter_data_rows())
+    assert (rows[0][0], rows[-1][0]) == (1, 2000)
+    title, metrics = report.convert_row(*rows[-1])
+    assert title.title == 'Journal 1999'
+    assert [m.period_total for m in metrics] == [1999, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0]
+
+
+def test_server_exceptions(sushi_server, tmp_path):
+    sushi_server.responses['/r5/reports/tr_j3'] = [(200, {'Code': 2010, 'Message': 'Requestor Not Authorized'})]
+    sushi_server.responses['/r5/reports/tr_b3'] = [(200, [{'Code': 1030, 'Message': 'Insufficient Information'}])]
+    sushi_server.responses['/r5/reports/tr_j1'] = [(200, tr_j3([], [{'Code': 3030, 'Message': 'No Usage'}]))]
+    sushi_server.responses['/r5/reports/tr_b1'] = [(200, tr_j3([], [{'Code': 3031, 'Message': 'Not Ready'}]))]
+    sushi = client(sushi_server)
+    fetch = lambda report: sushi.fetch(report, '2022-01-01', '2022-12-31', str(tmp_path))
+
+    with pytest.raises(SushiError, match='2010 Requestor Not Authorized'):
+        fetch('tr_j3')
+    with pytest.raises(SushiError, match='1030 Insufficient Information'):
+        fetch('tr_b3')
+    # No usage is an empty report, not an error.
+    assert fetch('tr_j1').row_count == 0
+    with pytest.raises(SushiError, match='3031 Not Ready'):
+        fetch('tr_b1')
+    with pytest.raises(SushiError, match='HTTP 404'):
+        fetch('dr')
+
+
+def test_harvest_yields_errors_with_the_reports(sushi_server, tmp_path):
+    sushi_server.responses['/r5/reports/tr_j3'] = [(200, tr_j3([('Journal A', '', {1: 1})]))]
+    sushi_server.responses['/r5/reports/tr_b3'] = [(200, {'Code': 2000, 'Message': 'Service Not Available'})]
+    vendors = [{'platform': PLATFORM, 'base_url': sushi_server.base_url, 'customer_id': 'cust',
+        'requests_per_second': 100}]
+    results = {report: result for platform, report, result
+        in SushiHarvester(vendors, str(tmp_path)).harvest('2022-01-01', '2022-12-31')}
+    assert isinstance(results['tr_j3'], SushiReport)
+    assert isinstance(results['tr_b3'], SushiError)
+
+
+def test_fetch_retries_busy_servers(sushi_server, tmp_path):
+    sushi_server.responses['/r5/reports/tr_j3'] = [
+        (503, {'Code': 1000, 'Message': 'Service Not Available'}),
+        (200, tr_j3([('Journal A', '', {1: 1})])),
+    ]
+    report = client(sushi_server).fetch('tr_j3', '2022-01-01', '2022-12-31', str(tmp_path))
+    assert report.row_count == 1
+    assert len(sushi_server.requests) == 2
+
+
+def test_harvested_report_loads_like_a_spreadsheet(database, sushi_server, tmp_path):
+    sushi_server.responses['/r5/reports/tr_j3'] = [(200, tr_j3([
+        ('Journal A', '1234-5678', {month: 2 for month in range(1, 13)}),
+        ('Journal B', '', {3: 5}),
+    ]))]
+    report = client(sushi_server).fetch('tr_j3', '2022-01-01', '2022-12-31', str(tmp_path))
+    # As harvest-sushi.py does, with the report the harvester opened.
+    jobs = LoadJobTable()
+    jobs.enqueue(str(tmp_path), [report.filename])
+    job = jobs.claim(str(tmp_path), 'harvester', [report.filename])
+    assert run_job(job, str(tmp_path), jobs, 'harvester', report=report, direct=True) is None
+    assert jobs.counts(str(tmp_path))['done'] == 1
+    assert jobs.claim(str(tmp_path), 'other', [report.filename]) is None
+
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT t.title, SUM(m.period_total), COUNT(*) FROM metric m \
+        JOIN title_report t ON t.id = m.title_report_id GROUP BY t.title ORDER BY t.title")
+    assert cursor.fetchall() == [('Journal A', 24, 12), ('Journal B', 5, 12)]
@@ -0,0 +1,82 @@
+from conftest import load_files, write_report
+from dataloader.counter_db import CounterDb, MetricTable, ReportInventoryTable, TitleReportTable
+
+
+def usage():
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT t.title, m.metric_type, m.period, m.period_total FROM metric m \
+        JOIN title_report t ON t.id = m.title_report_id ORDER BY 1, 2, 3")
+    return cursor.fetchall()
+
+
+def unload(path):
+    (row,) = ReportInventoryTable().find(path)
+    MetricTable().unload(row.id)
+    TitleReportTable().unload(row.id)
+    ReportInventoryTable().delete(row.id)
+
+
+def test_load_unload_round_trip(memory_database, tmp_path):
+    first = write_report(tmp_path / 'tr_j3-acm-2022.tsv', [
+        ('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12),
+        ('Journal B', 'ACM Digital Library', 'Total_Item_Requests', [2] * 12),
+        # A repeated row is loaded as its last occurrence.
+        ('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [3] * 12),
+    ])
+    second = write_report(tmp_path / 'tr_j3-acm-2022b.tsv', [
+        ('Journal B', 'ACM Digital Library', 'Total_Item_Requests', [4] * 12),
+        ('Journal C', 'ACM Digital Library', 'Total_Item_Requests', [5] * 6 + [0] * 6),
+        ('Journal C', 'ACM Digital Library', 'Unique_Item_Requests', [6] * 12),
+        ('Journal C', 'ACM Digital Library', 'Total_Item_Investigations', [7] * 12),
+    ], created='2023-02-01T10:00:00Z')
+
+    load_files([first])
+    loaded = usage()
+    assert sorted(set((title, total) for title, metric_type, period, total in loaded)) == [
+        ('Journal A', 3), ('Journal B', 2)]
+
+    load_files([second])
+    assert set((title, total) for title, metric_type, period, total in usage()) == {
+        ('Journal A', 3), ('Journal B', 4), ('Journal C', 5), ('Journal C', 0), ('Journal C', 6),
+        ('Journal C', 7)}
+
+    # Taking the second report out restores the usage it overwrote and
+    # removes the title only it listed.
+    unload(second)
+    assert usage() == loaded
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT title FROM title_report ORDER BY title")
+    assert cursor.fetchall() == [('Journal A',), ('Journal B',)]
+
+    unload(first)
+    assert usage() == []
+    cursor.execute(u"SELECT COUNT(*) FROM title_report")
+    assert cursor.fetchone() == (0,)
+
+
+def test_unload_clears_other_caches_and_cluster_keys(database, tmp_path):
+    first = write_report(tmp_path / 'tr_j3-acm-2022.tsv',
+        [('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12, '1234-5678')])
+    load_files([first])
+    assert TitleReportTable._title_ids
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT COUNT(*) FROM title_cluster_key")
+    assert cursor.fetchone() == (1,)
+
+    # Another process, e.g. a watch daemon, keeps its cache until it sees
+    # that titles were deleted.
+    cached = (dict(TitleReportTable._title_ids), TitleReportTable._cache_version)
+    unload(first)
+    TitleReportTable._title_ids, TitleReportTable._cache_version = cached
+    TitleReportTable.check_cache()
+    assert TitleReportTable._title_ids == {}
+
+    for table in ['title_report', 'title_cluster', 'title_cluster_key']:
+        cursor.execute(u"SELECT COUNT(*) FROM {0}".format(table))
+        assert cursor.fetchone() == (0,), table
+
+    # Loading the report again gets new title ids.
+    load_files([write_report(tmp_path / 'tr_j3-acm-2022b.tsv',
+        [('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12)])])
+    cursor.execute(u"SELECT COUNT(*) FROM metric m JOIN title_report t ON t.id = m.title_report_id")
+    assert cursor.fetchone() == (12,)
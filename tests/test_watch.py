@@ -0,0 +1,59 @@
+import threading
+
+from conftest import write_report
+from dataloader.counter_db import CounterDb, LoadJobTable, MetricTable, ReportInventoryTable, TitleReportTable
+from dataloader.pipeline import watch_reports
+from dataloader.watch import DirectoryWatcher
+
+
+def unload_elsewhere(name):
+    """
+    Unloads a report as unload-report.py does, in what stands for another
+    process: the title id cache of this one is left as it was.
+    """
+    cached = (dict(TitleReportTable._title_ids), TitleReportTable._cache_version)
+    (row,) = ReportInventoryTable().find(name)
+    MetricTable().unload(row.id)
+    TitleReportTable().unload(row.id)
+    ReportInventoryTable().delete(row.id)
+    LoadJobTable().mark_unloaded(row.excel_name)
+    TitleReportTable._title_ids, TitleReportTable._cache_version = cached
+
+
+def test_daemon_drops_title_ids_of_titles_unloaded_between_files(database, tmp_path):
+    reportdir = str(tmp_path)
+    stagedir = tmp_path / 'staging'
+    stagedir.mkdir()
+    write_report(tmp_path / 'tr_j3-acm-2022.tsv',
+        [('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [1] * 12, '1234-5678')])
+
+    stop = threading.Event()
+    watcher = DirectoryWatcher(reportdir, ['tr*.tsv'], settle_seconds=0, poll_seconds=0.01)
+    daemon = watch_reports(watcher, reportdir, LoadJobTable(), 'daemon', stop, str(stagedir))
+    try:
+        # The daemon waits for its next file while the test acts.
+        assert next(daemon) == ('tr_j3-acm-2022.tsv', None)
+        stale_ids = set(TitleReportTable._title_ids.values())
+        assert stale_ids
+
+        unload_elsewhere('tr_j3-acm-2022.tsv')
+        write_report(tmp_path / 'tr_j3-acm-2022b.tsv', [
+            ('Journal A', 'ACM Digital Library', 'Total_Item_Requests', [2] * 12, '1234-5678'),
+            ('Journal B', 'ACM Digital Library', 'Total_Item_Requests', [3] * 12),
+        ], created='2023-02-01T10:00:00Z')
+        assert next(daemon) == ('tr_j3-acm-2022b.tsv', None)
+    finally:
+        stop.set()
+        daemon.close()
+        watcher.close()
+
+    cursor = CounterDb.conn.cursor()
+    cursor.execute(u"SELECT t.id, t.title, SUM(m.period_total) FROM metric m \
+        JOIN title_report t ON t.id = m.title_report_id GROUP BY t.id, t.title ORDER BY t.title")
+    rows = cursor.fetchall()
+    assert [(title, total) for title_id, title, total in rows] == [('Journal A', 24), ('Journal B', 36)]
+    assert not stale_ids & {title_id for title_id, title, total in rows}
+    cursor.execute(u"SELECT COUNT(*) FROM metric WHERE title_report_id NOT IN (SELECT id FROM title_report)")
+    assert cursor.fetchone() == (0,)
+    cursor.execute(u"SELECT COUNT(*) FROM title_cluster WHERE title_report_id NOT IN (SELECT id FROM title_report)")
+    assert cursor.fetchone() == (0,)
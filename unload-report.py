@@ -0,0 +1,86 @@
+import argparse
+import sys
+import traceback
+from datetime import datetime
+
+from dataloader.counter_db import LoadJobTable, MetricTable, ReportInventoryTable, TitleReportTable
+
+
+# Takes a loaded title report back out of the database, e.g. when a vendor
+# file turns out to be wrong. The report is given by file name or by its
+# report_inventory id (see audit-reports.py).
+#
+# Every title_report and metric row is tagged with the inventory id of the
+# report that last wrote it (load_id), so the report's rows are found on
+# the idx_load_id index. Metric rows the report inserted are deleted and
+# rows it overwrote get their previous values back; titles left without
+# usage are deleted. The work is done in batches, each in its own
+# transaction, so an interrupted unload can simply be run again. Finally
+# the inventory row is removed and the report's load jobs are marked
+# failed, so the file is only loaded again once it is replaced or failed
+# jobs are retried.
+#
+# Deleted titles are taken out of their clusters, with the ISSN and ISBN
+# keys no other title of the cluster has. Loaders cache title ids: the
+# unload bumps the titles counter in data_version, and running loaders,
+# such as watch-reports.py, drop their cache before their next file. Item
+# reports are not tagged and cannot be unloaded.
+
+def write_error(err_msg):
+    logfile = open('errors.log', 'at')
+    logfile.write(datetime.now().isoformat() + '\n')
+    logfile.write(err_msg + '\n')
+    logfile.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage='python unload-report.py <report file name or inventory id> [--export-parquet <directory>]')
+    parser.add_argument('report')
+    parser.add_argument('--export-parquet', metavar='DIR',
+        help='rewrite the Parquet partitions the report covered in this directory')
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+        sys.exit(0)
+
+    args = parser.parse_args()
+    inv = ReportInventoryTable()
+    rows = inv.find(args.report)
+    if not rows:
+        print('{0} is not in the report inventory'.format(args.report))
+        sys.exit(1)
+    if len(rows) > 1:
+        print('{0} matches several inventory rows, give the id instead:'.format(args.report))
+        for row in rows:
+            print('  {0} {1} {2} to {3}'.format(row.id, row.platform, row.begin_date, row.end_date))
+        sys.exit(1)
+    row = rows[0]
+    if row.excel_name.startswith('ir'):
+        print('{0} is an item report, which cannot be unloaded'.format(row.excel_name))
+        sys.exit(1)
+
+    if args.export_parquet:
+        # The partitions are found from the report's rows, before they go.
+        from dataloader.export import ParquetExporter
+        exporter = ParquetExporter(args.export_parquet)
+        partitions = MetricTable().partitions([row.id])
+
+    start = datetime.now()
+    try:
+        deleted, restored = MetricTable().unload(row.id)
+        titles = TitleReportTable().unload(row.id)
+        inv.delete(row.id)
+        LoadJobTable().mark_unloaded(row.excel_name)
+    except Exception:
+        print('{0}: ERROR (see errors.log)'.format(row.excel_name))
+        write_error('{0}\n{1}'.format(row.excel_name, traceback.format_exc()))
+        sys.exit(1)
+    print('{0}: {1} metric rows deleted, {2} restored, {3} titles deleted in {4}'.format(
+        row.excel_name, deleted, restored, titles, str(datetime.now() - start).split('.')[0]))
+
+    if args.export_parquet:
+        for year, platform_id in sorted(partitions):
+            count = exporter.write_partition(year, platform_id)
+            print('year={0} platform_id={1}: {2} rows'.format(year, platform_id, count))
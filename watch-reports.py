@@ -0,0 +1,84 @@
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+from datetime import datetime
+
+from dataloader.counter_db import LoadJobTable, PlatformTable
+from dataloader.export import ParquetExporter
+from dataloader.pipeline import watch_reports
+from dataloader.watch import DirectoryWatcher
+
+
+# Runs the loader continuously: the report directory is watched and each
+# new report is loaded as soon as it has been completely copied in.
+#
+# The process keeps its database connection, the platform resolver and
+# the title id cache between files, so each file only pays for its own
+# load. Files are queued and claimed in load_job exactly as by loader.py,
+# so the daemon can run next to batch loaders or other daemons.
+#
+# SIGTERM or Ctrl-C stops the daemon after the file being loaded, if any,
+# is finished.
+
+REPORT_PATTERNS = ['[ijt]r*.xlsx', 'tr*.tsv', 'tr*.csv']
+
+def write_error(err_msg):
+    logfile = open('errors.log', 'at')
+    logfile.write(datetime.now().isoformat() + '\n')
+    logfile.write(err_msg + '\n')
+    logfile.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        usage='python watch-reports.py <report directory> [--settle SECONDS] [--poll SECONDS]')
+    parser.add_argument('reportdir')
+    parser.add_argument('--settle', type=float, default=30,
+        help='seconds a file must stay unchanged before it is loaded')
+    parser.add_argument('--poll', type=float, default=10,
+        help='seconds between directory scans when inotify is not available')
+    parser.add_argument('--node', default='{0}:{1}'.format(socket.gethostname(), os.getpid()),
+        help='name of this loader process in load_job, defaults to host:pid')
+    parser.add_argument('--stale-minutes', type=float, default=10,
+        help='take over files whose claim has had no heartbeat for this long')
+    parser.add_argument('--verify', action='store_true',
+        help='after loading each report, check the loaded totals against it')
+    parser.add_argument('--export-parquet', metavar='DIR',
+        help='after each load, rewrite the Parquet partitions it touched')
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+    else:
+        args = parser.parse_args()
+        reportdir = os.path.abspath(args.reportdir)
+        stagedir = os.path.join(reportdir, '.staging', args.node.replace(os.sep, '_').replace(':', '_'))
+        os.makedirs(stagedir, exist_ok=True)
+        stale_after = int(args.stale_minutes * 60)
+
+        stop = threading.Event()
+        def request_stop(signum, frame):
+            print('Stopping after the current file')
+            stop.set()
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        jobs = LoadJobTable()
+        PlatformTable().get_resolver()
+        watcher = DirectoryWatcher(reportdir, REPORT_PATTERNS, args.settle, args.poll)
+        print('Watching {0} ({1})'.format(reportdir, 'inotify' if watcher.uses_inotify else 'polling'))
+
+        try:
+            for name, message in watch_reports(watcher, reportdir, jobs, args.node, stop, stagedir,
+                    stale_after, args.verify):
+                if message:
+                    print('  ERROR (see errors.log)')
+                    write_error(message)
+                elif args.export_parquet:
+                    ParquetExporter(args.export_parquet).export()
+        finally:
+            watcher.close()
+        print('Stopped')